@@ -0,0 +1,158 @@
+"""Benchmark the selectors of AutoMR.
+
+Runs `--num_updates` sample/update rounds over `--num_arms` arms with
+random rewards, and reports the time per round of the array-backed
+selectors (`--selectors`), at the start and at the end of the run
+(which should be the same, i.e. independent of the number of previous
+updates). The previous list-based implementation (whose
+`get_reward_histories` scans all the previous updates) is run for
+`--num_legacy_updates` rounds only, as it is quadratic in the number
+of updates.
+
+Then, each selector is run for `--num_simulated_updates` rounds against
+a simulated validation score, which moves by a fixed (random) gain of
+the chosen arm plus noise, and the share of the rounds on the arm of
+the largest gain is reported, i.e. how few evaluations a selector
+needs to find the best task.
+
+Usage (from the root of the repo):
+    python -m benchmarks.bandit_selector \
+        --num_updates 100000 --num_arms 50 \
+        --selectors BernoulliTS GaussianTS DiscountedUCB EXP3
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from multitask import multitask_autoMR_model
+
+
+class _LegacyBernoulliBanditTS(object):
+    """The list-based selector of previous versions"""
+
+    def __init__(self, num_actions, reward_shaping_fn, decay_rate):
+        self._num_actions = num_actions
+        self._reward_shaping_fn = reward_shaping_fn
+        self._decay_rate = decay_rate
+        self._parameters = [[1., 1.] for _ in range(num_actions)]
+        self._update_histories = []
+
+    def get_reward_histories(self, chosen_arm):
+        histories = [h[0] for h in self._update_histories]
+        arm_histories = [h[0] for h in self._update_histories
+                         if h[1] == chosen_arm]
+        return histories or [0.0], arm_histories or [0.0]
+
+    def sample(self, step=0):
+        sampled_means = np.random.beta(
+            [p[0] for p in self._parameters],
+            [p[1] for p in self._parameters])
+        return multitask_autoMR_model.random_argmax(sampled_means), None
+
+    def update(self, reward, chosen_arm):
+        shaped_reward = self._reward_shaping_fn(
+            reward, *self.get_reward_histories(chosen_arm))
+        for arm in range(self._num_actions):
+            for i in range(2):
+                self._parameters[arm][i] = (
+                    (1 - self._decay_rate) * self._parameters[arm][i] +
+                    self._decay_rate)
+
+        self._parameters[chosen_arm][0] += shaped_reward
+        self._parameters[chosen_arm][1] += 1 - shaped_reward
+        self._update_histories.append(
+            (reward, chosen_arm, [list(p) for p in self._parameters]))
+
+
+def _run(selector, rewards):
+    """Returns the seconds of each sample/update round"""
+    seconds = np.zeros([len(rewards)])
+    for i, reward in enumerate(rewards):
+        start_time = time.time()
+        chosen_arm, _ = selector.sample(step=i)
+        selector.update(reward=reward, chosen_arm=chosen_arm)
+        seconds[i] = time.time() - start_time
+    return seconds
+
+
+def _simulate(selector, gains, num_updates, noise, random_state):
+    """Returns the share of the rounds on the best arm"""
+    score = 0.0
+    best_arm = np.argmax(gains)
+    num_best = 0
+    for i in range(num_updates):
+        chosen_arm, _ = selector.sample(step=i)
+        score += gains[chosen_arm] + noise * random_state.randn()
+        selector.update(reward=score, chosen_arm=chosen_arm)
+        num_best += int(chosen_arm == best_arm)
+    return num_best / num_updates
+
+
+def _report(name, seconds, window):
+    window = max(1, min(window, len(seconds) // 2))
+    print("%-16s %10d %14.1f %14.1f %12.2f" % (
+        name, len(seconds),
+        np.mean(seconds[:window]) * 1e6,
+        np.mean(seconds[-window:]) * 1e6,
+        np.sum(seconds)))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_updates", type=int, default=100000)
+    parser.add_argument("--num_legacy_updates", type=int, default=5000)
+    parser.add_argument("--num_arms", type=int, default=50)
+    parser.add_argument("--decay_rate", type=float, default=0.3)
+    parser.add_argument("--window", type=int, default=1000)
+    parser.add_argument("--random_seed", type=int, default=1234)
+    parser.add_argument("--selectors", type=str, nargs="+",
+                        default=[multitask_autoMR_model.DEFAULT_SELECTOR])
+    parser.add_argument("--num_simulated_updates", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.01)
+    args = parser.parse_args(arguments)
+
+    random_state = np.random.RandomState(args.random_seed)
+    rewards = random_state.rand(args.num_updates)
+    reward_shaping_fn = multitask_autoMR_model._binary_prediction_gain_v3
+
+    print("%-16s %10s %14s %14s %12s" % (
+        "Selector", "Updates", "First (us)", "Last (us)", "Total (s)"))
+
+    np.random.seed(args.random_seed)
+    legacy_seconds = _run(
+        _LegacyBernoulliBanditTS(
+            num_actions=args.num_arms,
+            reward_shaping_fn=reward_shaping_fn,
+            decay_rate=args.decay_rate),
+        rewards[:args.num_legacy_updates])
+    _report("list", legacy_seconds, args.window)
+
+    for selector_type in args.selectors:
+        np.random.seed(args.random_seed)
+        selector = multitask_autoMR_model.create_selector(
+            selector_type,
+            num_actions=args.num_arms,
+            decay_rate=args.decay_rate)
+        _report(selector_type, _run(selector, rewards), args.window)
+
+    gains = random_state.randn(args.num_arms) * args.noise
+    print("%-16s %14s" % ("Selector", "Best arm (%)"))
+    for selector_type in args.selectors:
+        np.random.seed(args.random_seed)
+        selector = multitask_autoMR_model.create_selector(
+            selector_type,
+            num_actions=args.num_arms,
+            decay_rate=args.decay_rate)
+        best_share = _simulate(
+            selector, gains, args.num_simulated_updates, args.noise,
+            np.random.RandomState(args.random_seed))
+        print("%-16s %14.1f" % (selector_type, 100. * best_share))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+"""Benchmark the storage encodings of the packed ELMo store.
+
+Two reports are available:
+
+    reconstruction: size on disk and reconstruction error of each
+        encoding versus float32, computed directly from the stores
+    accuracy: trains one model per encoding with `run_MTL.py`, and
+        reports the best validation score and the delta versus float32
+
+Usage (from the root of the repo):
+    python -m benchmarks.elmo_cache_encodings reconstruction \
+        --files [split].sequence_1 ...
+    python -m benchmarks.elmo_cache_encodings accuracy \
+        --task_sets MRPC-QQP-WNLI-QNLI-RTE-MNLIMatched \
+                    RTE-QQP-WNLI-QNLI-MRPC-MNLIMatched \
+        --logdir [logdir] -- [additional run_MTL.py arguments]
+
+The stores of every encoding must have been built beforehand with
+`python elmo_cache_utils.py pack --encoding [encoding]`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+import elmo_cache_utils
+from constants import TRAIN_LOGFILE_SUFFIX
+
+
+def _store_size(fname, variant):
+    prefix = elmo_cache_utils.packed_prefix(fname, variant)
+    return sum(os.path.getsize(prefix + suffix)
+               for suffix in [".values", ".scales", ".zero_points"]
+               if os.path.exists(prefix + suffix))
+
+
+def reconstruction_report(fnames, encodings, max_rows=None):
+    print("%-40s %-8s %12s %12s %12s" % (
+        "File", "Encoding", "Size (MB)", "MaxAbsErr", "RMSE"))
+
+    for fname in fnames:
+        reference = elmo_cache_utils.open_reader(
+            fname, backend=elmo_cache_utils.PACKED_BACKEND)
+        num_rows = (len(reference) if max_rows is None
+                    else min(max_rows, len(reference)))
+
+        for encoding in encodings:
+            variant = elmo_cache_utils.default_variant(encoding)
+            reader = elmo_cache_utils.open_reader(
+                fname, backend=elmo_cache_utils.PACKED_BACKEND,
+                variant=variant)
+
+            max_abs_error = 0.0
+            squared_error = 0.0
+            num_values = 0
+            for i in range(num_rows):
+                error = (np.asarray(reader[i], dtype=np.float32) -
+                         np.asarray(reference[i], dtype=np.float32))
+                max_abs_error = max(max_abs_error, np.abs(error).max())
+                squared_error += np.square(error).sum()
+                num_values += error.size
+
+            print("%-40s %-8s %12.1f %12.5f %12.5f" % (
+                fname[-40:], encoding,
+                _store_size(fname, variant) / 2. ** 20,
+                max_abs_error,
+                np.sqrt(squared_error / max(num_values, 1))))
+
+
+def _read_best_scores(train_logfile):
+    """Parse the last line written by `run_MTL.trainMTL`"""
+    with open(train_logfile) as f:
+        lines = [l for l in f.read().split("\n") if l.strip()]
+
+    scores = {}
+    for item in lines[-1].split("\t"):
+        if item.strip():
+            tag, score = item.rsplit(":", 1)
+            scores[tag.strip()] = float(score)
+    return scores
+
+
+def accuracy_report(task_sets, encodings, logdir, run_MTL_args):
+    results = {}
+    for tasks in task_sets:
+        for encoding in encodings:
+            variant = elmo_cache_utils.default_variant(encoding)
+            trial_logdir = os.path.join(logdir, "%s_%s" % (tasks, encoding))
+            command = [sys.executable, "run_MTL.py",
+                       "--tasks", tasks,
+                       "--logdir", trial_logdir,
+                       "--elmo_cache_backend",
+                       elmo_cache_utils.PACKED_BACKEND] + run_MTL_args
+            if variant is not None:
+                command += ["--elmo_cache_variant", variant]
+
+            print("Running %s" % " ".join(command))
+            subprocess.check_call(command)
+            results[tasks, encoding] = _read_best_scores(
+                trial_logdir + TRAIN_LOGFILE_SUFFIX)
+
+    print("%-40s %-8s %10s %10s" % ("Tasks", "Encoding", "Score", "Delta"))
+    for tasks in task_sets:
+        reference = results.get((tasks, elmo_cache_utils.FLOAT32_ENCODING))
+        for encoding in encodings:
+            score = results[tasks, encoding]["Scores"]
+            delta = (score - reference["Scores"]
+                     if reference is not None else float("nan"))
+            print("%-40s %-8s %10.4f %+10.4f" % (
+                tasks[-40:], encoding, score, delta))
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    reconstruction_parser = subparsers.add_parser("reconstruction")
+    reconstruction_parser.add_argument(
+        "--files", nargs="+", required=True)
+    reconstruction_parser.add_argument(
+        "--encodings", nargs="+", default=elmo_cache_utils.ENCODINGS)
+    reconstruction_parser.add_argument(
+        "--max_rows", type=int, default=None)
+
+    accuracy_parser = subparsers.add_parser("accuracy")
+    accuracy_parser.add_argument(
+        "--task_sets", nargs="+", required=True,
+        help="the main task comes first, e.g. MRPC-QQP-WNLI")
+    accuracy_parser.add_argument(
+        "--encodings", nargs="+", default=elmo_cache_utils.ENCODINGS)
+    accuracy_parser.add_argument(
+        "--logdir", type=str, required=True)
+
+    args = parser.parse_args(arguments)
+
+    if args.command == "reconstruction":
+        reconstruction_report(args.files, args.encodings, args.max_rows)
+
+    elif args.command == "accuracy":
+        accuracy_report(args.task_sets, args.encodings,
+                        args.logdir, run_MTL_args)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
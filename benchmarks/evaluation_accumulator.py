@@ -0,0 +1,98 @@
+"""Benchmark the evaluation accumulator of `MultitaskBaseModel._evaluate`.
+
+Simulates the fetched batches of a validation split (40k examples by
+default, i.e. about the size of QQP/MNLI), and compares the wall time
+and the peak memory of the previous accumulation (`.tolist()` and list
+concatenation, scored with `sklearn.metrics.accuracy_score`) with the
+array-backed one (scored with `tasks._accuracy`). Session time is
+not included, only the accumulation and the scoring.
+
+Usage (from the root of the repo):
+    python -m benchmarks.evaluation_accumulator \
+        --num_examples 40000 --batch_size 128 --num_classes 3
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from sklearn import metrics
+
+from multitask import tasks
+from multitask import multitask_base_model
+
+
+def _list_accumulation(batches):
+    all_logits = []
+    all_predictions = []
+    all_targets = []
+    for logits, predictions, targets in batches:
+        all_logits += logits.tolist()
+        all_predictions += predictions.tolist()
+        all_targets += targets.tolist()
+
+    return metrics.accuracy_score(all_targets, all_predictions)
+
+
+def _array_accumulation(batches):
+    all_logits = multitask_base_model._ArrayAccumulator(np.float32)
+    all_predictions = multitask_base_model._ArrayAccumulator(np.int64)
+    all_targets = multitask_base_model._ArrayAccumulator(np.int64)
+    for logits, predictions, targets in batches:
+        all_logits.append(logits)
+        all_predictions.append(predictions)
+        all_targets.append(targets)
+
+    return tasks._accuracy(all_targets.values, all_predictions.values)
+
+
+def _measure(fn, batches, num_repeats):
+    seconds = []
+    for _ in range(num_repeats):
+        start_time = time.time()
+        score = fn(batches)
+        seconds.append(time.time() - start_time)
+
+    tracemalloc.start()
+    fn(batches)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return score, np.median(seconds), peak_bytes
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_examples", type=int, default=40000)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--num_classes", type=int, default=3)
+    parser.add_argument("--num_repeats", type=int, default=5)
+    parser.add_argument("--random_seed", type=int, default=1234)
+    args = parser.parse_args(arguments)
+
+    random_state = np.random.RandomState(args.random_seed)
+    batches = []
+    for start in range(0, args.num_examples, args.batch_size):
+        batch_size = min(args.batch_size, args.num_examples - start)
+        logits = random_state.randn(
+            batch_size, args.num_classes).astype(np.float32)
+        batches.append((
+            logits,
+            np.argmax(logits, axis=1),
+            random_state.randint(args.num_classes, size=batch_size)))
+
+    print("%-8s %10s %12s %14s" % (
+        "Method", "Score", "Time (ms)", "Peak (MB)"))
+    for name, fn in [("list", _list_accumulation),
+                     ("array", _array_accumulation)]:
+        score, seconds, peak_bytes = _measure(fn, batches, args.num_repeats)
+        print("%-8s %10.4f %12.1f %14.1f" % (
+            name, score, seconds * 1000., peak_bytes / 2. ** 20))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+"""Benchmark the `LstmEncoder` unit types on CPU.
+
+For each unit type, builds an encoder on random inputs, and reports the
+training steps/sec (forward, backward and Adam update). The weights of
+the first unit type are saved, and restored into the others by name,
+to check that the checkpoints are compatible and the outputs match.
+
+Usage (from the root of the repo):
+    python -m benchmarks.lstm_encoder_speed \
+        --num_units 512 --num_layers 2 --batch_size 32 --max_length 50
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from multitask import modules
+
+
+def _build(unit_type, args, is_training):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(args.random_seed)
+        inputs = tf.placeholder(
+            tf.float32, [None, None, args.input_dim], name="inputs")
+        sequence_length = tf.placeholder(
+            tf.int32, [None], name="sequence_length")
+
+        encoder = modules.LstmEncoder(
+            unit_type=unit_type,
+            num_units=args.num_units,
+            num_layers=args.num_layers,
+            dropout_rate=args.dropout_rate,
+            is_training=is_training,
+            name="LstmEncoder")
+        outputs, _ = encoder(inputs=inputs, sequence_length=sequence_length)
+
+        loss = tf.reduce_mean(tf.reduce_max(outputs, axis=1))
+        train_op = tf.train.AdamOptimizer().minimize(loss)
+        saver = tf.train.Saver(var_list=tf.trainable_variables())
+        init_op = tf.global_variables_initializer()
+
+    sess = tf.Session(graph=graph, config=tf.ConfigProto(
+        intra_op_parallelism_threads=args.num_threads,
+        inter_op_parallelism_threads=args.num_threads))
+    sess.run(init_op)
+
+    return {"Session": sess,
+            "Saver": saver,
+            "Inputs": inputs,
+            "SequenceLength": sequence_length,
+            "Outputs": outputs,
+            "TrainOp": train_op}
+
+
+def _feed_dict(model, batch):
+    return {model["Inputs"]: batch[0],
+            model["SequenceLength"]: batch[1]}
+
+
+def steps_per_second(unit_type, args, batches):
+    model = _build(unit_type, args, is_training=True)
+    for batch in batches[:args.num_warmup_steps]:
+        model["Session"].run(model["TrainOp"], _feed_dict(model, batch))
+
+    start_time = time.time()
+    for batch in batches[args.num_warmup_steps:]:
+        model["Session"].run(model["TrainOp"], _feed_dict(model, batch))
+    seconds = time.time() - start_time
+
+    model["Session"].close()
+    return (len(batches) - args.num_warmup_steps) / seconds
+
+
+def max_output_difference(unit_types, args, batch):
+    """restore the weights of the first unit type into the others"""
+    ckpt = os.path.join(tempfile.mkdtemp(), "model.ckpt")
+    reference = _build(unit_types[0], args, is_training=False)
+    reference["Saver"].save(reference["Session"], ckpt)
+    reference_outputs = reference["Session"].run(
+        reference["Outputs"], _feed_dict(reference, batch))
+
+    differences = {}
+    for unit_type in unit_types[1:]:
+        model = _build(unit_type, args, is_training=False)
+        model["Saver"].restore(model["Session"], ckpt)
+        outputs = model["Session"].run(
+            model["Outputs"], _feed_dict(model, batch))
+        differences[unit_type] = np.abs(outputs - reference_outputs).max()
+        model["Session"].close()
+
+    reference["Session"].close()
+    return differences
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unit_types", nargs="+",
+                        default=["lstm", modules.FUSED_LSTM_UNIT_TYPE])
+    parser.add_argument("--num_units", type=int, default=512)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--input_dim", type=int, default=1024)
+    parser.add_argument("--dropout_rate", type=float, default=0.5)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_length", type=int, default=50)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--num_warmup_steps", type=int, default=5)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--random_seed", type=int, default=1234)
+    args = parser.parse_args(arguments)
+
+    random_state = np.random.RandomState(args.random_seed)
+    batches = []
+    for _ in range(args.num_steps + args.num_warmup_steps):
+        batches.append((
+            random_state.randn(
+                args.batch_size, args.max_length,
+                args.input_dim).astype(np.float32),
+            random_state.randint(
+                1, args.max_length + 1, size=args.batch_size)))
+
+    print("%-20s %12s" % ("UnitType", "Steps/sec"))
+    for unit_type in args.unit_types:
+        print("%-20s %12.2f" % (
+            unit_type, steps_per_second(unit_type, args, batches)))
+
+    differences = max_output_difference(args.unit_types, args, batches[0])
+    for unit_type, difference in differences.items():
+        print("Max |outputs(%s) - outputs(%s)| = %.2e" % (
+            unit_type, args.unit_types[0], difference))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,108 @@
+"""Compare the proxy reward of AutoMR with the full evaluation.
+
+Trains an AutoMR model (updated with the full evaluation, as usual),
+and at every evaluation also evaluates the fixed proxy subset. Reports
+the wall time of both, and how often the binary rewards of the selector
+(`_binary_prediction_gain_v3`, i.e. whether the score did not decrease)
+computed from both agree.
+
+Usage (from the root of the repo):
+    python -m benchmarks.proxy_reward \
+        --logdir [logdir] --num_steps 2000 --steps_per_eval 100 \
+        --proxy_eval_size 256 -- \
+        --tasks RTE-MNLI-QQP --model_type CachedELMO-LSTM-Hard \
+        --stage 1 --random_seed 1234 [additional run_MTL.py arguments]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import numpy as np
+
+import run_MTL
+import model_utils
+from utils import misc_utils
+from constants import AUTOMR_MAX_EVAL_BATCHES
+
+
+def _binary_rewards(scores):
+    return [float(score >= previous)
+            for previous, score in zip(scores[:-1], scores[1:])]
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logdir", type=str, required=True)
+    parser.add_argument("--num_steps", type=int, default=2000)
+    parser.add_argument("--steps_per_eval", type=int, default=100)
+    parser.add_argument("--proxy_eval_size", type=int, default=256)
+    args = parser.parse_args(arguments)
+
+    hparams = run_MTL.get_hparams(run_MTL_args + [
+        "--logdir", args.logdir,
+        "--shared_eval",
+        "--automr_proxy_eval_size", str(args.proxy_eval_size)])
+    np.random.seed(hparams.numpy_seed)
+
+    train_MTL_model, val_MTL_model = model_utils.build_model(hparams)
+    train_MTL_model.initialize_or_restore_session(
+        ckpt_file=hparams.ckpt_file,
+        var_filter_fn=lambda name: "Adam" not in name)
+    train_MTL_model.initialize_data_iterator(model_idx=None)
+
+    start_time = time.time()
+    proxy_size = train_MTL_model.initialize_proxy_eval(args.proxy_eval_size)
+    load_seconds = time.time() - start_time
+
+    full_scores, full_seconds = [], []
+    proxy_scores, proxy_seconds = [], []
+    for step in range(1, args.num_steps + 1):
+        train_MTL_model.train()
+        if step % args.steps_per_eval != 0:
+            continue
+
+        with misc_utils.suppress_stdout():
+            start_time = time.time()
+            val_MTL_model.initialize_data_iterator(
+                [hparams.eval_model_index])
+            scores_dict = val_MTL_model.evaluate(
+                model_idx=hparams.eval_model_index,
+                max_eval_batches=AUTOMR_MAX_EVAL_BATCHES)
+            full_seconds.append(time.time() - start_time)
+            full_scores.append(scores_dict["MAIN"])
+
+            start_time = time.time()
+            proxy_scores.append(train_MTL_model.proxy_evaluate(
+                write_to_summary=False)["MAIN"])
+            proxy_seconds.append(time.time() - start_time)
+
+        train_MTL_model.update_TaskSelector(scores_dict["MAIN"])
+
+    full_rewards = _binary_rewards(full_scores)
+    proxy_rewards = _binary_rewards(proxy_scores)
+    print("Proxy subset: %d examples, loaded in %.2fs" % (
+        proxy_size, load_seconds))
+    print("%-8s %14s %12s" % ("Reward", "Time (ms)", "Mean score"))
+    print("%-8s %14.1f %12.4f" % (
+        "full", np.mean(full_seconds) * 1000., np.mean(full_scores)))
+    print("%-8s %14.1f %12.4f" % (
+        "proxy", np.mean(proxy_seconds) * 1000., np.mean(proxy_scores)))
+    if full_rewards:
+        print("Binary reward agreement: %.1f%% over %d updates" % (
+            100. * np.mean(np.equal(full_rewards, proxy_rewards)),
+            len(full_rewards)))
+        print("Score correlation: %.3f" % (
+            np.corrcoef(full_scores, proxy_scores)[0, 1]))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+"""Compare the per-task optimizers with the `--shared_optimizer` mode.
+
+Builds the model twice from the same `run_MTL.py` arguments (and seed),
+once with one optimizer per task and once with a single shared one, and
+trains both on the same round-robin task schedule. Reports the graph
+build time, the size of the optimizer variables, and the difference
+between the (smoothed) training curves, and exits with a non-zero
+status when the curves differ by more than `--tolerance`.
+
+Usage (from the root of the repo):
+    python -m benchmarks.shared_optimizer \
+        --logdir [logdir] --num_steps 500 -- \
+        --tasks MRPC-QQP-WNLI --model_type CachedELMO-LSTM-Hard \
+        --stage 1 --random_seed 1234 [additional run_MTL.py arguments]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+import run_MTL
+import model_utils
+
+
+def _base_model(model):
+    # e.g. unwrap the `MTLAutoMRModel`
+    return getattr(model, "_model", model)
+
+
+def _optimizer_variables(model):
+    graph = _base_model(model)._graph
+    with graph.as_default():
+        trainable_variables = set(tf.trainable_variables())
+        return [v for v in tf.global_variables()
+                if v not in trainable_variables and
+                "global_step" not in v.op.name]
+
+
+def _smooth(values, window):
+    window = max(1, min(window, len(values)))
+    return np.convolve(values, np.ones(window) / window, mode="valid")
+
+
+def run(run_MTL_args, logdir, shared_optimizer, num_steps):
+    argv = run_MTL_args + ["--logdir", logdir]
+    if shared_optimizer:
+        argv += ["--shared_optimizer"]
+    hparams = run_MTL.get_hparams(argv)
+    np.random.seed(hparams.numpy_seed)
+
+    start_time = time.time()
+    train_MTL_model, _ = model_utils.build_model(hparams)
+    build_seconds = time.time() - start_time
+
+    optimizer_variables = _optimizer_variables(train_MTL_model)
+    optimizer_bytes = sum(
+        v.shape.num_elements() * v.dtype.base_dtype.size
+        for v in optimizer_variables)
+
+    train_MTL_model.initialize_or_restore_session(
+        ckpt_file=None,
+        var_filter_fn=lambda name: "Adam" not in name)
+    train_MTL_model.initialize_data_iterator(model_idx=None)
+
+    # a fixed schedule, such that only the optimizers differ
+    model = _base_model(train_MTL_model)
+    losses = []
+    for step in range(num_steps):
+        loss, _ = model.train(model_idx=step % model.num_models)
+        losses.append(loss)
+
+    return {"BuildSeconds": build_seconds,
+            "NumOptimizerVariables": len(optimizer_variables),
+            "OptimizerBytes": optimizer_bytes,
+            "Losses": np.array(losses)}
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logdir", type=str, required=True)
+    parser.add_argument("--num_steps", type=int, default=500)
+    parser.add_argument("--window", type=int, default=50,
+                        help="window of the moving average of the losses")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="max relative difference of the curves")
+    args = parser.parse_args(arguments)
+
+    results = {}
+    for shared_optimizer in [False, True]:
+        mode = "shared" if shared_optimizer else "per_task"
+        results[mode] = run(
+            run_MTL_args=run_MTL_args,
+            logdir=os.path.join(args.logdir, mode),
+            shared_optimizer=shared_optimizer,
+            num_steps=args.num_steps)
+
+    print("%-10s %12s %12s %14s %12s" % (
+        "Mode", "Build (s)", "OptVars", "OptSize (MB)", "FinalLoss"))
+    for mode in ["per_task", "shared"]:
+        result = results[mode]
+        print("%-10s %12.2f %12d %14.1f %12.4f" % (
+            mode, result["BuildSeconds"],
+            result["NumOptimizerVariables"],
+            result["OptimizerBytes"] / 2. ** 20,
+            _smooth(result["Losses"], args.window)[-1]))
+
+    per_task_curve = _smooth(results["per_task"]["Losses"], args.window)
+    shared_curve = _smooth(results["shared"]["Losses"], args.window)
+    relative_difference = (np.abs(shared_curve - per_task_curve) /
+                           np.maximum(np.abs(per_task_curve), 1e-6))
+    print("Relative difference of the curves: mean %.4f, max %.4f" % (
+        relative_difference.mean(), relative_difference.max()))
+
+    if relative_difference.max() > args.tolerance:
+        print("FAILED: the curves differ by more than %.4f" % args.tolerance)
+        return 1
+
+    print("PASSED")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
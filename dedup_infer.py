@@ -0,0 +1,405 @@
+"""Inference (or evaluation) with deduplicated sentences.
+
+The same sentence often appears many times in a split (e.g. QQP, MNLI,
+QNLI), in either `sequence_1` or `sequence_2`. Here, each unique
+sentence is encoded once into its max-pooled vector, which is kept in
+an LRU cache (optionally spilled to disk when evicted), and the
+`[u, v, |u - v|, u * v]` features and logits of the pairs are then
+computed from the cached vectors.
+
+The pairs are processed in chunks, and only the sentences of a chunk
+that are not cached are encoded, thus the cache size bounds the memory
+and not the number of unique sentences. The vectors are max-pooled
+over the length of each sentence only, so they do not depend on the
+other sentences of the (padded) batch they are encoded in. The model
+max-pools over the zero-padded outputs instead, thus the vectors of
+the sentences that are padded in the batches of `run_MTL.py --infer`
+(the `eval_batch_size` consecutive pairs, unbucketed) are clipped at
+zero, and the logits are the same as those of `--infer`. With
+`--check_infer`, they are compared with the results of `--infer` in
+`[logdir]/results`.
+
+Only `CachedELMO` models are supported, as the representations of the
+sentences are read from the ELMo cache of the split.
+
+Usage (the arguments after `--` are those of the trained model):
+    python dedup_infer.py --max_cached_sentences 100000 \
+        --spill_dir [spill_dir] -- --logdir [logdir] --tasks [tasks] \
+        --model_type [model_type] --stage 1 [--infer] [...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import collections
+import numpy as np
+import tensorflow as tf
+
+import run_MTL
+import serve_MTL
+import model_utils
+import elmo_cache_utils
+from multitask import results_writer
+from multitask import multitask_base_model
+from constants import (MAIN_MODEL_INDEX,
+                       CACHED_ELMO_NUM_ELEMENTS,
+                       CACHED_ELMO_NUM_UNITS)
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+class SentenceVectorCache(object):
+    """LRU cache of sentence vectors, keyed by integers
+
+    When `spill_dir` is given, the evicted vectors are appended to a
+    file on disk (and read back from there), instead of being dropped.
+    """
+
+    def __init__(self, dim, max_items, spill_dir=None):
+        self._dim = dim
+        self._max_items = max_items
+        self._memory = collections.OrderedDict()
+
+        self._spill_file = None
+        self._spill_rows = {}
+        if spill_dir is not None:
+            if not os.path.exists(spill_dir):
+                os.makedirs(spill_dir)
+            self._spill_file = tempfile.TemporaryFile(dir=spill_dir)
+
+        # statistics
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._spill_rows
+
+    def __len__(self):
+        return len(self._memory)
+
+    def get(self, key):
+        if key in self._memory:
+            # move to the end, i.e. most recently used
+            vector = self._memory.pop(key)
+            self._memory[key] = vector
+            self.hits += 1
+            return vector
+
+        if key in self._spill_rows:
+            self._spill_file.seek(self._spill_rows[key] * self._dim * 4)
+            vector = np.frombuffer(
+                self._spill_file.read(self._dim * 4), dtype=np.float32)
+            self.spill_hits += 1
+            self.put(key, vector)
+            return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, key, vector):
+        self._memory[key] = np.asarray(vector, dtype=np.float32)
+        while len(self._memory) > self._max_items:
+            evicted_key, evicted_vector = self._memory.popitem(last=False)
+            if (self._spill_file is not None and
+                    evicted_key not in self._spill_rows):
+                self._spill_file.seek(0, os.SEEK_END)
+                self._spill_file.write(evicted_vector.tobytes())
+                self._spill_rows[evicted_key] = len(self._spill_rows)
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+
+
+class DedupInferenceModel(object):
+    """Sentence encoder and pair classifier of the main task"""
+
+    def __init__(self, hparams, ckpt_file):
+        if hparams.embedding_type != "CachedELMO":
+            raise ValueError("Only `CachedELMO` models are supported")
+
+        main_task = hparams.tasks[MAIN_MODEL_INDEX]
+        num_classes = [
+            len(serve_MTL.read_label_vocab(t.train_data + ".label_vocab"))
+            for t in hparams.tasks]
+        self._dual_stream = (
+            main_task.name not in multitask_base_model.SINGLE_STREAM_TASKS)
+        if hparams.elmo_prereduced:
+            src_shape = [None, None, CACHED_ELMO_NUM_UNITS]
+        else:
+            src_shape = [None, CACHED_ELMO_NUM_ELEMENTS,
+                         None, CACHED_ELMO_NUM_UNITS]
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            (embedding_fns,
+             encoder_fns_1,
+             _,
+             logits_fns,
+             _) = model_utils.base_functions(
+                hparams=hparams,
+                num_classes=num_classes,
+                vocab_size=None,
+                is_training=False)
+
+            # sentence encoder
+            # ------------------------------------------------------
+            self._source = tf.placeholder(tf.float32, src_shape)
+            self._sequence_length = tf.placeholder(tf.int32, [None])
+            outputs, _ = encoder_fns_1[MAIN_MODEL_INDEX](
+                inputs=embedding_fns[MAIN_MODEL_INDEX](self._source),
+                sequence_length=self._sequence_length)
+
+            # max-pooling over the length of each sentence, the
+            # padding of the batches of `--infer` is in `dedup_infer`
+            mask = tf.sequence_mask(
+                self._sequence_length, maxlen=tf.shape(outputs)[1])
+            outputs = tf.where(
+                mask, outputs,
+                tf.fill(tf.shape(outputs), outputs.dtype.min))
+            self._vectors = tf.reduce_max(outputs, axis=1)
+
+            # pair classifier
+            # ------------------------------------------------------
+            vector_shape = self._vectors.shape.as_list()
+            self._u = tf.placeholder(tf.float32, vector_shape)
+            self._v = tf.placeholder(tf.float32, vector_shape)
+            if self._dual_stream:
+                features = tf.concat(
+                    [self._u, self._v,
+                     tf.abs(tf.subtract(self._u, self._v)),
+                     tf.multiply(self._u, self._v)], axis=-1)
+            else:
+                features = self._u
+
+            with tf.variable_scope("Model_%s" % main_task.name):
+                self._logits = logits_fns[MAIN_MODEL_INDEX](features)
+            self._predictions = tf.argmax(self._logits, axis=1)
+
+            # all the variables are restored
+            restored_variables = serve_MTL.checkpoint_variables(ckpt_file)
+            saver = tf.train.Saver(var_list=restored_variables)
+            self._graph.finalize()
+
+        self._sess = tf.Session(graph=self._graph)
+        saver.restore(self._sess, ckpt_file)
+        self._vector_dim = vector_shape[-1]
+
+    @property
+    def dual_stream(self):
+        return self._dual_stream
+
+    @property
+    def vector_dim(self):
+        return self._vector_dim
+
+    def encode(self, representations, lengths, length_axis):
+        """Encode a batch of cached ELMo representations"""
+        max_length = max(lengths)
+        padded = []
+        for representation in representations:
+            paddings = [(0, 0)] * representation.ndim
+            paddings[length_axis] = (
+                0, max_length - representation.shape[length_axis])
+            padded.append(np.pad(
+                representation.astype(np.float32), paddings, "constant"))
+
+        return self._sess.run(self._vectors, {
+            self._source: np.stack(padded),
+            self._sequence_length: lengths})
+
+    def classify(self, u, v=None):
+        feed_dict = {self._u: u}
+        if self._dual_stream:
+            feed_dict[self._v] = v
+        return self._sess.run([self._logits, self._predictions], feed_dict)
+
+
+def _padded_rows(lengths, batch_size):
+    """Whether each row is padded in its batch of `batch_size`
+    consecutive rows, i.e. shorter than the longest row"""
+    num_rows = len(lengths)
+    num_batches = -(-num_rows // batch_size)
+    batch_lengths = np.zeros([num_batches * batch_size], dtype=np.int64)
+    batch_lengths[:num_rows] = lengths
+    max_lengths = np.repeat(
+        batch_lengths.reshape([num_batches, batch_size]).max(axis=1),
+        batch_size)[:num_rows]
+    return np.asarray(lengths) < max_lengths
+
+
+def _pool_as_padded(vectors, padded):
+    # the zeros of the padding, as in the max-pooling of the model
+    return np.where(padded[:, np.newaxis], np.maximum(vectors, 0.), vectors)
+
+
+def _read_lines(fname):
+    with open(fname) as f:
+        return f.read().splitlines()
+
+
+def dedup_infer(hparams, max_cached_sentences, spill_dir=None,
+                chunk_size=4096, encode_batch_size=128, check_infer=False):
+    model = DedupInferenceModel(hparams, serve_MTL.get_ckpt_file(hparams))
+    split_file = hparams.eval_files[MAIN_MODEL_INDEX]
+    stream_files = [split_file + ".sequence_1"]
+    if model.dual_stream:
+        stream_files.append(split_file + ".sequence_2")
+
+    readers = [elmo_cache_utils.open_reader(
+        fname, backend=hparams.elmo_cache_backend,
+        variant=hparams.elmo_cache_variant) for fname in stream_files]
+    stream_lengths = [np.asarray(reader.lengths) for reader in readers]
+    stream_padded = [_padded_rows(lengths, hparams.eval_batch_size)
+                     for lengths in stream_lengths]
+    length_axis = 0 if hparams.elmo_prereduced else 1
+
+    # map each sentence to an id, and each id to the first
+    # (stream, row) it appears in, for reading its representation
+    sentence_ids = {}
+    first_occurrences = []
+    stream_ids = []
+    for stream, fname in enumerate(stream_files):
+        ids = []
+        for row, sentence in enumerate(_read_lines(fname)):
+            if sentence not in sentence_ids:
+                sentence_ids[sentence] = len(first_occurrences)
+                first_occurrences.append((stream, row))
+            ids.append(sentence_ids[sentence])
+        stream_ids.append(np.asarray(ids))
+
+    num_pairs = len(stream_ids[0])
+    tf.logging.info("%d pairs, %d unique sentences out of %d" % (
+        num_pairs, len(first_occurrences), num_pairs * len(stream_files)))
+
+    # targets, when the labels are in the label vocab
+    label_vocab = serve_MTL.read_label_vocab(
+        hparams.train_files[MAIN_MODEL_INDEX] + ".label_vocab")
+    label_ids = dict((label, i) for i, label in enumerate(label_vocab))
+    targets = np.full([num_pairs], -1, dtype=np.int64)
+    if os.path.exists(split_file + ".labels"):
+        targets = np.asarray([label_ids.get(l, -1) for l in
+                              _read_lines(split_file + ".labels")])
+
+    cache = SentenceVectorCache(
+        dim=model.vector_dim,
+        max_items=max_cached_sentences,
+        spill_dir=spill_dir)
+    writer = results_writer.StreamingResultsWriter(
+        os.path.join(hparams.logdir, "dedup_" +
+                     multitask_base_model.RESULTS_DIRNAME))
+
+    num_encoded = 0
+    num_correct = 0
+    start_time = time.time()
+    for start in range(0, num_pairs, chunk_size):
+        end = min(start + chunk_size, num_pairs)
+        chunk_ids = [ids[start: end] for ids in stream_ids]
+
+        # the vectors of this chunk, cached or encoded
+        vectors = {}
+        missing_ids = []
+        for sentence_id in np.unique(np.concatenate(chunk_ids)):
+            vector = cache.get(sentence_id)
+            if vector is None:
+                missing_ids.append(sentence_id)
+            else:
+                vectors[sentence_id] = vector
+
+        # encode the missing sentences, sorted by length to reduce padding
+        missing_ids.sort(key=lambda i: stream_lengths[
+            first_occurrences[i][0]][first_occurrences[i][1]])
+        for batch_start in range(0, len(missing_ids), encode_batch_size):
+            batch_ids = missing_ids[
+                batch_start: batch_start + encode_batch_size]
+            occurrences = [first_occurrences[i] for i in batch_ids]
+            batch_vectors = model.encode(
+                representations=[readers[s][r] for s, r in occurrences],
+                lengths=[stream_lengths[s][r] for s, r in occurrences],
+                length_axis=length_axis)
+
+            for sentence_id, vector in zip(batch_ids, batch_vectors):
+                vectors[sentence_id] = vector
+                cache.put(sentence_id, vector)
+            num_encoded += len(batch_ids)
+
+        u = _pool_as_padded(np.stack([vectors[i] for i in chunk_ids[0]]),
+                            stream_padded[0][start: end])
+        v = (_pool_as_padded(np.stack([vectors[i] for i in chunk_ids[1]]),
+                             stream_padded[1][start: end])
+             if model.dual_stream else None)
+        logits, predictions = model.classify(u, v)
+
+        writer.write(logits=logits,
+                     predictions=predictions,
+                     target=targets[start: end])
+        num_correct += np.sum(predictions == targets[start: end])
+
+    writer.close()
+    cache.close()
+    seconds = time.time() - start_time
+
+    print("Pairs: %d, unique sentences: %d, encoded: %d" % (
+        num_pairs, len(first_occurrences), num_encoded))
+    print("Cache hits: %d (from disk: %d), misses: %d" % (
+        cache.hits, cache.spill_hits, cache.misses))
+    print("Wall time: %.1fs (%.1f pairs/sec)" % (
+        seconds, num_pairs / max(seconds, 1e-6)))
+    if np.all(targets >= 0):
+        print("Accuracy: %.4f" % (num_correct / max(num_pairs, 1)))
+
+    if check_infer:
+        _check_infer_results(
+            os.path.join(hparams.logdir, "dedup_" +
+                         multitask_base_model.RESULTS_DIRNAME),
+            os.path.join(hparams.logdir,
+                         multitask_base_model.RESULTS_DIRNAME))
+
+
+def _check_infer_results(dedup_dir, infer_dir, atol=1e-4):
+    """Compare the logits with those of `run_MTL.py --infer`"""
+    dedup_logits = results_writer.load_results(dedup_dir)["logits"]
+    infer_logits = results_writer.load_results(infer_dir)["logits"]
+    if dedup_logits.shape != infer_logits.shape:
+        raise ValueError("Expected logits of shape %s, found %s in %s" % (
+            infer_logits.shape, dedup_logits.shape, dedup_dir))
+
+    max_difference = (np.max(np.abs(dedup_logits - infer_logits))
+                      if len(infer_logits) else 0.)
+    print("Max logits difference with --infer: %.2e" % max_difference)
+    if max_difference > atol:
+        raise ValueError("The logits differ from those in %s" % infer_dir)
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max_cached_sentences", type=int, default=100000)
+    parser.add_argument("--spill_dir", type=str, default=None)
+    parser.add_argument("--chunk_size", type=int, default=4096)
+    parser.add_argument("--encode_batch_size", type=int, default=128)
+    # compare with the results of `run_MTL.py --infer` (on the same split)
+    parser.add_argument("--check_infer", action="store_true", default=False)
+    args = parser.parse_args(arguments)
+
+    dedup_infer(hparams=run_MTL.get_hparams(run_MTL_args),
+                max_cached_sentences=args.max_cached_sentences,
+                spill_dir=args.spill_dir,
+                chunk_size=args.chunk_size,
+                encode_batch_size=args.encode_batch_size,
+                check_infer=args.check_infer)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,772 @@
+"""Utilities for the cached ELMo representations.
+
+The cached representations are produced by `allennlp elmo --all` and live
+in `<split>.sequence_{1,2}.elmo.hdf5`, one dataset per sentence keyed by
+its row index, plus a `sentence_to_index` JSON string.
+
+This module builds a compact sidecar index next to each HDF5 file:
+
+    <split>.sequence_1.elmo.index.npy
+        int64 array of shape [num_rows, 2], where
+        index[i] = (token offset of row i, sequence length of row i)
+
+The index is memory-mapped on load, so counting the rows of a split no
+longer requires parsing the whole `sentence_to_index` string.
+
+Alternatively, all the representations of a split can be packed into a
+single contiguous ragged array:
+
+    <split>.sequence_1.elmo.packed.json
+        meta data, i.e. number of rows, tokens, elements and units
+    <split>.sequence_1.elmo.packed.index.npy
+        the same format as the sidecar index above
+    <split>.sequence_1.elmo.packed.values
+        raw buffer of all rows, row i is stored as a contiguous
+        [num_elements, length_i, num_units] block starting at
+        element offset_i x num_elements x num_units
+
+which is read back through `np.memmap` with zero-copy slicing, instead
+of one HDF5 dataset lookup per sentence.
+
+When the scalar mix of the ELMo layers is frozen, the layers can be folded
+once into a "reduced" packed store (`<split>.sequence_1.elmo.packed.reduced`
+by default), where each row is a single [length_i, num_units] tensor.
+
+The values of a packed store can be encoded as
+    float32: the original representations
+    float16: half-precision, cast back to float32 in `CachedElmoModule`
+    int8:    per-vector (i.e. per layer and token) affine quantization,
+             stored with float32 scales and zero-points in
+             `<prefix>.scales` and `<prefix>.zero_points`, and
+             dequantized by the reader in the input pipeline
+
+Usage:
+    python elmo_cache_utils.py index --files [split_1.sequence_1] ...
+    python elmo_cache_utils.py pack --files [split_1.sequence_1] ...
+        [--encoding {float32,float16,int8}]
+    python elmo_cache_utils.py reduce --files [split_1.sequence_1] ...
+        [--checkpoint [stage-1 checkpoint]] [--encoding ...]
+    python elmo_cache_utils.py padding --splits [split_1] ...
+        --batch_size [batch_size] --boundaries [boundary_1] ...
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import h5py
+import numpy as np
+
+HDF5_SUFFIX = ".elmo.hdf5"
+INDEX_SUFFIX = ".elmo.index.npy"
+PACKED_SUFFIX = ".elmo.packed"
+
+# backends of the cached representations
+HDF5_BACKEND = "hdf5"
+PACKED_BACKEND = "packed"
+BACKENDS = [HDF5_BACKEND, PACKED_BACKEND]
+
+# encodings of the packed store
+FLOAT32_ENCODING = "float32"
+FLOAT16_ENCODING = "float16"
+INT8_ENCODING = "int8"
+ENCODINGS = [FLOAT32_ENCODING, FLOAT16_ENCODING, INT8_ENCODING]
+_ENCODING_DTYPES = {FLOAT32_ENCODING: np.float32,
+                    FLOAT16_ENCODING: np.float16,
+                    INT8_ENCODING: np.int8}
+_INT8_MIN = -128
+_INT8_MAX = 127
+
+# default variant name of the reduced packed store
+REDUCED_VARIANT = "reduced"
+# name of the layer-mix weight of `modules.CachedElmoModule`
+CACHED_ELMO_WEIGHT_NAME = "cached_elmo/weight"
+
+# columns of the sidecar index
+INDEX_OFFSET_COLUMN = 0
+INDEX_LENGTH_COLUMN = 1
+
+
+def hdf5_file(fname):
+    return fname + HDF5_SUFFIX
+
+
+def index_file(fname):
+    return fname + INDEX_SUFFIX
+
+
+def packed_prefix(fname, variant=None):
+    if variant is None:
+        return fname + PACKED_SUFFIX
+    return fname + PACKED_SUFFIX + "." + variant
+
+
+def default_variant(encoding=FLOAT32_ENCODING, reduced=False):
+    """e.g. `None`, `float16`, `reduced` and `reduced.int8`"""
+    parts = []
+    if reduced:
+        parts.append(REDUCED_VARIANT)
+    if encoding != FLOAT32_ENCODING:
+        parts.append(encoding)
+    return ".".join(parts) if parts else None
+
+
+def _strip_suffix(fname):
+    for suffix in [HDF5_SUFFIX, INDEX_SUFFIX, PACKED_SUFFIX + ".json"]:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+
+def _save_array(array, fname):
+    """Write the array to a temporary file first, so that readers
+    never see a partially written file"""
+    tmp_fname = fname + ".tmp.npy"
+    np.save(tmp_fname, array)
+    os.replace(tmp_fname, fname)
+
+
+def count_rows_from_sentence_to_index(h5py_data):
+    """Legacy way of counting the rows of an ELMo HDF5 file.
+
+    Iterating over `.keys()` and find length or using `len(h5py_data)`
+    in large datasets prohibitative, instead, `sentence_to_index` is
+    much faster to get. But it still requires `eval()` on the whole
+    mapping, which takes seconds on QNLI/QQP, and thus is only used
+    when building the index or when the index is missing.
+    """
+    sentence_to_index = eval(  # "{S1: Index1, S2: Index2,...}"
+        h5py_data.get("sentence_to_index").value[0])
+    # Instead of using `len(sentence_to_index.keys())`
+    # use `max(sentence_to_index.values)` because there
+    # can be duplicate sentences, and thus using `len()`
+    # will lead to smaller `num_elements` than supposed to be.
+    # `+1` because max index + 1 = length
+    return np.max([int(i) for i in sentence_to_index.values()]) + 1
+
+
+def build_index(fname, verbose=True):
+    """Build the sidecar index of `fname.elmo.hdf5`
+
+    Only the dataset shapes are read, not the representations.
+
+    Args:
+        fname: the prefix of the HDF5 file, e.g. `RTE/train.sequence_1`
+
+    Returns:
+        index: int64 array of [num_rows, 2]
+    """
+    with h5py.File(hdf5_file(fname), "r") as h5py_data:
+        num_rows = count_rows_from_sentence_to_index(h5py_data)
+        lengths = np.zeros([num_rows], dtype=np.int64)
+        for i in range(num_rows):
+            # [3, sequence_length, 1024]
+            raw_data = h5py_data.get(str(i))
+            if raw_data is None:
+                # `sentence_to_index` is not guaranteed to give the
+                # correct count when there are duplicate sentences
+                raise ValueError("Row %d of %s is missing, the "
+                                 "`sentence_to_index` might be wrong" %
+                                 (i, hdf5_file(fname)))
+            lengths[i] = raw_data.shape[1]
+
+    index = np.zeros([num_rows, 2], dtype=np.int64)
+    index[1:, INDEX_OFFSET_COLUMN] = np.cumsum(lengths)[:-1]
+    index[:, INDEX_LENGTH_COLUMN] = lengths
+    _save_array(index, index_file(fname))
+
+    if verbose:
+        print("Wrote index of %d rows (%d tokens) to %s" % (
+            num_rows, lengths.sum(), index_file(fname)))
+
+    return index
+
+
+def index_exists(fname):
+    return os.path.exists(index_file(fname))
+
+
+def _load_index_file(index_fname):
+    index = np.load(index_fname, mmap_mode="r")
+    if index.ndim != 2 or index.shape[1] != 2:
+        raise ValueError("Unexpected index shape %s in %s" % (
+            index.shape, index_fname))
+    return index
+
+
+def load_index(fname):
+    """Memory-map the sidecar index of `fname.elmo.hdf5`
+
+    Returns:
+        index: read-only int64 array of [num_rows, 2]
+    """
+    if not index_exists(fname):
+        raise ValueError(
+            "%s does not exist, run `python elmo_cache_utils.py index "
+            "--files %s` first" % (index_file(fname), fname))
+
+    return _load_index_file(index_file(fname))
+
+
+def num_rows(fname):
+    """Number of rows of `fname.elmo.hdf5`, using the index
+    when possible and falling back to `sentence_to_index`"""
+    if index_exists(fname):
+        return load_index(fname).shape[0]
+
+    print("%s not found, falling back to `sentence_to_index`, which "
+          "is slow on large datasets" % index_file(fname))
+    with h5py.File(hdf5_file(fname), "r") as h5py_data:
+        return count_rows_from_sentence_to_index(h5py_data)
+
+
+# ==================================================
+# Readers
+# ==================================================
+
+class HDF5ElmoReader(object):
+    """Reads the representations from `fname.elmo.hdf5`,
+    one HDF5 dataset lookup per sentence"""
+
+    def __init__(self, fname):
+        self._fname = fname
+        self._h5py_data = h5py.File(hdf5_file(fname), "r")
+        self._num_rows = num_rows(fname)
+
+    def __len__(self):
+        return self._num_rows
+
+    def __getitem__(self, i):
+        # [3, sequence_length, 1024]
+        return self._h5py_data.get(str(i)).value
+
+    @property
+    def lengths(self):
+        return load_index(self._fname)[:, INDEX_LENGTH_COLUMN]
+
+    @property
+    def dtype(self):
+        return np.float32
+
+    @property
+    def reduced(self):
+        return False
+
+    @property
+    def encoding(self):
+        return FLOAT32_ENCODING
+
+
+class PackedElmoReader(object):
+    """Reads the representations from the packed store of `fname`,
+    each row is a zero-copy view into the memory-mapped values buffer"""
+
+    def __init__(self, fname, variant=None):
+        prefix = packed_prefix(fname, variant)
+        if not os.path.exists(prefix + ".json"):
+            raise ValueError(
+                "%s does not exist, run `python elmo_cache_utils.py pack "
+                "--files %s` first" % (prefix + ".json", fname))
+
+        with open(prefix + ".json") as f:
+            self._meta = json.load(f)
+
+        self._index = _load_index_file(prefix + ".index.npy")
+        self._reduced = self._meta.get("reduced", False)
+        self._encoding = self._meta.get("encoding", FLOAT32_ENCODING)
+        self._num_elements = self._meta["num_elements"]
+        self._num_units = self._meta["num_units"]
+        self._row_size = self._num_elements * self._num_units
+        self._values = np.memmap(
+            prefix + ".values", mode="r",
+            dtype=np.dtype(self._meta["dtype"]),
+            shape=(self._meta["num_tokens"] * self._row_size,))
+
+        if self._encoding == INT8_ENCODING:
+            # one scale and zero-point per [num_units] vector
+            num_vectors = self._meta["num_tokens"] * self._num_elements
+            self._scales = np.memmap(
+                prefix + ".scales", mode="r",
+                dtype=np.float32, shape=(num_vectors,))
+            self._zero_points = np.memmap(
+                prefix + ".zero_points", mode="r",
+                dtype=np.float32, shape=(num_vectors,))
+
+        if self._index.shape[0] != self._meta["num_rows"]:
+            raise ValueError("Index of %d rows != %d rows in meta data" % (
+                self._index.shape[0], self._meta["num_rows"]))
+
+    def __len__(self):
+        return self._meta["num_rows"]
+
+    def __getitem__(self, i):
+        offset, length = self._index[i]
+        start = offset * self._row_size
+        end = start + length * self._row_size
+        values = self._values[start: end]
+
+        if self._encoding == INT8_ENCODING:
+            vector_start = offset * self._num_elements
+            vector_end = vector_start + length * self._num_elements
+            values = _dequantize_int8(
+                values.reshape([-1, self._num_units]),
+                self._scales[vector_start: vector_end],
+                self._zero_points[vector_start: vector_end])
+
+        if self._reduced:
+            # [sequence_length, 1024]
+            return values.reshape([length, self._num_units])
+        # [3, sequence_length, 1024]
+        return values.reshape([self._num_elements, length, self._num_units])
+
+    @property
+    def lengths(self):
+        return self._index[:, INDEX_LENGTH_COLUMN]
+
+    @property
+    def dtype(self):
+        # int8 is dequantized into float32 by `__getitem__`
+        if self._encoding == INT8_ENCODING:
+            return np.dtype(np.float32)
+        return self._values.dtype
+
+    @property
+    def reduced(self):
+        return self._reduced
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+
+def open_reader(fname, backend=HDF5_BACKEND, variant=None):
+    """Open a reader of the cached representations of `fname`
+
+    Args:
+        fname: the prefix of the cached files, e.g. `RTE/train.sequence_1`
+        backend: one of `BACKENDS`
+        variant: the variant of the packed store, e.g. `reduced`,
+                 only used by the packed backend
+
+    Returns:
+        reader: an object supporting `len(reader)` and `reader[i]`
+    """
+    if backend == HDF5_BACKEND:
+        if variant is not None:
+            raise ValueError("`variant` is only supported by the "
+                             "%s backend" % PACKED_BACKEND)
+        return HDF5ElmoReader(fname)
+
+    if backend == PACKED_BACKEND:
+        return PackedElmoReader(fname, variant=variant)
+
+    raise ValueError("Unknown backend %s, expected one of %s" % (
+        backend, BACKENDS))
+
+
+# ==================================================
+# Converters
+# ==================================================
+
+def _quantize_int8(vectors):
+    """Affine quantization of each row of `vectors`
+
+    Args:
+        vectors: float32 array of [num_vectors, num_units]
+
+    Returns:
+        quantized: int8 array of [num_vectors, num_units]
+        scales: float32 array of [num_vectors]
+        zero_points: float32 array of [num_vectors]
+    """
+    mins = vectors.min(axis=1)
+    maxs = vectors.max(axis=1)
+    scales = (maxs - mins) / float(_INT8_MAX - _INT8_MIN)
+    # constant vectors
+    scales[scales == 0.0] = 1.0
+    zero_points = _INT8_MIN - mins / scales
+
+    quantized = np.round(vectors / scales[:, None] + zero_points[:, None])
+    quantized = np.clip(quantized, _INT8_MIN, _INT8_MAX).astype(np.int8)
+    return (quantized,
+            scales.astype(np.float32),
+            zero_points.astype(np.float32))
+
+
+def _dequantize_int8(quantized, scales, zero_points):
+    return ((quantized.astype(np.float32) - zero_points[:, None]) *
+            scales[:, None])
+
+
+def _write_packed_store(prefix, rows, lengths, num_elements, num_units,
+                        encoding=FLOAT32_ENCODING, reduced=False,
+                        verbose=True):
+    """Write the rows into a packed store
+
+    Args:
+        prefix: the prefix of the packed files
+        rows: iterable of arrays of [num_elements, length_i, num_units],
+              or [length_i, num_units] when `reduced` is True
+        lengths: int64 array of [num_rows]
+        encoding: one of `ENCODINGS`
+        reduced: whether the layers have been folded, in which
+                 case `num_elements` must be 1
+    """
+    if reduced and num_elements != 1:
+        raise ValueError("Reduced store must have `num_elements` = 1")
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding %s, expected one of %s" % (
+            encoding, ENCODINGS))
+    dtype = _ENCODING_DTYPES[encoding]
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_rows = lengths.shape[0]
+    num_tokens = int(lengths.sum())
+    row_size = num_elements * num_units
+
+    index = np.zeros([num_rows, 2], dtype=np.int64)
+    index[1:, INDEX_OFFSET_COLUMN] = np.cumsum(lengths)[:-1]
+    index[:, INDEX_LENGTH_COLUMN] = lengths
+
+    tmp_values_fname = prefix + ".values.tmp"
+    values = np.memmap(tmp_values_fname, mode="w+", dtype=dtype,
+                       shape=(max(num_tokens * row_size, 1),))
+    if encoding == INT8_ENCODING:
+        num_vectors = max(num_tokens * num_elements, 1)
+        scales = np.memmap(prefix + ".scales.tmp", mode="w+",
+                           dtype=np.float32, shape=(num_vectors,))
+        zero_points = np.memmap(prefix + ".zero_points.tmp", mode="w+",
+                                dtype=np.float32, shape=(num_vectors,))
+
+    for i, row in enumerate(rows):
+        expected_shape = (
+            (lengths[i], num_units) if reduced
+            else (num_elements, lengths[i], num_units))
+        if row.shape != expected_shape:
+            raise ValueError("Row %d has shape %s, expected %s" % (
+                i, row.shape, expected_shape))
+
+        start = index[i, INDEX_OFFSET_COLUMN] * row_size
+        end = start + lengths[i] * row_size
+        if encoding == INT8_ENCODING:
+            vector_start = index[i, INDEX_OFFSET_COLUMN] * num_elements
+            vector_end = vector_start + lengths[i] * num_elements
+            (quantized,
+             row_scales,
+             row_zero_points) = _quantize_int8(
+                row.reshape([-1, num_units]).astype(np.float32))
+            values[start: end] = quantized.reshape([-1])
+            scales[vector_start: vector_end] = row_scales
+            zero_points[vector_start: vector_end] = row_zero_points
+        else:
+            values[start: end] = row.reshape([-1]).astype(dtype)
+
+    values.flush()
+    del values
+    os.replace(tmp_values_fname, prefix + ".values")
+    if encoding == INT8_ENCODING:
+        for array, suffix in [(scales, ".scales"),
+                              (zero_points, ".zero_points")]:
+            array.flush()
+            os.replace(prefix + suffix + ".tmp", prefix + suffix)
+        del scales, zero_points
+    _save_array(index, prefix + ".index.npy")
+
+    meta = {"num_rows": num_rows,
+            "num_tokens": num_tokens,
+            "num_elements": num_elements,
+            "num_units": num_units,
+            "dtype": np.dtype(dtype).name,
+            "encoding": encoding,
+            "reduced": reduced}
+    with open(prefix + ".json", "w") as f:
+        json.dump(meta, f)
+
+    if verbose:
+        print("Wrote %d rows (%d tokens) to %s" % (
+            num_rows, num_tokens, prefix + ".values"))
+
+    return meta
+
+
+def pack(fname, encoding=FLOAT32_ENCODING, variant=None, verbose=True):
+    """Pack `fname.elmo.hdf5` into a single contiguous ragged array
+
+    Args:
+        fname: the prefix of the HDF5 file, e.g. `RTE/train.sequence_1`
+        encoding: one of `ENCODINGS`
+        variant: the variant name of the packed store, defaults
+                 to `default_variant(encoding)`
+    """
+    if variant is None:
+        variant = default_variant(encoding)
+
+    if not index_exists(fname):
+        build_index(fname, verbose=verbose)
+
+    reader = HDF5ElmoReader(fname)
+    lengths = np.array(reader.lengths)
+    if len(reader) == 0:
+        raise ValueError("%s is empty" % hdf5_file(fname))
+
+    num_elements, _, num_units = reader[0].shape
+    return _write_packed_store(
+        prefix=packed_prefix(fname, variant),
+        rows=(reader[i] for i in range(len(reader))),
+        lengths=lengths,
+        num_elements=num_elements,
+        num_units=num_units,
+        encoding=encoding,
+        verbose=verbose)
+
+
+def load_layer_weights(checkpoint=None,
+                       weight_name=CACHED_ELMO_WEIGHT_NAME,
+                       num_elements=3):
+    """Load the frozen layer-mix weights
+
+    Args:
+        checkpoint: checkpoint of a trained model (e.g. from stage-1),
+                    when None, the layers are averaged uniformly
+        weight_name: name of the `[1, num_elements, 1, 1]` weight
+                     of `modules.CachedElmoModule`
+
+    Returns:
+        weights: float32 array of [num_elements]
+    """
+    if checkpoint is None:
+        return np.full([num_elements], 1.0 / num_elements, dtype=np.float32)
+
+    # only needed when reading from a checkpoint
+    import tensorflow as tf
+    weights = tf.train.load_variable(checkpoint, weight_name)
+    return np.reshape(weights, [-1]).astype(np.float32)
+
+
+def reduce_layers(fname, weights, backend=HDF5_BACKEND,
+                  encoding=FLOAT32_ENCODING, variant=None, verbose=True):
+    """Fold the ELMo layers of `fname` with frozen weights, and write
+    the results into a reduced packed store, which is the same as
+    `tf.reduce_sum(inputs * weight, axis=1)` in `CachedElmoModule`"""
+    if variant is None:
+        variant = default_variant(encoding, reduced=True)
+
+    reader = open_reader(fname, backend=backend)
+    if reader.reduced:
+        raise ValueError("%s is already reduced" % fname)
+    if not index_exists(fname):
+        build_index(fname, verbose=verbose)
+
+    if len(reader) == 0:
+        raise ValueError("%s is empty" % fname)
+
+    num_elements, _, num_units = reader[0].shape
+    weights = np.asarray(weights, dtype=np.float32)
+    if weights.shape != (num_elements,):
+        raise ValueError("`weights` of shape %s, expected %s" % (
+            weights.shape, (num_elements,)))
+
+    if verbose:
+        print("Reducing %s with weights %s" % (fname, weights))
+
+    return _write_packed_store(
+        prefix=packed_prefix(fname, variant),
+        # [num_elements] x [num_elements, length, num_units]
+        rows=(np.tensordot(weights, reader[i], axes=1)
+              for i in range(len(reader))),
+        lengths=np.array(load_index(fname)[:, INDEX_LENGTH_COLUMN]),
+        num_elements=1,
+        num_units=num_units,
+        encoding=encoding,
+        reduced=True,
+        verbose=verbose)
+
+
+# ==================================================
+# Length Bucketing
+# ==================================================
+
+def bucketed_order(lengths, batch_size, boundaries, random_state=None):
+    """Order the rows such that every consecutive `batch_size` rows
+    (i.e. every batch) fall into the same length bucket.
+
+    Full batches of each bucket come first, then the leftover rows of
+    all buckets are sorted by length and batched together, so that the
+    batch boundaries stay aligned and only the last batch is partial.
+
+    Args:
+        lengths: int array of [num_rows], the bucketing key of each row
+        batch_size: Integer
+        boundaries: increasing list of bucket boundaries, a row of
+                    length L goes to bucket `sum(L >= boundaries)`
+        random_state: `np.random.RandomState` used to shuffle the rows
+                      within the buckets and the order of the batches,
+                      set to None to keep the order deterministic
+
+    Returns:
+        order: int64 array of [num_rows], a permutation of the rows
+    """
+    lengths = np.asarray(lengths)
+    bucket_ids = np.digitize(lengths, boundaries)
+
+    batches = []
+    leftovers = []
+    for bucket_id in np.unique(bucket_ids):
+        rows = np.where(bucket_ids == bucket_id)[0]
+        if random_state is not None:
+            rows = random_state.permutation(rows)
+
+        num_full_rows = (len(rows) // batch_size) * batch_size
+        if num_full_rows:
+            batches.extend(np.split(rows[:num_full_rows],
+                                    num_full_rows // batch_size))
+        leftovers.append(rows[num_full_rows:])
+
+    leftovers = np.concatenate(leftovers)
+    # stable sort keeps the (possibly shuffled) order within lengths
+    leftovers = leftovers[np.argsort(lengths[leftovers], kind="mergesort")]
+    num_full_rows = (len(leftovers) // batch_size) * batch_size
+    if num_full_rows:
+        batches.extend(np.split(leftovers[:num_full_rows],
+                                num_full_rows // batch_size))
+
+    if random_state is not None:
+        batches = [batches[i] for i in random_state.permutation(len(batches))]
+
+    # the partial batch, if any, always comes last
+    batches.append(leftovers[num_full_rows:])
+    return np.concatenate(batches).astype(np.int64)
+
+
+def padding_efficiency(lengths_1, lengths_2, order, batch_size):
+    """Fraction of the padded tokens that are real tokens, when both
+    sequences are padded to their longest sequence in the batch"""
+    lengths_1 = np.asarray(lengths_1)[order]
+    lengths_2 = np.asarray(lengths_2)[order]
+
+    num_tokens = 0
+    num_padded_tokens = 0
+    for start in range(0, len(order), batch_size):
+        batch_lengths_1 = lengths_1[start: start + batch_size]
+        batch_lengths_2 = lengths_2[start: start + batch_size]
+        num_tokens += batch_lengths_1.sum() + batch_lengths_2.sum()
+        num_padded_tokens += len(batch_lengths_1) * (
+            batch_lengths_1.max() + batch_lengths_2.max())
+
+    return num_tokens / float(max(num_padded_tokens, 1))
+
+
+def padding_report(lengths_1, lengths_2, batch_size,
+                   boundaries, random_seed=None):
+    """Padding efficiency of randomly shuffled versus bucketed batches
+
+    Returns:
+        shuffled_efficiency, bucketed_efficiency
+    """
+    random_state = np.random.RandomState(random_seed)
+    keys = np.maximum(lengths_1, lengths_2)
+    shuffled_efficiency = padding_efficiency(
+        lengths_1, lengths_2,
+        order=random_state.permutation(len(keys)),
+        batch_size=batch_size)
+    bucketed_efficiency = padding_efficiency(
+        lengths_1, lengths_2,
+        order=bucketed_order(keys, batch_size, boundaries, random_state),
+        batch_size=batch_size)
+
+    return shuffled_efficiency, bucketed_efficiency
+
+
+# ==================================================
+# Command Line Interface
+# ==================================================
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    index_parser = subparsers.add_parser(
+        "index", help="build the sidecar row index of ELMo HDF5 files")
+    index_parser.add_argument(
+        "--files", nargs="+", required=True,
+        help="prefixes (or paths) of the `.elmo.hdf5` files")
+
+    pack_parser = subparsers.add_parser(
+        "pack", help="pack ELMo HDF5 files into contiguous ragged arrays")
+    pack_parser.add_argument(
+        "--files", nargs="+", required=True,
+        help="prefixes (or paths) of the `.elmo.hdf5` files")
+    pack_parser.add_argument(
+        "--encoding", type=str, default=FLOAT32_ENCODING, choices=ENCODINGS)
+    pack_parser.add_argument(
+        "--variant", type=str, default=None)
+
+    reduce_parser = subparsers.add_parser(
+        "reduce", help="fold the ELMo layers with frozen mixing weights")
+    reduce_parser.add_argument(
+        "--files", nargs="+", required=True,
+        help="prefixes (or paths) of the `.elmo.hdf5` files")
+    reduce_parser.add_argument(
+        "--checkpoint", type=str, default=None,
+        help="checkpoint to read the weights from, uniform if not set")
+    reduce_parser.add_argument(
+        "--weight_name", type=str, default=CACHED_ELMO_WEIGHT_NAME)
+    reduce_parser.add_argument(
+        "--backend", type=str, default=HDF5_BACKEND, choices=BACKENDS,
+        help="which store to read the unreduced representations from")
+    reduce_parser.add_argument(
+        "--encoding", type=str, default=FLOAT32_ENCODING, choices=ENCODINGS)
+    reduce_parser.add_argument(
+        "--variant", type=str, default=None)
+
+    padding_parser = subparsers.add_parser(
+        "padding", help="report the padding efficiency of bucketing")
+    padding_parser.add_argument(
+        "--splits", nargs="+", required=True,
+        help="prefixes of the splits, e.g. RTE/train")
+    padding_parser.add_argument(
+        "--batch_size", type=int, required=True)
+    padding_parser.add_argument(
+        "--boundaries", type=int, nargs="+", required=True)
+
+    args = parser.parse_args(arguments)
+
+    if args.command == "index":
+        for fname in args.files:
+            build_index(_strip_suffix(fname))
+
+    elif args.command == "pack":
+        for fname in args.files:
+            pack(_strip_suffix(fname), encoding=args.encoding,
+                 variant=args.variant)
+
+    elif args.command == "reduce":
+        weights = load_layer_weights(
+            checkpoint=args.checkpoint, weight_name=args.weight_name)
+        for fname in args.files:
+            reduce_layers(_strip_suffix(fname), weights,
+                          backend=args.backend, encoding=args.encoding,
+                          variant=args.variant)
+
+    elif args.command == "padding":
+        print("%-40s %10s %10s" % ("Split", "Shuffled", "Bucketed"))
+        for split in args.splits:
+            shuffled_efficiency, bucketed_efficiency = padding_report(
+                lengths_1=load_index(split + ".sequence_1")[
+                    :, INDEX_LENGTH_COLUMN],
+                lengths_2=load_index(split + ".sequence_2")[
+                    :, INDEX_LENGTH_COLUMN],
+                batch_size=args.batch_size,
+                boundaries=args.boundaries)
+            print("%-40s %10.3f %10.3f" % (
+                split[-40:], shuffled_efficiency, bucketed_efficiency))
+
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
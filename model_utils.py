@@ -3,7 +3,6 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
-import h5py
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import lookup_ops
@@ -13,10 +12,13 @@ from data_utils import vocab_utils
 from data_utils import iterator_utils_3
 from utils import merge_vocabs
 import modules
+import elmo_cache_utils
 from multitask import modules
 
 from multitask import multitask_models
+from multitask.checkpoint_writer import AsyncCheckpointWriter
 from constants import (MAIN_MODEL_INDEX,
+                       MAX_CHECKPOINTS_TO_KEEP,
                        NUM_TASKS,
                        TRANSFORMER_NUM_HEADS,
                        CACHED_ELMO_NUM_ELEMENTS,
@@ -46,7 +48,13 @@ def _merge_vocabs(hparams):
 
 def _build_data(train_file, val_file, src_vocab_file,
                 train_batch_size, val_batch_size,
-                train_graph, val_graph, random_seed):
+                train_graph, val_graph, random_seed,
+                cache_backend=elmo_cache_utils.HDF5_BACKEND,
+                cache_variant=None,
+                prereduced=False,
+                bucket_boundaries=None,
+                bucket_val=True,
+                num_shards=None):
     
     # iterator_utils_2 return ELMO embeddings
     iterator_builder = (
@@ -74,58 +82,169 @@ def _build_data(train_file, val_file, src_vocab_file,
     tf.logging.info("label_vocab_size = %d from %s" % (
         label_vocab_size, tgt_vocab_file))
 
-    def _data_generator(fname):
-        h5py_data = h5py.File(fname + ".elmo.hdf5", "r")
-        # Iterating over `.keys()` and find length or
-        # using `len(h5py_data)` in large datasets
-        # prohibitative, instead, `sentence_to_index`
-        # is much faster to get. We can also use
-        # while-loop, and break when output is None.
-        # Speed: When dataset is small (e.g. RTE/MRPC)
-        # using `len()` is roughly 10-20X faster than my
-        # approach (40ms vs. 2ms). When dataset is large (e.g. QNLI)
-        # my approach takes 500ms versus 2min for `len()`.
-        sentence_to_index = eval(  # "{S1: Index1, S2: Index2,...}"
-            h5py_data.get("sentence_to_index").value[0])
-        # Instead of using `len(sentence_to_index.keys())`
-        # use `max(sentence_to_index.values)` because there
-        # can be duplicate sentences, and thus using `len()`
-        # will lead to smaller `num_elements` than supposed to be.
-        # `+1` because max index + 1 = length
-        # Note that this might also lead to incorrect count
-        # because in duplicate settings, we cannot guarantee
-        # that `max(sentence_to_index.values)` will return
-        # the correct length when the multiple sentences
-        # are duplicate form of the sentence at the max index.
-        # But this might not be a problem here because the max index
-        # is usually inserted at the end, and thus will not be
-        # overriden. Some tests will be used to verify this
-        num_elements = np.max([int(i) for i in sentence_to_index.values()]) + 1
-
-        def _callable_generator():
-            for i in range(num_elements):
-                # [3, sequence_length, 1024]
-                raw_data = h5py_data.get(str(i))
-                raw_data = raw_data.value
-                yield raw_data
+    # each split is read by `num_shards` parallel readers
+    if num_shards is None:
+        num_shards = DATA_NUM_PARALLEL_CALLS or 1
+
+    # pre-reduced representations are [sequence_length, 1024]
+    # instead of [3, sequence_length, 1024]
+    if prereduced:
+        src_len_axis = 0
+        src_shape = [None, CACHED_ELMO_NUM_UNITS]
+    else:
+        src_len_axis = 1
+        src_shape = [CACHED_ELMO_NUM_ELEMENTS, None, CACHED_ELMO_NUM_UNITS]
+
+    def _elmo_reader(fname):
+        # `HDF5ElmoReader` reads one HDF5 dataset per sentence,
+        # while `PackedElmoReader` slices a memory-mapped buffer.
+        # The number of elements comes from the sidecar index,
+        # instead of parsing `sentence_to_index` with `eval()`
+        reader = elmo_cache_utils.open_reader(
+            fname, backend=cache_backend, variant=cache_variant)
+        if reader.reduced != prereduced:
+            raise ValueError("%s: reader.reduced = %s but "
+                             "prereduced = %s" % (
+                                 fname, reader.reduced, prereduced))
+        return reader
+
+    def _read_labels(fname):
+        with open(fname) as f:
+            return f.read().splitlines()
+
+    def _order_fn_builder(num_rows, keys, batch_size, shuffle):
+        """Returns a function that builds an `order_fn`, which returns
+        the order of the next epoch when called. Since the order only
+        depends on the random seed and the epoch, each stream (and each
+        shard of the streams) can have its own `order_fn` and they will
+        always agree with each other."""
+        def _build_order_fn():
+            epoch = [0]
+
+            def _order_fn():
+                if keys is None:
+                    return np.arange(num_rows)
+
+                random_state = np.random.RandomState(
+                    # evaluation always uses the same order
+                    [random_seed or 0, epoch[0] if shuffle else 0])
+                epoch[0] += 1
+                return elmo_cache_utils.bucketed_order(
+                    keys, batch_size=batch_size,
+                    boundaries=bucket_boundaries,
+                    random_state=random_state)
+
+            return _order_fn
+        return _build_order_fn
+
+    def _sharded_generator(rows_builder, order_fn_builder, block_length):
+        """Shard `k` yields the blocks `k, k + num_shards, ...` of the
+        epoch order, such that interleaving the shards deterministically
+        with the same `block_length` gives back the epoch order. Each
+        shard opens its own reader, so that they can read in parallel."""
+        shard_states = {}
+
+        def _callable_generator(shard):
+            shard = int(shard)
+            # `_callable_generator` is called once per shard per epoch
+            if shard not in shard_states:
+                shard_states[shard] = (rows_builder(), order_fn_builder())
+            rows, order_fn = shard_states[shard]
+
+            order = order_fn()
+            for start in range(shard * block_length, len(order),
+                               num_shards * block_length):
+                for i in order[start: start + block_length]:
+                    # [3, sequence_length, 1024]
+                    yield rows[i]
+
         return _callable_generator
 
+    def _sharded_dataset(rows_builder, order_fn_builder,
+                         block_length, output_types, output_shapes):
+        generator = _sharded_generator(
+            rows_builder, order_fn_builder, block_length)
+        if num_shards == 1:
+            return tf.data.Dataset.from_generator(
+                lambda: generator(0),
+                output_types=output_types,
+                output_shapes=output_shapes)
+
+        # `sloppy=False` makes the interleaving deterministic
+        return tf.data.Dataset.range(num_shards).apply(
+            tf.contrib.data.parallel_interleave(
+                lambda shard: tf.data.Dataset.from_generator(
+                    generator,
+                    output_types=output_types,
+                    output_shapes=output_shapes,
+                    args=(shard,)),
+                cycle_length=num_shards,
+                block_length=block_length,
+                sloppy=False))
+
+    def _build_split(split_file, batch_size, shuffle, use_buckets):
+        """Returns the datasets of sequence_1, sequence_2 and labels,
+        and whether the iterator should shuffle the examples"""
+        reader_1 = _elmo_reader(split_file + ".sequence_1")
+        reader_2 = _elmo_reader(split_file + ".sequence_2")
+
+        keys = None
+        if use_buckets:
+            keys = np.maximum(reader_1.lengths, reader_2.lengths)
+            tf.logging.info(
+                "padding efficiency of %s: %.3f (shuffled) -> "
+                "%.3f (bucketed)" % ((split_file,) +
+                                     elmo_cache_utils.padding_report(
+                    lengths_1=reader_1.lengths,
+                    lengths_2=reader_2.lengths,
+                    batch_size=batch_size,
+                    boundaries=bucket_boundaries,
+                    random_seed=random_seed)))
+
+        order_fn_builder = _order_fn_builder(
+            num_rows=len(reader_1), keys=keys,
+            batch_size=batch_size, shuffle=shuffle)
+
+        src_datasets = [
+            _sharded_dataset(
+                rows_builder=lambda fname=fname: _elmo_reader(fname),
+                order_fn_builder=order_fn_builder,
+                block_length=batch_size,
+                output_types=tf.as_dtype(reader.dtype),
+                output_shapes=tf.TensorShape(src_shape))
+            for fname, reader in [(split_file + ".sequence_1", reader_1),
+                                  (split_file + ".sequence_2", reader_2)]]
+
+        if num_shards == 1 and not use_buckets:
+            tgt_dataset = tf.data.TextLineDataset(split_file + ".labels")
+        else:
+            tgt_dataset = _sharded_dataset(
+                rows_builder=lambda: _read_labels(split_file + ".labels"),
+                order_fn_builder=order_fn_builder,
+                block_length=batch_size,
+                output_types=tf.string,
+                output_shapes=tf.TensorShape([]))
+
+        # the examples are already shuffled within buckets,
+        # and shuffling them again will break the buckets
+        return (src_datasets[0],
+                src_datasets[1],
+                tgt_dataset,
+                shuffle and not use_buckets)
+
     # train dataset
     with train_graph.as_default():
         # no UNKs in target labels
         tgt_vocab_table = lookup_ops.index_table_from_file(tgt_vocab_file)
 
-        train_src_1 = tf.data.Dataset.from_generator(
-            _data_generator(train_file + ".sequence_1"),
-            output_types=tf.float32,
-            output_shapes=tf.TensorShape(
-                [CACHED_ELMO_NUM_ELEMENTS, None, CACHED_ELMO_NUM_UNITS]))
-        train_src_2 = tf.data.Dataset.from_generator(
-            _data_generator(train_file + ".sequence_2"),
-            output_types=tf.float32,
-            output_shapes=tf.TensorShape(
-                [CACHED_ELMO_NUM_ELEMENTS, None, CACHED_ELMO_NUM_UNITS]))
-        train_tgt = tf.data.TextLineDataset(train_file + ".labels")
+        (train_src_1,
+         train_src_2,
+         train_tgt,
+         train_shuffle) = _build_split(
+            split_file=train_file,
+            batch_size=train_batch_size,
+            shuffle=True,
+            use_buckets=bucket_boundaries is not None)
         train_batch = iterator_builder(
             src_dataset_1=train_src_1,
             src_dataset_2=train_src_2,
@@ -133,29 +252,29 @@ def _build_data(train_file, val_file, src_vocab_file,
             tgt_vocab_table=tgt_vocab_table,
             batch_size=train_batch_size,
             random_seed=random_seed,
-            src_len_axis=1,
+            src_len_axis=src_len_axis,
             num_parallel_calls=DATA_NUM_PARALLEL_CALLS,
             output_buffer_size=train_batch_size * DATA_BUFFER_MULTIPLIER,
-            shuffle=True,
+            shuffle=train_shuffle,
             repeat=True)
 
     # val dataset
     with val_graph.as_default():
         # since these are graph-specific, we build them twice
+        # unless the val dataset lives in the train graph
         # no UNKs in target labels
-        tgt_vocab_table = lookup_ops.index_table_from_file(tgt_vocab_file)
-
-        val_src_1 = tf.data.Dataset.from_generator(
-            _data_generator(val_file + ".sequence_1"),
-            output_types=tf.float32,
-            output_shapes=tf.TensorShape(
-                [CACHED_ELMO_NUM_ELEMENTS, None, CACHED_ELMO_NUM_UNITS]))
-        val_src_2 = tf.data.Dataset.from_generator(
-            _data_generator(val_file + ".sequence_2"),
-            output_types=tf.float32,
-            output_shapes=tf.TensorShape(
-                [CACHED_ELMO_NUM_ELEMENTS, None, CACHED_ELMO_NUM_UNITS]))
-        val_tgt = tf.data.TextLineDataset(val_file + ".labels")
+        if val_graph is not train_graph:
+            tgt_vocab_table = lookup_ops.index_table_from_file(
+                tgt_vocab_file)
+
+        (val_src_1,
+         val_src_2,
+         val_tgt,
+         val_shuffle) = _build_split(
+            split_file=val_file,
+            batch_size=val_batch_size,
+            shuffle=False,
+            use_buckets=bucket_boundaries is not None and bucket_val)
         val_batch = iterator_builder(
             src_dataset_1=val_src_1,
             src_dataset_2=val_src_2,
@@ -163,10 +282,10 @@ def _build_data(train_file, val_file, src_vocab_file,
             tgt_vocab_table=tgt_vocab_table,
             batch_size=val_batch_size,
             random_seed=random_seed,
-            src_len_axis=1,
+            src_len_axis=src_len_axis,
             num_parallel_calls=DATA_NUM_PARALLEL_CALLS,
             output_buffer_size=val_batch_size * DATA_BUFFER_MULTIPLIER,
-            shuffle=False,
+            shuffle=val_shuffle,
             repeat=False)
 
     return train_batch, val_batch, token_vocab_size, label_vocab_size
@@ -179,12 +298,17 @@ def _build_model(hparams,
                  # misc
                  graph,
                  is_training,
-                 debug_mode=False):
+                 debug_mode=False,
+                 eval_data_batches=None,
+                 checkpoint_writer=None,
+                 session_config=None):
 
     # ModelTypes
     # -----------------------------------
     additional_kwargs = {}
     wrapper_kwargs = {}
+    # e.g. no wrapper with fixed mixing ratios
+    ModelWrapper = None
 
 
     # determine the base type of the model
@@ -194,14 +318,26 @@ def _build_model(hparams,
     elif hparams.multitask_model_type == "Hard":
         ModelCreator = multitask_models.MultitaskHardSharingModel
 
-    # determine the auto-parts
-    if hparams.auto_model_type == "AutoMR":
+    # determine the auto-parts, `AutoMR` or `AutoMR-[selector_type]`
+    if (hparams.auto_model_type is not None and
+            hparams.auto_model_type.split("-")[0] == "AutoMR"):
         ModelWrapper = multitask_models.MTLAutoMRModel
         wrapper_kwargs = {
+            "selector_type": (
+                hparams.auto_model_type.split("-", 1)[1]
+                if "-" in hparams.auto_model_type
+                else multitask_models.DEFAULT_SELECTOR),
             "initial_weight": 100.0,
             "update_rate": hparams.automr_update_rate,
             "reward_scale": hparams.automr_reward_scale,
-            "temperature_anneal_rate": None}
+            "temperature_anneal_rate": None,
+            "block_samples": hparams.automr_block_samples,
+            # the selector is updated every `automr_proxy_steps`
+            # steps with the proxy reward
+            "block_length": (
+                hparams.automr_proxy_steps
+                if hparams.automr_proxy_eval_size is not None
+                else hparams.steps_per_eval)}
 
     print(misc_utils.bcolors.WARNING +
           "Using Model %s" % (ModelCreator.__base__) +
@@ -234,30 +370,48 @@ def _build_model(hparams,
         optimizer="Adam",
         learning_rate=hparams.learning_rate,
         gradient_clipping_norm=2.0,
+        shared_optimizer=hparams.shared_optimizer,
+        fuse_dual_stream=hparams.fuse_dual_stream,
+        mixed_batch_size=(
+            hparams.train_batch_size
+            if (hparams.training_strategy == "Mixed" and
+                is_training) else None),
         # misc
         graph=graph,
         logdir=hparams.logdir,
         main_model_index=MAIN_MODEL_INDEX,
         debug_mode=debug_mode,
+        eval_data=eval_data_batches,
+        checkpoint_writer=checkpoint_writer,
+        session_config=session_config,
+        random_seed=hparams.numpy_seed,
+        proxy_eval=(hparams.automr_proxy_eval_size is not None and
+                    eval_data_batches is not None),
         # additional args
         **additional_kwargs)
 
-    model = ModelWrapper(
-        model=model,
-        **wrapper_kwargs)
+    if ModelWrapper is not None:
+        model = ModelWrapper(
+            model=model,
+            **wrapper_kwargs)
 
     model.build()
     return model
 
 
-def build_model(hparams, debug_mode=False):
+def build_model(hparams, debug_mode=False, session_config=None):
     # build the data
     train_batches = []
     val_batches = []
     token_vocab_sizes = []
     label_vocab_sizes = []
     train_graph = tf.Graph()
-    val_graph = tf.Graph()
+    # `tf.set_random_seed` only applies to the default graph
+    train_graph.seed = hparams.tensorflow_seed
+    # with `shared_eval`, the val data and the evaluation
+    # sub-graph are built in the train graph, and share
+    # the variables with the training models
+    val_graph = train_graph if hparams.shared_eval else tf.Graph()
 
     merged_src_vocab_file = _merge_vocabs(hparams)
     hparams.merged_src_vocab_file = merged_src_vocab_file
@@ -275,7 +429,14 @@ def build_model(hparams, debug_mode=False):
             val_batch_size=hparams.eval_batch_size,
             train_graph=train_graph,
             val_graph=val_graph,
-            random_seed=hparams.tensorflow_seed)
+            random_seed=hparams.tensorflow_seed,
+            cache_backend=hparams.elmo_cache_backend,
+            cache_variant=hparams.elmo_cache_variant,
+            prereduced=hparams.elmo_prereduced,
+            bucket_boundaries=hparams.bucket_boundaries,
+            # keep the order of the test set during inference
+            bucket_val=not hparams.infer,
+            num_shards=hparams.data_num_shards)
 
         train_batches.append(train_batch)
         val_batches.append(val_batch)
@@ -295,7 +456,17 @@ def build_model(hparams, debug_mode=False):
         vocab_size=token_vocab_size,
         graph=train_graph,
         is_training=True,
-        debug_mode=debug_mode)
+        debug_mode=debug_mode,
+        eval_data_batches=(
+            val_batches if hparams.shared_eval else None),
+        checkpoint_writer=(
+            AsyncCheckpointWriter(max_to_keep=MAX_CHECKPOINTS_TO_KEEP)
+            if hparams.async_ckpt else None),
+        session_config=session_config)
+
+    if hparams.shared_eval:
+        val_MTL_model = multitask_models.SharedEvalModel(train_MTL_model)
+        return train_MTL_model, val_MTL_model
 
     val_MTL_model = _build_model(
         hparams=hparams,
@@ -304,7 +475,8 @@ def build_model(hparams, debug_mode=False):
         vocab_size=token_vocab_size,
         graph=val_graph,
         is_training=False,
-        debug_mode=debug_mode)
+        debug_mode=debug_mode,
+        session_config=session_config)
 
     return train_MTL_model, val_MTL_model
 
@@ -330,7 +502,10 @@ def base_functions(hparams,
     if hparams.embedding_type == "CachedELMO":
         # The data is the computed ELMO representations
         # so no need for extra embedding function
-        embedding_fn = modules.CachedElmoModule()
+        # When `elmo_prereduced` is set, the layers have been
+        # folded offline and the module becomes a pass-through
+        embedding_fn = modules.CachedElmoModule(
+            pre_reduced=hparams.elmo_prereduced)
 
     if hparams.embedding_type == "ELMO":
         embedding_fn = modules.TFHubElmoEmbedding()
@@ -346,7 +521,7 @@ def base_functions(hparams,
     if hparams.base_model_type == "LSTM":
         encoder_fns_1 = encoder_fns_2 = [
             modules.LstmEncoder(
-                unit_type="lstm",
+                unit_type=hparams.lstm_unit_type,
                 num_units=hparams.num_units,
                 num_layers=hparams.num_layers,
                 dropout_rate=hparams.dropout_rate,
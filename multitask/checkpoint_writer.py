@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import atexit
+import threading
+import collections
+import tensorflow as tf
+from six.moves import queue
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints on a background thread
+
+    The variables are snapshotted into host memory on the calling
+    thread, and then serialized by a worker thread, which loads them
+    into a shadow graph (one per set of variables, shared by all the
+    checkpoint prefixes, e.g. the candidates of successive halving) and
+    saves them with a regular `tf.train.Saver`, thus the checkpoints can
+    be restored as usual. Besides checkpoints, arbitrary callables (e.g. saving the
+    selector or the training manager) can be submitted as well, and
+    they are executed in order.
+
+    The queue is bounded, so the training loop blocks (back-pressure)
+    when the worker falls behind. Pending writes are flushed by `close`,
+    which is also registered to run at exit.
+    """
+
+    def __init__(self, max_queue_size=2, max_to_keep=None):
+        self._max_to_keep = max_to_keep
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # signature --> (session, saver, assign_op, placeholders)
+        self._shadow_savers = {}
+        # prefix --> the checkpoints kept by `max_to_keep`
+        self._last_checkpoints = {}
+        self._error = None
+        self._closed = False
+
+        # metrics
+        self._num_writes = 0
+        self._blocked_seconds = 0.0
+        self._write_seconds = 0.0
+
+        self._thread = threading.Thread(
+            target=self._run, name="AsyncCheckpointWriter")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, sess, variables, save_path, global_step):
+        """Snapshot the variables, and save them asynchronously
+
+        Args:
+            sess: the session holding the variables
+            variables: list of `tf.Variable`
+            save_path: prefix of the checkpoint
+            global_step: Integer, appended to the prefix
+
+        Returns:
+            the path of the checkpoint to be written
+        """
+        start_time = time.time()
+        values = sess.run(variables)
+        snapshot = collections.OrderedDict(
+            (variable.op.name, value)
+            for variable, value in zip(variables, values))
+
+        self._put((self._write_checkpoint,
+                   (snapshot, save_path, global_step)))
+        self._blocked_seconds += time.time() - start_time
+        return "%s-%d" % (save_path, global_step)
+
+    def submit(self, fn, *args):
+        """Run `fn(*args)` on the worker thread. The arguments
+        should be snapshots that will not be modified later"""
+        start_time = time.time()
+        self._put((fn, args))
+        self._blocked_seconds += time.time() - start_time
+
+    def _put(self, item):
+        if self._closed:
+            raise ValueError("AsyncCheckpointWriter is closed")
+        self._raise_error()
+        self._queue.put(item)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self):
+        """Block until all the submitted writes are done"""
+        start_time = time.time()
+        self._queue.join()
+        self._blocked_seconds += time.time() - start_time
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        for sess, _, _, _ in self._shadow_savers.values():
+            sess.close()
+
+        tf.logging.info(
+            "AsyncCheckpointWriter: %d writes, %.2fs blocked, "
+            "%.2fs writing" % (self._num_writes,
+                               self._blocked_seconds,
+                               self._write_seconds))
+
+    @property
+    def stats(self):
+        return {"NumWrites": self._num_writes,
+                "BlockedSeconds": self._blocked_seconds,
+                "WriteSeconds": self._write_seconds}
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            fn, args = item
+            start_time = time.time()
+            try:
+                fn(*args)
+            except Exception as error:
+                tf.logging.error("AsyncCheckpointWriter: %s" % error)
+                self._error = error
+            finally:
+                self._num_writes += 1
+                self._write_seconds += time.time() - start_time
+                self._queue.task_done()
+
+    def _get_shadow_saver(self, snapshot):
+        # the names, shapes and dtypes of the variables
+        signature = tuple((name, value.shape, value.dtype.str)
+                          for name, value in snapshot.items())
+        if signature not in self._shadow_savers:
+            graph = tf.Graph()
+            with graph.as_default():
+                placeholders = []
+                shadow_variables = []
+                for name, value in snapshot.items():
+                    placeholder = tf.placeholder(
+                        dtype=tf.as_dtype(value.dtype),
+                        shape=value.shape)
+                    # using `tf.Variable` will uniquify the names
+                    shadow_variables.append(tf.get_variable(
+                        name, shape=value.shape,
+                        dtype=tf.as_dtype(value.dtype),
+                        initializer=tf.zeros_initializer(),
+                        trainable=False))
+                    placeholders.append(placeholder)
+
+                assign_op = tf.group(*[
+                    tf.assign(variable, placeholder)
+                    for variable, placeholder in zip(
+                        shadow_variables, placeholders)])
+                saver = tf.train.Saver(
+                    var_list=shadow_variables,
+                    max_to_keep=self._max_to_keep)
+
+            sess = tf.Session(graph=graph)
+            self._shadow_savers[signature] = (
+                sess, saver, assign_op, placeholders)
+
+        return self._shadow_savers[signature]
+
+    def _write_checkpoint(self, snapshot, save_path, global_step):
+        (sess,
+         saver,
+         assign_op,
+         placeholders) = self._get_shadow_saver(snapshot)
+
+        tf.gfile.MakeDirs(os.path.dirname(save_path))
+        sess.run(assign_op, feed_dict=dict(
+            zip(placeholders, snapshot.values())))
+        # the saver is shared, thus `max_to_keep` follows each prefix
+        saver.set_last_checkpoints(self._last_checkpoints.get(save_path, []))
+        saver.save(sess, save_path,
+                   global_step=global_step,
+                   write_meta_graph=False)
+        self._last_checkpoints[save_path] = saver.last_checkpoints
@@ -56,6 +56,49 @@ class MultitaskHardSharingModel(
                 summary_collections,
                 update_variables)
 
+    def _build_eval_models(self):
+        """Same models on `eval_data`, sharing the variables
+        (through the modules) and without dropout"""
+        logits_collections = []
+        predictions_collections = []
+
+        for task_idx in range(self.num_models):
+            scope_name = "EvalModel_%s" % self._names[task_idx]
+            with tf.variable_scope(scope_name):
+                (logits,
+                 predictions,
+                 _) = self._build_single_model(
+                    task_name=self._names[task_idx],
+                    data=self._eval_data[task_idx],
+                    embedding_fn=self._embedding_fns[self._main_model_index],
+                    encoder_fn_1=self._encoder_fns_1[self._main_model_index],
+                    encoder_fn_2=self._encoder_fns_2[self._main_model_index],
+                    logits_fn=self._logits_fns[task_idx],
+                    is_training=False)
+
+                logits_collections.append(logits)
+                predictions_collections.append(predictions)
+
+        return logits_collections, predictions_collections
+
+    def _build_mixed_model(self):
+        """Mixed-task model, sharing the embedding and
+        encoders of the main task, as in `_build_models`"""
+        sub_batch_sizes = tf.placeholder(
+            tf.int32, shape=[self.num_models],
+            name="mixed_sub_batch_sizes")
+
+        with tf.variable_scope("MixedModel"):
+            (actual_sub_batch_sizes,
+             cross_entropy) = self._build_mixed_single_model(
+                sub_batch_sizes=sub_batch_sizes,
+                embedding_fn=self._embedding_fns[self._main_model_index],
+                encoder_fn_1=self._encoder_fns_1[self._main_model_index],
+                encoder_fn_2=self._encoder_fns_2[self._main_model_index],
+                logits_fns=self._logits_fns)
+
+        return sub_batch_sizes, actual_sub_batch_sizes, cross_entropy
+
 
     # def evaluate(self, model_idx,
     #              max_eval_batches=None,
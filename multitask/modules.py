@@ -32,6 +32,10 @@ from tensorflow.python.ops import rnn_cell_impl
 from warnings import warn
 from constants import CACHED_ELMO_NUM_ELEMENTS
 
+# `LSTMBlockFusedCell`, which runs the whole sequence in one op,
+# with variables compatible with the "lstm" (`BasicLSTMCell`) ones
+FUSED_LSTM_UNIT_TYPE = "lstm_block_fused"
+
 
 @six.add_metaclass(abc.ABCMeta)
 class AbstractModule(object):
@@ -331,6 +335,11 @@ class TFHubElmoEmbedding(base.AbstractModule):
         self._trainable = trainable
         self._elmo = tf_hub.Module(self.ELMO_URL, trainable=trainable)
 
+    @property
+    def hub_variables(self):
+        """The variables of the TF-Hub module"""
+        return self._elmo.variables
+
     def _build(self, tokens_input, tokens_length):
         """Compute the ELMO embeddings
 
@@ -394,8 +403,21 @@ class LstmEncoder(base.AbstractModule):
             print("\n")
 
 
-    def _build(self, inputs, sequence_length=None, initial_state=None):
-        mode = "train" if self._is_training else "inference"
+    def _build(self, inputs, sequence_length=None,
+               initial_state=None, is_training=None):
+        """`is_training` overrides the one given in the constructor,
+        which allows building an evaluation sub-graph (without dropout)
+        that shares the variables with the training graph"""
+        if is_training is None:
+            is_training = self._is_training
+        mode = "train" if is_training else "inference"
+
+        if self._unit_type == FUSED_LSTM_UNIT_TYPE:
+            return self._build_fused(
+                inputs=inputs,
+                sequence_length=sequence_length,
+                initial_state=initial_state,
+                mode=mode)
 
         if self._bidirectional:
             fw_cell = rnn_cell_utils.create_rnn_cell(
@@ -461,6 +483,109 @@ class LstmEncoder(base.AbstractModule):
 
         return outputs, state
 
+    def _build_fused(self, inputs, sequence_length, initial_state, mode):
+        """Same as `_build` with `BasicLSTMCell`, but with
+        `LSTMBlockFusedCell`. The variables are created under the same
+        names as `bidirectional_dynamic_rnn` (or `dynamic_rnn`) would,
+        thus checkpoints of the "lstm" unit type can be restored as is"""
+        if self._encoder_kargs:
+            raise ValueError("%s does not support additional "
+                             "cell arguments" % FUSED_LSTM_UNIT_TYPE)
+
+        # the fused cell is time-major
+        inputs = tf.transpose(inputs, [1, 0, 2])
+        with tf.variable_scope(self._encoder_scope):
+            if self._bidirectional:
+                with tf.variable_scope("fw"):
+                    fw_outputs, fw_state = self._fused_rnn(
+                        inputs, sequence_length, initial_state, mode)
+
+                with tf.variable_scope("bw"):
+                    bw_outputs, bw_state = self._fused_rnn(
+                        inputs, sequence_length, initial_state, mode,
+                        reverse=True)
+
+                outputs = array_ops.concat(
+                    axis=2, values=[fw_outputs, bw_outputs])
+                state = (fw_state, bw_state)
+
+            else:
+                outputs, state = self._fused_rnn(
+                    inputs, sequence_length, initial_state, mode)
+
+        outputs = tf.transpose(outputs, [1, 0, 2])
+        return outputs, state
+
+    def _fused_rnn(self, inputs, sequence_length,
+                   initial_state, mode, reverse=False):
+        """Multi-layer LSTM on time-major inputs, the dropout and
+        residual connections follow `create_rnn_cell`"""
+        def _reverse(tensor):
+            if sequence_length is None:
+                return tf.reverse(tensor, axis=[0])
+            return tf.reverse_sequence(
+                tensor, sequence_length, seq_axis=0, batch_axis=1)
+
+        # the fused cell zeros the outputs beyond `sequence_length`,
+        # and so does `dynamic_rnn` after the `ResidualWrapper`
+        mask = 1.0
+        if sequence_length is not None:
+            mask = tf.expand_dims(tf.transpose(tf.sequence_mask(
+                sequence_length, maxlen=tf.shape(inputs)[0],
+                dtype=dtypes.float32)), axis=2)
+
+        if reverse:
+            inputs = _reverse(inputs)
+
+        dropout = self._dropout_rate
+        if dropout is not None and mode != "train":
+            dropout = 0.0
+
+        cells = []
+        states = []
+        for i in range(self._num_layers):
+            cell = tf.contrib.rnn.LSTMBlockFusedCell(self._num_units)
+            layer_initial_state = initial_state
+            if initial_state is not None and self._num_layers > 1:
+                layer_initial_state = initial_state[i]
+
+            layer_inputs = inputs
+            if dropout:
+                layer_inputs = tf.nn.dropout(
+                    layer_inputs, keep_prob=1.0 - dropout)
+
+            # variables of `MultiRNNCell([BasicLSTMCell, ...])`
+            if self._num_layers > 1:
+                with tf.variable_scope("multi_rnn_cell/cell_%d" % i):
+                    outputs, state = cell(
+                        layer_inputs,
+                        initial_state=layer_initial_state,
+                        dtype=dtypes.float32,
+                        sequence_length=sequence_length,
+                        scope="basic_lstm_cell")
+            else:
+                outputs, state = cell(
+                    layer_inputs,
+                    initial_state=layer_initial_state,
+                    dtype=dtypes.float32,
+                    sequence_length=sequence_length,
+                    scope="basic_lstm_cell")
+
+            # residual connections on the top layers
+            if i >= self._num_layers - self._num_residual_layers:
+                outputs = outputs + inputs * mask
+
+            inputs = outputs
+            cells.append(cell)
+            states.append(rnn_cell_impl.LSTMStateTuple(*state))
+
+        self._cell = cells
+        if reverse:
+            outputs = _reverse(outputs)
+
+        state = states[0] if self._num_layers == 1 else tuple(states)
+        return outputs, state
+
     def _clone(self, name):
         return type(self)(unit_type=self._unit_type,
                           num_units=self._num_units,
@@ -686,19 +811,36 @@ def get_last_layer_cell_state(cell_states):
 
 
 class CachedElmoModule(base.AbstractModule):
-    """Does nothing, but ensures consistent behavior"""
+    """Does nothing, but ensures consistent behavior
+
+    When `pre_reduced` is True, the layers have been folded offline
+    with frozen weights (see `elmo_cache_utils.py reduce`), and the
+    module simply passes through the [batch_size, sequence_len, num_units]
+    inputs. Non-float32 (i.e. float16) inputs are cast to float32.
+    """
 
     def __init__(self,
                  name="cached_elmo",
                  trainable=True,
-                 num_elements=CACHED_ELMO_NUM_ELEMENTS):
+                 num_elements=CACHED_ELMO_NUM_ELEMENTS,
+                 pre_reduced=False):
 
         super(CachedElmoModule, self).__init__(name=name)
         self._trainable = trainable
         self._num_elements = num_elements
+        self._pre_reduced = pre_reduced
         self._initializer = utils.create_linear_initializer(num_elements)
 
     def _build(self, inputs):
+        # half-precision caches are streamed as float16
+        # to halve the input bandwidth, and cast back here
+        if inputs.dtype != tf.float32:
+            inputs = tf.cast(inputs, tf.float32)
+
+        if self._pre_reduced:
+            # Inputs = Outputs = [batch_size, sequence_len, num_units]
+            return inputs
+
         self._weight = tf.get_variable(
             "weight",
             shape=[1, self._num_elements, 1, 1],
@@ -714,4 +856,5 @@ class CachedElmoModule(base.AbstractModule):
     def _clone(self, name):
         return type(self)(name=name,
                           trainable=self._trainable,
-                          num_elements=self._num_elements)
+                          num_elements=self._num_elements,
+                          pre_reduced=self._pre_reduced)
@@ -3,6 +3,8 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import json
+import threading
 import numpy as np
 from namedlist import namedlist
 from collections import namedtuple
@@ -18,6 +20,11 @@ def _safe_standardization(reward, hists, ahists):
     return (reward - np.mean(hists)) / np.std(hists)
 
 
+def _squashed_standardization(reward, hists, ahists):
+    # the standardized reward, squashed into [0, 1]
+    return 1. / (1. + np.exp(-_safe_standardization(reward, hists, ahists)))
+
+
 def _prediction_gain(reward, hists, ahists):
     if hists[-1] == 0.0:
         return 0.0
@@ -49,6 +56,10 @@ def _binary_prediction_gain_v3(reward, hists, ahists):
     return float(reward >= hists[-1])
 
 
+# the selector of `--mixing_ratios AutoMR`
+DEFAULT_SELECTOR = "BernoulliTS"
+
+
 class MTLAutoMRModel(object):
     """
     Multitask model with automatic task selection
@@ -68,6 +79,13 @@ class MTLAutoMRModel(object):
     
     Q Score should be negative loss thus lower is better
     high initial Q for being "optimistic under uncertainty"
+
+    When `block_samples` is given, `block_samples` tasks are sampled
+    after each evaluation, and turned into a schedule of `block_length`
+    steps (e.g. `steps_per_eval`) mixing them, instead of training a
+    single task until the next evaluation.
+
+    `selector_type` is one of `SELECTORS`, e.g. `EXP3` or `GaussianTS`.
     """
 
     def __init__(self,
@@ -75,29 +93,77 @@ class MTLAutoMRModel(object):
                  initial_weight,
                  update_rate=0.3,
                  reward_scale=1.0,
-                 temperature_anneal_rate=None):
+                 temperature_anneal_rate=None,
+                 block_samples=None,
+                 block_length=None,
+                 selector_type=DEFAULT_SELECTOR):
         self._model = model
         # save new arguments
         self._initial_weight = initial_weight
         self._update_rate = update_rate
         self._reward_scale = reward_scale
         self._temperature_anneal_rate = temperature_anneal_rate
+        self._block_samples = block_samples
+        self._block_length = block_length
+        self._selector_type = selector_type
+        if selector_type not in SELECTORS:
+            raise ValueError("Unknown selector %s, expected one of %s" % (
+                selector_type, sorted(SELECTORS.keys())))
+        if block_samples is not None and block_length is None:
+            raise ValueError("`block_samples` requires `block_length`")
     
     def build(self):
         # build the MTL base model
         self._model.build()
         # build the Selector
-        self._TaskSelector = BernoulliBanditTS(
+        self._TaskSelector = create_selector(
+            self._selector_type,
             num_actions=self.num_models,
-            reward_shaping_fn=lambda reward, hists, ahists: (
-                _binary_prediction_gain_v3(reward, hists, ahists)),
             decay_rate=self._update_rate)
+        if self._TaskSelector.single_arm_updates and (
+                self._model.mixed_training or self.block_scheduling):
+            raise ValueError(
+                "%s does not support `--training_strategy Mixed` nor "
+                "`--automr_block_samples`" % self._selector_type)
 
         # initial task will be main task
         self._selector_task_index = 0
+        if self._block_samples is not None:
+            self._set_schedule(np.zeros(
+                [self._block_length], dtype=np.int64))
+
+    @property
+    def block_scheduling(self):
+        return self._block_samples is not None
+
+    def _set_schedule(self, task_schedule):
+        self._task_schedule = task_schedule
+        self._schedule_position = 0
+        # the share of each task in the block
+        self._schedule_weights = np.bincount(
+            task_schedule, minlength=self.num_models) / len(task_schedule)
 
     def update_TaskSelector(self, reward):
-        
+        if self._model.mixed_training and not self.block_scheduling:
+            # every task has been trained on, by its share of the
+            # mixed batches (the arm weights, which only change with
+            # the updates), rather than the sampled one
+            self._TaskSelector.update_batch(
+                reward=reward,
+                arm_weights=self._mixing_shares(
+                    self._TaskSelector.arm_weights))
+            return
+
+        if self.block_scheduling:
+            self._TaskSelector.update_batch(
+                reward=reward,
+                arm_weights=self._schedule_weights)
+            self._set_schedule(self._TaskSelector.sample_schedule(
+                num_steps=self._block_length,
+                num_samples=self._block_samples,
+                step=self._model.global_step))
+            return
+
         self._TaskSelector.update(
             reward=reward,
             chosen_arm=self._selector_task_index)
@@ -109,9 +175,28 @@ class MTLAutoMRModel(object):
     def _AutoMR_task_selector(self, step):
         # override parent method
         # step argument is kept for compatability
+        if self.block_scheduling:
+            # a schedule longer than the block repeats itself
+            task = self._task_schedule[
+                self._schedule_position % len(self._task_schedule)]
+            self._schedule_position += 1
+            return task
+
         return self._selector_task_index
 
+    def _mixing_shares(self, mixing_ratios):
+        mixing_ratios = np.asarray(mixing_ratios, dtype=np.float64)
+        return mixing_ratios / mixing_ratios.sum()
+
     def train(self):
+        if self._model.mixed_training:
+            # mix the tasks by the expected reward of each arm,
+            # or by the share of each task in the block
+            return self._model.train_mixed(
+                mixing_ratios=(
+                    self._schedule_weights if self.block_scheduling
+                    else self._TaskSelector.arm_weights))
+
         return self._model.train(
             model_idx=self._AutoMR_task_selector(self.global_step))
 
@@ -130,6 +215,12 @@ class MTLAutoMRModel(object):
     def inference(self, *args, **kargs):
         return self._model.inference(*args, **kargs)
 
+    def initialize_proxy_eval(self, *args, **kargs):
+        return self._model.initialize_proxy_eval(*args, **kargs)
+
+    def proxy_evaluate(self, *args, **kargs):
+        return self._model.proxy_evaluate(*args, **kargs)
+
     # Save and Load the Selector
     # ----------------------------------------------
     @property
@@ -138,12 +229,21 @@ class MTLAutoMRModel(object):
 
     def save_selector(self):
         # additionally save the selector
-        self._TaskSelector.save(self.selector_dir)
+        writer = self._model.checkpoint_writer
+        if writer is None:
+            self._TaskSelector.save(self.selector_dir)
+        else:
+            # only the records since the last confirmed save, and
+            # the parameters, are handed over to the writer
+            writer.submit(self._TaskSelector.write_state, self.selector_dir,
+                          *self._TaskSelector.persistence_state(
+                              self.selector_dir))
 
     def load_selector(self):
         try:
-            # additionally restore the selector
-            self._TaskSelector.load(self.selector_dir)
+            # additionally restore the selector, the older
+            # records are not needed to resume training
+            self._TaskSelector.load(self.selector_dir, tail_only=True)
 
         except ValueError:
             # the files haven't been created, skipping
@@ -168,8 +268,15 @@ class MTLAutoMRModel(object):
         return self._model.write_summary(*args, **kargs)
 
     def save_best_session(self):
+        # e.g. with `--shared_eval`, the only save of the selector
+        # when `--steps_per_ckpt` is not given
+        self.save_selector()
         return self._model.save_best_session()
 
+    @property
+    def checkpoint_writer(self):
+        return self._model.checkpoint_writer
+
     # Copy the interface (base class)
     # ----------------------------------------------
     def initialize_data_iterator(self, *args, **kargs):
@@ -195,6 +302,10 @@ class MTLAutoMRModel(object):
     def main_task_step(self):
         return self._model.main_task_step
 
+    @property
+    def examples_per_second(self):
+        return self._model.examples_per_second
+
 
 
 
@@ -204,10 +315,71 @@ Parameter = namedlist(
 SampleHistory = namedtuple(
     "SampleHistory",
     ("ChosenArm", "SampledValues"))
+# `Parameters` is the [num_actions, 2] parameters (e.g. Alpha, Beta)
+# after the update, or a list of {"Arm", "Alpha", "Beta"} in older selectors
 UpdateHistory = namedtuple(
     "UpdateHistory",
     ("Reward", "ShapedReward", "ChosenArm", "Parameters"))
 
+# number of rewards (overall, and per arm) kept for the shaping functions
+REWARD_HISTORY_SIZE = 1024
+
+# the selector is persisted as an append-only log of fixed-size
+# records (one per sample or update), and a small JSON snapshot of
+# the parameters and of the number of valid records in the log
+SELECTOR_LOG_SUFFIX = ".log"
+SELECTOR_SNAPSHOT_SUFFIX = ".snapshot.json"
+SAMPLE_RECORD = 0
+UPDATE_RECORD = 1
+# logs of version 1 have no `ArmWeights`
+SELECTOR_LOG_VERSION = 2
+# records read at once when looking for the tail of the log
+TAIL_CHUNK_SIZE = 4096
+
+
+def _record_dtype(num_actions, version=SELECTOR_LOG_VERSION):
+    # `Values` are the sampled values (in the first column) of a
+    # sample, and the parameters (e.g. Alpha, Beta) after the update
+    # of an update. `ArmWeights` are the shares of the arms credited
+    # by an update (one-hot for a single arm)
+    fields = [("Kind", "<i1"),
+              ("ChosenArm", "<i4"),
+              ("Step", "<i8"),
+              ("Reward", "<f8"),
+              ("ShapedReward", "<f8"),
+              ("Values", "<f8", (num_actions, 2))]
+    if version >= 2:
+        fields.append(("ArmWeights", "<f8", (num_actions,)))
+    return np.dtype(fields)
+
+
+def _upgrade_records(records, num_actions):
+    """Records of an older log, where the updates credit their
+    `ChosenArm` only (which is exact for single-arm updates)"""
+    upgraded = np.zeros([len(records)], dtype=_record_dtype(num_actions))
+    for field in records.dtype.names:
+        upgraded[field] = records[field]
+    updates = np.nonzero(upgraded["Kind"] == UPDATE_RECORD)[0]
+    upgraded["ArmWeights"][updates, upgraded["ChosenArm"][updates]] = 1.0
+    return upgraded
+
+
+def write_selector_state(file_dir, records, start, snapshot):
+    """Write the `records` from the `start`-th record of the log
+    (dropping anything after them), and then the snapshot"""
+    log_file = file_dir + SELECTOR_LOG_SUFFIX
+    mode = "r+b" if start > 0 and os.path.exists(log_file) else "wb"
+    with open(log_file, mode) as f:
+        f.seek(start * records.dtype.itemsize)
+        f.write(records.tobytes())
+        f.truncate()
+
+    # write then rename, the snapshot is either the old or the new one
+    snapshot_file = file_dir + SELECTOR_SNAPSHOT_SUFFIX
+    with open(snapshot_file + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.rename(snapshot_file + ".tmp", snapshot_file)
+
 
 def random_argmax(vector):
     """Helper function to select argmax at random... not just first one."""
@@ -215,134 +387,775 @@ def random_argmax(vector):
     return index
 
 
-class BernoulliBanditTS(BaseBandit):
+class _RingBuffers(object):
+    """The last `capacity` values of each of `num_buffers` buffers"""
+
+    def __init__(self, num_buffers, capacity):
+        self._values = np.zeros([num_buffers, capacity], dtype=np.float64)
+        self._counts = np.zeros([num_buffers], dtype=np.int64)
+        self._capacity = capacity
+
+    def append(self, index, value):
+        self._values[index, self._counts[index] % self._capacity] = value
+        self._counts[index] += 1
+
+    def values(self, index):
+        """The values of the buffer, from the oldest to the newest"""
+        count = self._counts[index]
+        if count <= self._capacity:
+            return self._values[index, :count]
+
+        start = count % self._capacity
+        return np.concatenate([self._values[index, start:],
+                               self._values[index, :start]])
+
+    def __len__(self):
+        return len(self._counts)
+
+    def get_state(self):
+        return {"values": self._values.tolist(),
+                "counts": self._counts.tolist()}
+
+    def set_state(self, state):
+        values = np.array(state["values"], dtype=np.float64)
+        if values.shape != self._values.shape:
+            raise ValueError("Expected buffers of shape %s, found %s" % (
+                self._values.shape, values.shape))
+        self._values = values
+        self._counts = np.array(state["counts"], dtype=np.int64)
+
+
+class _ArrayBandit(BaseBandit):
+    """The common part of the selectors: the parameters of the arms are a
+    [num_actions, 2] array, and the reward histories, the records and
+    their persistence are shared. The selectors implement
+
+        _initial_parameters():
+            the [num_actions, 2] parameters before any update
+        _sample_values(num_samples):
+            [num_samples, num_actions] values, an arm is chosen by
+            each row with its argmax
+        _update_parameters(shaped_reward, arm_weights):
+            the update of the parameters, where `arm_weights` is one-hot
+            for a single arm, or the share of each arm in a block
+        arm_weights:
+            non-negative weights of the arms, e.g. for mixed training
+
+    Selectors with `single_arm_updates` only support `update`, i.e. a
+    reward credited to the one arm that was sampled.
+    """
+    selector_type = None
+    single_arm_updates = False
 
     def __init__(self,
                  num_actions,
                  reward_shaping_fn,
-                 prior_alpha=1,
-                 prior_beta=1,
-                 decay_rate=0.0):
-        """
-        Args:
-            prior_alpha:
-                Prior parameters for Beta Distribution
-            prior_beta:
-                Prior parameters for Beta Distribution
-            decay_rate:
-                How quickly uncertainty is injected. Set to
-                non-zero values will effectly create a non-stationary TS bandit
-
-        """
-        super(BernoulliBanditTS, self).__init__()
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        super(_ArrayBandit, self).__init__()
         if not callable(reward_shaping_fn):
             raise TypeError("`reward_shaping_fn` must be callable")
 
         self._num_actions = num_actions
         self._reward_shaping_fn = reward_shaping_fn
-        self._prior_alpha = prior_alpha
-        self._prior_beta = prior_beta
         self._decay_rate = decay_rate
-        self._parameters = [
-            Parameter(Alpha=prior_alpha, Beta=prior_beta)
-            for _ in range(num_actions)]
+        self._history_size = history_size
+        self._parameters = self._initial_parameters()
+        # index `num_actions` holds the rewards of all the arms
+        self._reward_histories = _RingBuffers(
+            num_buffers=num_actions + 1, capacity=history_size)
 
-        self._sample_histories = []
-        self._update_histories = []
-        
+        # the records in memory are [records_offset, num_records)
+        # of the log, those before `num_persisted` are on disk. Both
+        # are set by the writer (thread) once the write is done
+        self._records = np.zeros([64], dtype=_record_dtype(num_actions))
+        self._records_offset = 0
+        self._num_records = 0
+        self._num_persisted = 0
+        self._persisted_dir = None
+        self._persistence_lock = threading.Lock()
+
+    def _initial_parameters(self):
+        raise NotImplementedError
+
+    def _sample_values(self, num_samples):
+        raise NotImplementedError
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        raise NotImplementedError
+
+    def _check_shaped_reward(self, shaped_reward):
+        pass
+
+    def _snapshot_state(self):
+        """Additional state of the selector, saved in the snapshot"""
+        return {}
+
+    def _restore_state(self, snapshot):
+        pass
 
     @property
-    def alphas(self):
-        return [p.Alpha for p in self._parameters]
+    def arm_weights(self):
+        raise NotImplementedError
 
     @property
-    def betas(self):
-        return [p.Beta for p in self._parameters]
+    def parameters(self):
+        return self._parameters.copy()
 
     @property
-    def arm_weights(self):
-        return [p.Alpha / (p.Alpha + p.Beta) for p in self._parameters]
+    def records(self):
+        """The records in memory, i.e. those since the first record
+        of the log that is not yet persisted or loaded"""
+        return self._records[:self._num_records - self._records_offset]
+
+    @property
+    def sample_histories(self):
+        return [SampleHistory(ChosenArm=r["ChosenArm"],
+                              SampledValues=r["Values"][:, 0])
+                for r in self.records if r["Kind"] == SAMPLE_RECORD]
+
+    @property
+    def update_histories(self):
+        return [UpdateHistory(Reward=r["Reward"],
+                              ShapedReward=r["ShapedReward"],
+                              ChosenArm=r["ChosenArm"],
+                              Parameters=r["Values"])
+                for r in self.records if r["Kind"] == UPDATE_RECORD]
+
+    def _append_record(self, kind, chosen_arm, values, step=0,
+                       reward=0.0, shaped_reward=0.0, arm_weights=0.0):
+        index = self._num_records - self._records_offset
+        if index == len(self._records):
+            self._trim_records()
+            index = self._num_records - self._records_offset
+        if index == len(self._records):
+            self._records = np.concatenate(
+                [self._records, np.zeros_like(self._records)])
+
+        record = self._records[index]
+        record["Kind"] = kind
+        record["ChosenArm"] = chosen_arm
+        record["Step"] = step
+        record["Reward"] = reward
+        record["ShapedReward"] = shaped_reward
+        record["Values"] = values
+        record["ArmWeights"] = arm_weights
+        self._num_records += 1
+
+    def _trim_records(self):
+        """Drop the records that are already persisted, the reward
+        histories do not need them"""
+        with self._persistence_lock:
+            num_dropped = self._num_persisted - self._records_offset
+        if num_dropped <= 0:
+            return
+
+        self._records = np.concatenate(
+            [self._records[num_dropped:],
+             np.zeros([num_dropped], dtype=self._records.dtype)])
+        self._records_offset += num_dropped
+
+    def _append_reward(self, reward, arm_weights):
+        self._reward_histories.append(self._num_actions, reward)
+        for arm in np.nonzero(arm_weights)[0]:
+            self._reward_histories.append(arm, reward)
 
     def get_reward_histories(self, chosen_arm=None):
-        histories = [h.Reward for h in self._update_histories]
+        histories = self._reward_histories.values(self._num_actions)
         arm_histories = (
-            [h.Reward for h in self._update_histories
-             if h.ChosenArm == chosen_arm]
+            self._reward_histories.values(chosen_arm)
             if chosen_arm is not None else None)
 
         # at the start, the update_histories is empty
         # to avoid nan, we will force set this to 0
         if len(histories) == 0:
-            histories = [0.0]
-        if len(arm_histories) == 0:
-            arm_histories = ([0.0] if chosen_arm is not None else None)
+            histories = np.zeros([1])
+        if arm_histories is not None and len(arm_histories) == 0:
+            arm_histories = np.zeros([1])
 
         return histories, arm_histories
-    
+
     def sample(self, step=0):
-        sampled_means = np.random.beta(self.alphas, self.betas)
-        chosen_arm = random_argmax(sampled_means)
+        sampled_values = self._sample_values(1)[0]
+        chosen_arm = random_argmax(sampled_values)
 
-        self._sample_histories.append(
-            SampleHistory(
-                ChosenArm=chosen_arm,
-                SampledValues=sampled_means))
+        values = np.zeros([self._num_actions, 2])
+        values[:, 0] = sampled_values
+        self._append_record(kind=SAMPLE_RECORD,
+                            chosen_arm=chosen_arm,
+                            values=values,
+                            step=step)
 
-        return chosen_arm, sampled_means
+        return chosen_arm, sampled_values
 
     def update(self, reward, chosen_arm):
+        arm_weights = np.zeros([self._num_actions])
+        arm_weights[chosen_arm] = 1.0
+        self._update(reward, chosen_arm, arm_weights)
+
+    def update_batch(self, reward, arm_weights):
+        """Update the arms trained on in a block, each one with the
+        shaped reward weighted by its share of the block"""
+        if self.single_arm_updates:
+            raise ValueError("%s only supports single-arm updates"
+                             % self.selector_type)
+        arm_weights = np.asarray(arm_weights, dtype=np.float64)
+        # the record is attributed to the arm with the largest share
+        self._update(reward, int(np.argmax(arm_weights)), arm_weights)
+
+    def _update(self, reward, chosen_arm, arm_weights):
         shaped_reward = self._reward_shaping_fn(
             reward, *self.get_reward_histories(chosen_arm))
-        
-        if shaped_reward not in [0.0, 1.0]:
-            raise ValueError("`shaped_reward` should be a Bernoulli variable")
-
-        # All values decay slightly, observation updated
-        for arm in range(self._num_actions):
-            # 􏰁(1 − \gamma) \alpha + \gamma \alpha_bar
-            # (1 − \gamma) \beta + \gamma \beta_bar
-            # where *_bar is a hyper-parameter which we chose
-            # to be the prior (\alpha = \beta = 1), i.e. uniform
-            self._parameters[arm].Alpha = (
-                (1 - self._decay_rate) *
-                self._parameters[arm].Alpha +
-                self._decay_rate * self._prior_alpha)
-            self._parameters[arm].Beta = (
-                (1 - self._decay_rate) *
-                self._parameters[arm].Beta +
-                self._decay_rate * self._prior_beta)
-
-        self._parameters[chosen_arm].Alpha += shaped_reward
-        self._parameters[chosen_arm].Beta += 1 - shaped_reward
-
-        parameter_snapshot = [
-            {"Arm": i, "Alpha": p.Alpha, "Beta": p.Beta}
-            for i, p in enumerate(self._parameters)]
-
-        self._update_histories.append(
-            UpdateHistory(
-                Reward=reward,
-                ShapedReward=shaped_reward,
-                ChosenArm=chosen_arm,
-                Parameters=parameter_snapshot))
-        
+        self._check_shaped_reward(shaped_reward)
+        self._update_parameters(shaped_reward, arm_weights)
+
+        self._append_reward(reward, arm_weights)
+        self._append_record(kind=UPDATE_RECORD,
+                            chosen_arm=chosen_arm,
+                            values=self._parameters,
+                            reward=reward,
+                            shaped_reward=shaped_reward,
+                            arm_weights=arm_weights)
+
+    def sample_schedule(self, num_steps, num_samples, step=0):
+        """Draw `num_samples` samples at once, and spread the chosen
+        arms over `num_steps` steps, proportionally to the number of
+        times each arm is chosen, and interleaved
+
+        Returns:
+            an array of `num_steps` arms
+        """
+        sampled_values = self._sample_values(num_samples)
+        # random tie-breaking, as in `random_argmax`
+        is_max = sampled_values == sampled_values.max(axis=1, keepdims=True)
+        chosen_arms = np.argmax(
+            is_max * np.random.rand(*is_max.shape), axis=1)
+        counts = np.bincount(chosen_arms, minlength=self._num_actions)
+
+        # largest remainder rounding of the steps of each arm
+        shares = counts / num_samples * num_steps
+        steps_per_arm = np.floor(shares).astype(np.int64)
+        remainders = np.argsort(steps_per_arm - shares, kind="stable")
+        steps_per_arm[remainders[:num_steps - steps_per_arm.sum()]] += 1
+
+        # each arm at evenly spaced positions of the block
+        arms = np.repeat(np.arange(self._num_actions), steps_per_arm)
+        positions = np.concatenate([
+            (np.arange(n) + 0.5) / n for n in steps_per_arm if n > 0])
+        task_schedule = arms[np.argsort(positions, kind="stable")]
+
+        for chosen_arm, values in zip(chosen_arms, sampled_values):
+            self._append_record(kind=SAMPLE_RECORD,
+                                chosen_arm=chosen_arm,
+                                values=np.stack(
+                                    [values, np.zeros_like(values)], axis=1),
+                                step=step)
+
+        return task_schedule
+
+    def persistence_state(self, file_dir):
+        """Returns the arguments of `write_state`, i.e. the records
+        not yet written to `file_dir`, and the snapshot. A write that
+        is not confirmed (e.g. pending or failed) is redone by the next
+        one, from the same start"""
+        with self._persistence_lock:
+            start = self._num_persisted
+            persisted_dir = self._persisted_dir
+        if file_dir != persisted_dir:
+            # a new log, starting from the first record
+            if self._records_offset > 0:
+                raise ValueError("Only the tail of the log is in "
+                                 "memory, it can't be written elsewhere")
+            start = 0
+
+        records = self._records[start - self._records_offset:
+                                self._num_records - self._records_offset]
+        snapshot = {"selector_type": self.selector_type,
+                    "log_version": SELECTOR_LOG_VERSION,
+                    "num_actions": self._num_actions,
+                    "num_records": self._num_records,
+                    "parameters": self._parameters.tolist()}
+        snapshot.update(self._snapshot_state())
+        return records.copy(), start, snapshot
+
+    def write_state(self, file_dir, records, start, snapshot):
+        """`write_selector_state`, then record the records of the
+        snapshot as persisted, e.g. on the thread of the writer"""
+        write_selector_state(file_dir, records, start, snapshot)
+        with self._persistence_lock:
+            num_persisted = snapshot["num_records"]
+            if file_dir == self._persisted_dir:
+                num_persisted = max(num_persisted, self._num_persisted)
+            self._num_persisted = num_persisted
+            self._persisted_dir = file_dir
 
     def save(self, file_dir):
-        misc_utils.save_object(
-            self._parameters, file_dir + "._parameters")
-        misc_utils.save_object(
-            self._sample_histories, file_dir + "._sample_histories")
-        misc_utils.save_object(
-            self._update_histories, file_dir + "._update_histories")
-
-    def load(self, file_dir):
+        self.write_state(file_dir, *self.persistence_state(file_dir))
+
+    def load(self, file_dir, tail_only=False):
+        """Restore the selector saved in `file_dir`
+
+        When `tail_only` is True, only the records needed by the reward
+        histories are read (the parameters are in the snapshot), thus
+        the other records are not in `records`. Logs of older versions
+        are read entirely, and rewritten by the next save.
+        """
+        snapshot_file = file_dir + SELECTOR_SNAPSHOT_SUFFIX
+        if not os.path.exists(snapshot_file):
+            return self._load_legacy(file_dir)
+
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+        if snapshot["num_actions"] != self._num_actions:
+            raise ValueError("Expected %d actions, found %d" % (
+                self._num_actions, snapshot["num_actions"]))
+        # snapshots without a type are of Bernoulli selectors
+        selector_type = snapshot.get("selector_type", "BernoulliTS")
+        if selector_type != self.selector_type:
+            raise ValueError("Expected a %s selector, found %s" % (
+                self.selector_type, selector_type))
+
+        num_records = snapshot["num_records"]
+        version = snapshot.get("log_version", 1)
+        dtype = _record_dtype(self._num_actions, version=version)
+        log = np.zeros([0], dtype=dtype)
+        if num_records:
+            # records after `num_records` were not part of the snapshot
+            log = np.memmap(file_dir + SELECTOR_LOG_SUFFIX, dtype=dtype,
+                            mode="r", shape=(num_records,))
+
+        offset = 0
+        if tail_only and version == SELECTOR_LOG_VERSION:
+            offset = self._tail_offset(log)
+        records = np.array(log[offset:])
+        if version != SELECTOR_LOG_VERSION:
+            records = _upgrade_records(records, self._num_actions)
+
+        if "parameters" in snapshot:
+            self._parameters = np.array(
+                snapshot["parameters"], dtype=np.float64)
+        else:
+            self._parameters = np.stack(
+                [snapshot["alphas"], snapshot["betas"]],
+                axis=1).astype(np.float64)
+        self._set_records(records, offset)
+        self._restore_state(snapshot)
+        self._num_persisted = num_records
+        self._persisted_dir = file_dir
+        if version != SELECTOR_LOG_VERSION:
+            # the next save writes a new log
+            self._num_persisted = 0
+            self._persisted_dir = None
+
+    def _tail_offset(self, log):
+        """The first record of the shortest tail of the `log` holding
+        the last `history_size` updates, overall and of each arm"""
+        # the updates still needed by each of the reward histories
+        needed = np.full([self._num_actions + 1], self._history_size)
+        offset = len(log)
+        end = len(log)
+        while end > 0 and np.any(needed > 0):
+            start = max(0, end - TAIL_CHUNK_SIZE)
+            chunk = log[start: end]
+            is_update = chunk["Kind"] == UPDATE_RECORD
+            # [chunk_size, num_actions + 1] whether each record adds
+            # to each history, counted from the end of the chunk
+            adds = np.concatenate(
+                [chunk["ArmWeights"] != 0, np.ones([len(chunk), 1], bool)],
+                axis=1) & is_update[:, np.newaxis]
+            counts = np.cumsum(adds[::-1], axis=0)
+
+            for index in np.nonzero(needed > 0)[0]:
+                if counts[-1, index] >= needed[index]:
+                    position = np.argmax(counts[:, index] >= needed[index])
+                    offset = min(offset, end - 1 - position)
+                else:
+                    # the history needs the records before the chunk
+                    offset = start
+
+            needed = needed - counts[-1]
+            end = start
+
+        return offset
+
+    def _load_legacy(self, file_dir):
+        # the pickled lists of previous (Bernoulli) versions
+        if self.selector_type != "BernoulliTS":
+            raise ValueError("%s File not exist ", file_dir)
+
         try:
-            self._parameters = misc_utils.load_object(
+            parameters = misc_utils.load_object(
                 file_dir + "._parameters")
-            self._sample_histories = misc_utils.load_object(
+            sample_histories = misc_utils.load_object(
                 file_dir + "._sample_histories")
-            self._update_histories = misc_utils.load_object(
+            update_histories = misc_utils.load_object(
                 file_dir + "._update_histories")
-        
+
         except FileNotFoundError:
             raise ValueError("%s File not exist ", file_dir)
+
+        records = np.zeros([len(sample_histories) + len(update_histories)],
+                           dtype=_record_dtype(self._num_actions, version=1))
+        for record, history in zip(records, sample_histories):
+            record["Kind"] = SAMPLE_RECORD
+            record["ChosenArm"] = history.ChosenArm
+            record["Values"][:, 0] = history.SampledValues
+        for record, history in zip(records[len(sample_histories):],
+                                   update_histories):
+            record["Kind"] = UPDATE_RECORD
+            record["ChosenArm"] = history.ChosenArm
+            record["Reward"] = history.Reward
+            record["ShapedReward"] = history.ShapedReward
+            record["Values"] = (
+                [[p["Alpha"], p["Beta"]] for p in history.Parameters]
+                if isinstance(history.Parameters, list)
+                else history.Parameters)
+
+        self._parameters = np.array([[p.Alpha, p.Beta] for p in parameters],
+                                    dtype=np.float64)
+        self._set_records(_upgrade_records(records, self._num_actions), 0)
+        # the next save writes a new log
+        self._num_persisted = 0
+        self._persisted_dir = None
+
+    def _set_records(self, records, offset):
+        self._records = np.concatenate(
+            [records, np.zeros([max(64, len(records))],
+                               dtype=records.dtype)])
+        self._records_offset = offset
+        self._num_records = offset + len(records)
+
+        # rebuild the reward histories from the updates
+        self._reward_histories = _RingBuffers(
+            num_buffers=self._num_actions + 1,
+            capacity=self._history_size)
+        updates = records[records["Kind"] == UPDATE_RECORD]
+        for reward, arm_weights in zip(updates["Reward"],
+                                       updates["ArmWeights"]):
+            self._append_reward(reward, arm_weights)
+
+
+class BernoulliBanditTS(_ArrayBandit):
+    """Thompson sampling of Beta-Bernoulli arms, the parameters are
+    (Alpha, Beta), and the shaped rewards must be 0 or 1"""
+    selector_type = "BernoulliTS"
+
+    def __init__(self,
+                 num_actions,
+                 reward_shaping_fn,
+                 prior_alpha=1,
+                 prior_beta=1,
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        """
+        Args:
+            prior_alpha:
+                Prior parameters for Beta Distribution
+            prior_beta:
+                Prior parameters for Beta Distribution
+            decay_rate:
+                How quickly uncertainty is injected. Set to
+                non-zero values will effectly create a non-stationary TS bandit
+            history_size:
+                Number of the most recent rewards (overall, and per arm)
+                passed to `reward_shaping_fn`
+
+        """
+        self._prior_alpha = prior_alpha
+        self._prior_beta = prior_beta
+        super(BernoulliBanditTS, self).__init__(
+            num_actions=num_actions,
+            reward_shaping_fn=reward_shaping_fn,
+            decay_rate=decay_rate,
+            history_size=history_size)
+
+    def _initial_parameters(self):
+        return np.tile([[self._prior_alpha, self._prior_beta]],
+                       [self._num_actions, 1]).astype(np.float64)
+
+    @property
+    def alphas(self):
+        return self._parameters[:, 0].copy()
+
+    @property
+    def betas(self):
+        return self._parameters[:, 1].copy()
+
+    @property
+    def arm_weights(self):
+        alphas, betas = self._parameters[:, 0], self._parameters[:, 1]
+        return (alphas / (alphas + betas)).tolist()
+
+    def _sample_values(self, num_samples):
+        return np.random.beta(
+            self._parameters[:, 0], self._parameters[:, 1],
+            size=[num_samples, self._num_actions])
+
+    def _check_shaped_reward(self, shaped_reward):
+        if shaped_reward not in [0.0, 1.0]:
+            raise ValueError("`shaped_reward` should be a Bernoulli variable")
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        # All values decay slightly, observation updated
+        # 􏰁(1 − \gamma) \alpha + \gamma \alpha_bar
+        # (1 − \gamma) \beta + \gamma \beta_bar
+        # where *_bar is a hyper-parameter which we chose
+        # to be the prior (\alpha = \beta = 1), i.e. uniform
+        self._parameters *= 1 - self._decay_rate
+        self._parameters += self._decay_rate * np.array(
+            [self._prior_alpha, self._prior_beta])
+
+        self._parameters[:, 0] += arm_weights * shaped_reward
+        self._parameters[:, 1] += arm_weights * (1 - shaped_reward)
+
+
+class GaussianBanditTS(_ArrayBandit):
+    """Thompson sampling of Gaussian arms, for continuous shaped rewards.
+    The parameters are the (decayed) sum of the shaped rewards and the
+    (decayed) number of updates of each arm, the posterior of the mean
+    of an arm is Gaussian with a N(0, `prior_variance`) prior, and a
+    known `noise_variance` of the rewards
+    """
+    selector_type = "GaussianTS"
+
+    def __init__(self,
+                 num_actions,
+                 reward_shaping_fn,
+                 prior_variance=1.0,
+                 noise_variance=1.0,
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        super(GaussianBanditTS, self).__init__(
+            num_actions=num_actions,
+            reward_shaping_fn=reward_shaping_fn,
+            decay_rate=decay_rate,
+            history_size=history_size)
+        self._prior_variance = prior_variance
+        self._noise_variance = noise_variance
+        # fixed draws for `arm_weights`, leaving the global random
+        # state (and thus the samples) untouched
+        self._normal_draws = np.random.RandomState(0).randn(
+            256, num_actions)
+
+    def _initial_parameters(self):
+        return np.zeros([self._num_actions, 2], dtype=np.float64)
+
+    def _posterior(self):
+        """The means and standard deviations of the posteriors"""
+        precisions = (1. / self._prior_variance +
+                      self._parameters[:, 1] / self._noise_variance)
+        means = self._parameters[:, 0] / self._noise_variance / precisions
+        return means, np.sqrt(1. / precisions)
+
+    @property
+    def arm_weights(self):
+        # the probability of each arm to be sampled
+        means, stddevs = self._posterior()
+        chosen_arms = np.argmax(means + self._normal_draws * stddevs, axis=1)
+        return (np.bincount(chosen_arms, minlength=self._num_actions) /
+                len(chosen_arms)).tolist()
+
+    def _sample_values(self, num_samples):
+        means, stddevs = self._posterior()
+        return means + stddevs * np.random.randn(
+            num_samples, self._num_actions)
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        # forget the older rewards, i.e. back to the prior
+        self._parameters *= 1 - self._decay_rate
+        self._parameters[:, 0] += arm_weights * shaped_reward
+        self._parameters[:, 1] += arm_weights
+
+
+class DiscountedUCB(_ArrayBandit):
+    """Discounted UCB, for continuous shaped rewards. The parameters are
+    the discounted sum of the shaped rewards and the discounted number
+    of updates of each arm, discounted by `1 - decay_rate` at each update
+    """
+    selector_type = "DiscountedUCB"
+
+    def __init__(self,
+                 num_actions,
+                 reward_shaping_fn,
+                 exploration=1.0,
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        super(DiscountedUCB, self).__init__(
+            num_actions=num_actions,
+            reward_shaping_fn=reward_shaping_fn,
+            decay_rate=decay_rate,
+            history_size=history_size)
+        self._exploration = exploration
+
+    def _initial_parameters(self):
+        return np.zeros([self._num_actions, 2], dtype=np.float64)
+
+    def _upper_bounds(self):
+        sums, counts = self._parameters[:, 0], self._parameters[:, 1]
+        # arms that have not been updated are chosen first
+        with np.errstate(divide="ignore", invalid="ignore"):
+            upper_bounds = sums / counts + self._exploration * np.sqrt(
+                2. * np.log(max(counts.sum(), 1.)) / counts)
+        upper_bounds[counts == 0.] = np.inf
+        return upper_bounds
+
+    @property
+    def arm_weights(self):
+        # the arms of the largest upper bound, evenly
+        upper_bounds = self._upper_bounds()
+        is_max = (upper_bounds == upper_bounds.max()).astype(np.float64)
+        return (is_max / is_max.sum()).tolist()
+
+    def _sample_values(self, num_samples):
+        # deterministic, the ties are broken at random
+        return np.tile(self._upper_bounds(), [num_samples, 1])
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        self._parameters *= 1 - self._decay_rate
+        self._parameters[:, 0] += arm_weights * shaped_reward
+        self._parameters[:, 1] += arm_weights
+
+
+class SlidingWindowUCB(DiscountedUCB):
+    """UCB over the last `window_size` updates, for continuous shaped
+    rewards. The parameters are the sum of the shaped rewards and the
+    number of updates of each arm in the window, `decay_rate` is unused
+    """
+    selector_type = "SlidingWindowUCB"
+
+    def __init__(self,
+                 num_actions,
+                 reward_shaping_fn,
+                 exploration=1.0,
+                 window_size=50,
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        # the arm weights and the shaped reward of the updates
+        self._window = _RingBuffers(
+            num_buffers=num_actions + 1, capacity=window_size)
+        super(SlidingWindowUCB, self).__init__(
+            num_actions=num_actions,
+            reward_shaping_fn=reward_shaping_fn,
+            exploration=exploration,
+            decay_rate=decay_rate,
+            history_size=history_size)
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        for arm in range(self._num_actions):
+            self._window.append(arm, arm_weights[arm])
+        self._window.append(self._num_actions, shaped_reward)
+
+        # all the buffers have the same length (and order)
+        weights = np.stack([self._window.values(arm)
+                            for arm in range(self._num_actions)], axis=1)
+        rewards = self._window.values(self._num_actions)
+        self._parameters[:, 0] = np.dot(rewards, weights)
+        self._parameters[:, 1] = weights.sum(axis=0)
+
+    def _snapshot_state(self):
+        # the window, as the parameters can't be updated without it
+        return {"window": self._window.get_state()}
+
+    def _restore_state(self, snapshot):
+        if "window" not in snapshot:
+            raise ValueError("The snapshot has no window")
+        self._window.set_state(snapshot["window"])
+
+
+class EXP3Bandit(_ArrayBandit):
+    """EXP3, for shaped rewards in [0, 1]. The parameters are the
+    log-weights and the probabilities of the arms, the weights decay
+    towards the uniform ones by `1 - decay_rate` at each update
+
+    The importance-weighted estimate of the reward needs the one arm
+    that was sampled, thus mixed and block updates (whose shares are
+    about the probabilities) are not supported.
+    """
+    selector_type = "EXP3"
+    single_arm_updates = True
+
+    def __init__(self,
+                 num_actions,
+                 reward_shaping_fn,
+                 exploration_rate=0.1,
+                 decay_rate=0.0,
+                 history_size=REWARD_HISTORY_SIZE):
+        self._exploration_rate = exploration_rate
+        super(EXP3Bandit, self).__init__(
+            num_actions=num_actions,
+            reward_shaping_fn=reward_shaping_fn,
+            decay_rate=decay_rate,
+            history_size=history_size)
+
+    def _initial_parameters(self):
+        parameters = np.zeros([self._num_actions, 2], dtype=np.float64)
+        parameters[:, 1] = 1. / self._num_actions
+        return parameters
+
+    @property
+    def arm_weights(self):
+        return self._parameters[:, 1].tolist()
+
+    def _sample_values(self, num_samples):
+        # the argmax of the Gumbel-perturbed log-probabilities
+        # is distributed as the probabilities
+        return np.log(self._parameters[:, 1]) + np.random.gumbel(
+            size=[num_samples, self._num_actions])
+
+    def _check_shaped_reward(self, shaped_reward):
+        if not 0.0 <= shaped_reward <= 1.0:
+            raise ValueError("`shaped_reward` should be in [0, 1]")
+
+    def _update_parameters(self, shaped_reward, arm_weights):
+        log_weights = self._parameters[:, 0]
+        probabilities = self._parameters[:, 1]
+        # importance-weighted estimates of the rewards of the arms
+        estimates = arm_weights * shaped_reward / probabilities
+
+        log_weights *= 1 - self._decay_rate
+        log_weights += (self._exploration_rate * estimates /
+                        self._num_actions)
+        log_weights -= log_weights.max()
+
+        weights = np.exp(log_weights)
+        self._parameters[:, 1] = (
+            (1 - self._exploration_rate) * weights / weights.sum() +
+            self._exploration_rate / self._num_actions)
+
+
+# the selectors of `--mixing_ratios AutoMR-[selector_type]`,
+# and the reward shaping function of each one
+SELECTORS = {
+    "BernoulliTS": (BernoulliBanditTS, _binary_prediction_gain_v3),
+    "GaussianTS": (GaussianBanditTS, _safe_standardization),
+    "DiscountedUCB": (DiscountedUCB, _safe_standardization),
+    "SlidingWindowUCB": (SlidingWindowUCB, _safe_standardization),
+    "EXP3": (EXP3Bandit, _squashed_standardization),
+}
+
+
+def create_selector(selector_type, num_actions, **kargs):
+    """Create the selector of `selector_type`, with its reward shaping
+    function, `kargs` are passed to the selector"""
+    if selector_type not in SELECTORS:
+        raise ValueError("Unknown selector %s, expected one of %s" % (
+            selector_type, sorted(SELECTORS.keys())))
+
+    Selector, reward_shaping_fn = SELECTORS[selector_type]
+    return Selector(num_actions=num_actions,
+                    reward_shaping_fn=reward_shaping_fn,
+                    **kargs)
+
+
+def restore_selector(file_dir, num_actions):
+    """Load the selector saved in `file_dir`, of the type in its snapshot"""
+    selector_type = DEFAULT_SELECTOR
+    snapshot_file = file_dir + SELECTOR_SNAPSHOT_SUFFIX
+    if os.path.exists(snapshot_file):
+        with open(snapshot_file) as f:
+            selector_type = json.load(f).get(
+                "selector_type", DEFAULT_SELECTOR)
+
+    selector = create_selector(selector_type, num_actions)
+    selector.load(file_dir)
+    return selector
@@ -3,18 +3,31 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import time
 import collections
-import pandas as pd
+import numpy as np
 import tensorflow as tf
 
 from multitask import modules
 import modules
 from multitask import base_model
+from multitask import results_writer
 from constants import (RESULTS_CSV_FNAME,
                        MAX_CHECKPOINTS_TO_KEEP)
 
+# checkpoints written by the `AsyncCheckpointWriter`, the
+# best ones are kept in a sub-directory such that they do
+# not rotate out the regular ones (and vice versa)
+ASYNC_CKPT_FNAME = "model.ckpt"
+ASYNC_BEST_CKPT_DIR = "best_ckpt"
+# the results streamed by `results_writer.StreamingResultsWriter`
+RESULTS_DIRNAME = "results"
+
 tf.logging.set_verbosity(tf.logging.INFO)
 
+# tasks without `sequence_2`
+SINGLE_STREAM_TASKS = ["CoLA", "SST"]
+
 
 def _check_list_compatability(l, num_models):
     if not isinstance(l, (list, tuple)):
@@ -61,20 +74,65 @@ def _mr_compatible(mixing_ratios, num_models, print_out=True):
         print("checked mixing_ratios = %s" % mixing_ratios)
 
 
-def _write_results_to_csv(all_logits,
-                          all_predictions,
-                          all_fetched_data,
-                          output_dir):
+def _pad_and_concat(tensors):
+    """Pad [batch_size, length, depth] tensors to the
+    same length, and concatenate them along the batch"""
+    max_length = tf.reduce_max([tf.shape(t)[1] for t in tensors])
+    padded_tensors = [
+        tf.pad(t, [[0, 0], [0, max_length - tf.shape(t)[1]], [0, 0]])
+        for t in tensors]
+
+    outputs = tf.concat(padded_tensors, axis=0)
+    # non-constant paddings drop the static depth
+    outputs.set_shape([None, None, tensors[0].shape[-1]])
+    return outputs
+
+
+def _pad_and_concat_arrays(arrays):
+    """Pad arrays to the same shape (except the first axis)
+    with zeros, and concatenate them along the first axis"""
+    shape = np.max([a.shape for a in arrays], axis=0)
+    return np.concatenate([
+        np.pad(a, [(0, 0)] + [(0, s - d) for s, d in zip(
+            shape[1:], a.shape[1:])], "constant")
+        for a in arrays])
+
+
+class _ArrayAccumulator(object):
+    """Concatenates batches along the first axis into a
+    preallocated buffer, which doubles when full"""
+
+    def __init__(self, dtype, initial_capacity=1024):
+        self._dtype = dtype
+        self._initial_capacity = initial_capacity
+        self._buffer = None
+        self._size = 0
+
+    def append(self, batch):
+        batch = np.asarray(batch, dtype=self._dtype)
+        if self._buffer is None:
+            self._buffer = np.empty(
+                (max(self._initial_capacity, len(batch)),) + batch.shape[1:],
+                dtype=self._dtype)
+
+        if self._size + len(batch) > len(self._buffer):
+            capacity = max(2 * len(self._buffer), self._size + len(batch))
+            buffer = np.empty((capacity,) + self._buffer.shape[1:],
+                              dtype=self._dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+
+        self._buffer[self._size: self._size + len(batch)] = batch
+        self._size += len(batch)
 
-    results_df = pd.DataFrame(
-        columns=["Logits", "Predictions", "Seq1", "Seq2", "Target"])
-    results_df["Logits"] = all_logits
-    results_df["Predictions"] = all_predictions
-    # results_df["Seq1"] = all_fetched_data["seq_1"]
-    # results_df["Seq2"] = all_fetched_data["seq_2"]
-    # results_df["Target"] = all_fetched_data["target"]
-    results_df.to_csv(output_dir)
-    print("Wrote the results to %s" % output_dir)
+    @property
+    def values(self):
+        if self._buffer is None:
+            return np.empty((0,), dtype=self._dtype)
+        return self._buffer[:self._size]
+
+    def __len__(self):
+        return self._size
 
 
 class MultitaskBaseModel(base_model.BaseModel):
@@ -97,15 +155,51 @@ class MultitaskBaseModel(base_model.BaseModel):
                  optimizer="Adam",
                  learning_rate=0.001,
                  gradient_clipping_norm=2.0,
+                 shared_optimizer=False,
+                 mixed_batch_size=None,
+                 fuse_dual_stream=False,
                  # misc
                  graph=None,
                  logdir=None,
                  main_model_index=0,
-                 debug_mode=False):
+                 debug_mode=False,
+                 eval_data=None,
+                 checkpoint_writer=None,
+                 session_config=None,
+                 random_seed=None,
+                 proxy_eval=False):
         """
         Classification model that does the mapping of
 
             f: Seq_1 x Seq_2 --> Class
+
+        When `eval_data` is given (built in the same graph), an evaluation
+        sub-graph sharing the variables with the training graph is built,
+        such that evaluation runs directly on the live weights.
+
+        When `checkpoint_writer` is given, checkpoints are written
+        by the `AsyncCheckpointWriter` in the background.
+
+        When `shared_optimizer` is True, the task losses are routed
+        through a single optimizer instance, instead of one per task,
+        thus the shared variables have one set of optimizer slots.
+
+        When `mixed_batch_size` is given, a mixed-task training step is
+        built as well, where `mixed_batch_size` examples are drawn from
+        the tasks according to the mixing ratios, and trained on in a
+        single `session.run` (see `train_mixed`).
+
+        When `fuse_dual_stream` is True and the two encoders are the
+        same object, both sequences are encoded in one RNN invocation.
+
+        When `session_config` is given (e.g. a thread budget), the session
+        is created with it, and `random_seed` seeds the random state of the
+        model, instead of the global one, e.g. for several models trained
+        concurrently in one process.
+
+        When `proxy_eval` is True (requires `eval_data`), the main model
+        is also built on a fixed subset of `eval_data` held in host memory
+        (see `initialize_proxy_eval`), which is evaluated in a single run.
         """
         
         super(MultitaskBaseModel, self).__init__(
@@ -114,6 +208,8 @@ class MultitaskBaseModel(base_model.BaseModel):
 
         num_models = len(names)
         _check_list_compatability(data, num_models)
+        if eval_data is not None:
+            _check_list_compatability(eval_data, num_models)
         _check_fn_list_compatability(embedding_fns, num_models, True)
         _check_fn_list_compatability(encoder_fns_1, num_models, True)
         _check_fn_list_compatability(encoder_fns_2, num_models, True)
@@ -129,6 +225,7 @@ class MultitaskBaseModel(base_model.BaseModel):
 
         self._names = names
         self._data = data
+        self._eval_data = eval_data
         self._embedding_fns = embedding_fns
         self._encoder_fns_1 = encoder_fns_1
         self._encoder_fns_2 = encoder_fns_2
@@ -146,14 +243,38 @@ class MultitaskBaseModel(base_model.BaseModel):
         self._optimizer = optimizer
         self._learning_rate = learning_rate
         self._gradient_clipping_norm = gradient_clipping_norm
+        self._shared_optimizer = shared_optimizer
+        self._mixed_batch_size = mixed_batch_size
+        self._fuse_dual_stream = fuse_dual_stream
 
         self._main_model_index = main_model_index
         self._debug = collections.defaultdict(list)
         self._debug_mode = debug_mode
+        self._checkpoint_writer = checkpoint_writer
+        self._session_config = session_config
+        self._proxy_eval = proxy_eval
+        if proxy_eval and eval_data is None:
+            raise ValueError("`proxy_eval` requires `eval_data`")
+        self._random_seed = random_seed
+        self._random_state = (
+            np.random.RandomState(random_seed)
+            if random_seed is not None else np.random)
+
+        # throughput statistics
+        self._num_train_examples = 0
+        self._train_seconds = 0.0
 
     def _check_compatability(self):
         pass
 
+    def build(self):
+        super(MultitaskBaseModel, self).build()
+        if self._session_config is not None:
+            # replace the session created with the default config
+            self._sess.close()
+            self._sess = tf.Session(
+                graph=self._graph, config=self._session_config)
+
     def _build(self):
         # build models
         (logits_collections,
@@ -166,9 +287,17 @@ class MultitaskBaseModel(base_model.BaseModel):
         # build optimization and Ops
         train_op_collections = []
         summary_op_collections = []
+        batch_size_collections = []
         global_step_tensor = (  # common global step
             tf.train.get_or_create_global_step(graph=self._graph))
 
+        optimizer = None
+        if self._shared_optimizer:
+            # the slots are created on the first `apply_gradients`,
+            # and reused by the following tasks' train_ops
+            optimizer = tf.contrib.layers.OPTIMIZER_CLS_NAMES[
+                self._optimizer](learning_rate=self._learning_rate)
+
         for model_idx in range(self.num_models):
 
             loss = loss_collections[model_idx]
@@ -179,7 +308,8 @@ class MultitaskBaseModel(base_model.BaseModel):
                 train_op = self._build_optimizer(
                     loss, global_step_tensor,
                     update_variables=update_variables,
-                    name=self._names[model_idx])
+                    name=self._names[model_idx],
+                    optimizer=optimizer)
 
                 summary_op = tf.summary.merge(
                     inputs=summaries,
@@ -188,27 +318,119 @@ class MultitaskBaseModel(base_model.BaseModel):
                 train_op_collections.append(train_op)
                 summary_op_collections.append(summary_op)
 
+            batch_size_collections.append(
+                tf.shape(self._data[model_idx].target)[0])
+
         self._logits_collections = logits_collections
         self._predictions_collections = predictions_collections
         self._step_collections = step_collections
         self._loss_collections = loss_collections
         self._train_op_collections = train_op_collections
         self._summary_op_collections = summary_op_collections
+        self._batch_size_collections = batch_size_collections
         # a tensor
         self._global_step_tensor = global_step_tensor
 
+        # build the mixed-task training step
+        if self._mixed_batch_size is not None:
+            (self._mixed_sub_batch_sizes,
+             self._mixed_actual_sub_batch_sizes,
+             self._mixed_loss) = self._build_mixed_model()
+            # the number of queued examples of each task
+            self._mixed_queue_sizes = np.zeros(
+                [self.num_models], dtype=np.int64)
+
+            with tf.variable_scope("Opt_Mixed"):
+                self._mixed_train_op = self._build_optimizer(
+                    self._mixed_loss, global_step_tensor,
+                    update_variables=update_variables,
+                    name="Mixed",
+                    optimizer=optimizer)
+
+        # build the evaluation sub-graph sharing the variables
+        if self._eval_data is not None:
+            (self._eval_logits_collections,
+             self._eval_predictions_collections) = self._build_eval_models()
+
+        # build the evaluation on a fixed subset of `eval_data`
+        if self._proxy_eval:
+            (self._proxy_placeholders,
+             self._proxy_initializer,
+             self._proxy_target,
+             self._proxy_predictions) = self._build_proxy_eval_model()
+
 
     def _build_models(self):
         """building MultiTask Models"""
         raise NotImplementedError
 
+    def _build_proxy_eval_model(self):
+        """The main model on variables holding a subset of its `eval_data`
+
+        The variables are in no collection, thus they are neither
+        initialized with the others nor saved, and are initialized
+        from the placeholders by `initialize_proxy_eval`.
+        """
+        model_idx = self._main_model_index
+        data = self._eval_data[model_idx]
+        placeholders = collections.OrderedDict()
+        proxy_fields = {}
+        initializers = []
+        # pinned in host memory, as the data pipeline outputs
+        with tf.device("/cpu:0"):
+            for field, tensor in data._asdict().items():
+                if not isinstance(tensor, tf.Tensor):
+                    # e.g. the initializer
+                    continue
+
+                placeholder = tf.placeholder(
+                    tensor.dtype, shape=tensor.shape)
+                variable = tf.Variable(
+                    placeholder, trainable=False,
+                    collections=[], validate_shape=False,
+                    name="ProxyEvalData_%s" % field)
+                value = tf.identity(variable)
+                value.set_shape(tensor.shape)
+
+                placeholders[field] = placeholder
+                proxy_fields[field] = value
+                initializers.append(variable.initializer)
+
+        proxy_data = data._replace(**proxy_fields)
+        with tf.variable_scope("ProxyEvalModel_%s" % self._names[model_idx]):
+            (_,
+             predictions,
+             _) = self._build_single_model(
+                task_name=self._names[model_idx],
+                data=proxy_data,
+                embedding_fn=self._embedding_fns[model_idx],
+                encoder_fn_1=self._encoder_fns_1[model_idx],
+                encoder_fn_2=self._encoder_fns_2[model_idx],
+                logits_fn=self._logits_fns[model_idx],
+                is_training=False)
+
+        return (placeholders,
+                tf.group(*initializers),
+                proxy_data.target,
+                predictions)
+
+    def _build_eval_models(self):
+        """building MultiTask Models on `eval_data` with shared variables"""
+        raise NotImplementedError
+
+    def _build_mixed_model(self):
+        """building the mixed-task model, returns the sub-batch sizes
+        placeholder, the actual sub-batch sizes and the loss"""
+        raise NotImplementedError
+
     def _build_single_model(self,
                             task_name,
                             data,
                             embedding_fn,
                             encoder_fn_1,
                             encoder_fn_2,
-                            logits_fn):
+                            logits_fn,
+                            is_training=None):
 
         """building Individual Models"""
         raise NotImplementedError
@@ -217,25 +439,35 @@ class MultitaskBaseModel(base_model.BaseModel):
                          loss,
                          global_step_tensor,
                          update_variables,
-                         name):
+                         name,
+                         optimizer=None):
         # Add the optimizer.
         # ------------------------------------------------------
+        summaries = ["loss", "learning_rate", "global_gradient_norm"]
+        learning_rate = self._learning_rate
+        if optimizer is None:
+            optimizer = self._optimizer
+        else:
+            # the learning rate is owned by the optimizer instance
+            summaries = ["loss", "global_gradient_norm"]
+            learning_rate = None
+
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
             train_op = tf.contrib.layers.optimize_loss(
                 loss=loss,
                 global_step=global_step_tensor,
-                learning_rate=self._learning_rate,
-                optimizer=self._optimizer,
+                learning_rate=learning_rate,
+                optimizer=optimizer,
                 # some gradient clipping stabilizes training in the beginning.
                 clip_gradients=self._gradient_clipping_norm,
                 # name="OptimizeLoss_%s" % name,
                 variables=update_variables,
-                summaries=["loss", "learning_rate", "global_gradient_norm"])
+                summaries=summaries)
 
         return train_op
 
-    def initialize_data_iterator(self, model_idx=None):
+    def initialize_data_iterator(self, model_idx=None, eval_data=False):
         """
         Initialize data generators. This function assumes the
         wrapped model to have `._data` field.
@@ -243,6 +475,7 @@ class MultitaskBaseModel(base_model.BaseModel):
         Args:
             model_idx: the index of the model to be initialized.
                        Set to None to initialize all models
+            eval_data: whether to initialize `._eval_data` instead
         """
         if model_idx and not isinstance(model_idx, (list, tuple)):
             raise TypeError("`model_idx` must be list-like structure")
@@ -253,10 +486,15 @@ class MultitaskBaseModel(base_model.BaseModel):
             model_idx if model_idx is not None
             else range(self.num_models))
 
+        data = self._eval_data if eval_data else self._data
         for idx in model_indices:
             try:
                 print("Initializing %d data" % idx)
-                self._sess.run(self._data[idx].initializer)
+                self._sess.run(data[idx].initializer)
+                if self.mixed_training and not eval_data:
+                    # drop the examples queued from the previous one
+                    self._sess.run(self._mixed_clear_ops[idx])
+                    self._mixed_queue_sizes[idx] = 0
             except AttributeError:
                 # wraps the error with more informative message
                 raise AttributeError("Model #%d has no `_data` attribute")
@@ -270,12 +508,12 @@ class MultitaskBaseModel(base_model.BaseModel):
 
         Returns:
             fetched_predictions:
-                list: [batch size]
+                np.ndarray: [batch size]
                 outputs of model predictions
 
             fetched_data: fetched data
-                tuple: [source_1, source_2, target]
-                each of which is a list: [batch_size]
+                dict: {target}
+                each of which is a np.ndarray: [batch_size]
                 input data that makes the predictions
         """
         if data is not None:
@@ -285,18 +523,13 @@ class MultitaskBaseModel(base_model.BaseModel):
              fetched_predictions) = self._sess.run(
                 [data.target, logits, predictions])
 
-            fetched_logits = fetched_logits.tolist()
-            fetched_predictions = fetched_predictions.tolist()
-            fetched_data = {"target": fetched_target.tolist()}
+            fetched_data = {"target": fetched_target}
 
         else:
             fetched_data = None
             (fetched_logits,
              fetched_predictions) = self._sess.run(
                 [logits, predictions])
-            
-            fetched_logits = fetched_logits.tolist()
-            fetched_predictions = fetched_predictions.tolist()
 
         return fetched_logits, fetched_predictions, fetched_data
 
@@ -306,7 +539,8 @@ class MultitaskBaseModel(base_model.BaseModel):
                   data, evaluation_fn,
                   max_eval_batches=None,
                   calculate_scores=True,
-                  write_results=False):
+                  write_results=False,
+                  export_csv=False):
         """Sample from model predictions, and evaluate outputs
 
         Args:
@@ -327,7 +561,12 @@ class MultitaskBaseModel(base_model.BaseModel):
 
             write_results:
                 Bool
-                Whether to write results to csv file for diagnosis
+                Whether to stream the results to `RESULTS_DIRNAME`
+                for diagnosis, as they are produced
+
+            export_csv:
+                Bool
+                Whether to also export the written results to csv
 
         Returns:
             counts:
@@ -340,12 +579,15 @@ class MultitaskBaseModel(base_model.BaseModel):
         """
         # counting the evaluation batches
         num_eval_batches = 0
-        # logits and predictions from the model
-        all_logits = []
-        all_predictions = []
+        num_predictions = 0
+        # predictions from the model, only kept for the scores
+        all_predictions = _ArrayAccumulator(np.int64)
         # fetched data that led to the predictions
-        # dictionary of {seq_1: [], seq_2: [], target: []}
-        all_fetched_data = collections.defaultdict(list)
+        all_targets = _ArrayAccumulator(np.int64)
+        writer = None
+        if write_results:
+            writer = results_writer.StreamingResultsWriter(
+                os.path.join(self._logdir, RESULTS_DIRNAME))
         try:
             while True:
                 # sample predictions
@@ -355,9 +597,15 @@ class MultitaskBaseModel(base_model.BaseModel):
                     logits=logits, predictions=predictions, data=data)
 
                 # Cache the data
-                all_logits += fetched_logits
-                all_predictions += fetched_predictions
-                all_fetched_data["target"] += fetched_data["target"]
+                num_predictions += len(fetched_predictions)
+                if calculate_scores:
+                    all_predictions.append(fetched_predictions)
+                    all_targets.append(fetched_data["target"])
+
+                if writer is not None:
+                    writer.write(logits=fetched_logits,
+                                 predictions=fetched_predictions,
+                                 target=fetched_data["target"])
 
                 # break the loop if max_eval_batches is set
                 num_eval_batches += 1
@@ -368,24 +616,119 @@ class MultitaskBaseModel(base_model.BaseModel):
         except tf.errors.OutOfRangeError:
             pass
 
+        # dictionary of {seq_1: [], seq_2: [], target: []}
+        all_fetched_data = collections.defaultdict(list)
+        all_fetched_data["target"] = all_targets.values
+
         # Evaluate
         scores = None
         if calculate_scores:
             scores = evaluation_fn(
-                all_predictions,
+                all_predictions.values,
                 all_fetched_data["seq_1"],  # Should be empty
                 all_fetched_data["seq_2"],  # Should be empty
                 all_fetched_data["target"])
 
-        if write_results:
-            _write_results_to_csv(
-                all_logits,
-                all_predictions,
-                all_fetched_data,
-                output_dir=os.path.join(
-                    self._logdir, RESULTS_CSV_FNAME))
+        if writer is not None:
+            writer.close()
+            if export_csv:
+                results_writer.export_csv(
+                    os.path.join(self._logdir, RESULTS_DIRNAME),
+                    csv_file=os.path.join(self._logdir, RESULTS_CSV_FNAME))
+
+        return num_predictions, scores
+
+    @property
+    def checkpoint_writer(self):
+        return self._checkpoint_writer
+
+    def _async_save(self, save_path):
+        with self._graph.as_default():
+            variables = tf.global_variables()
+        return self._checkpoint_writer.save(
+            sess=self._sess,
+            variables=variables,
+            save_path=save_path,
+            global_step=self.global_step)
+
+    def save_session(self):
+        if self._checkpoint_writer is None:
+            return super(MultitaskBaseModel, self).save_session()
+
+        return self._async_save(os.path.join(
+            self._logdir, ASYNC_CKPT_FNAME))
+
+    def save_best_session(self):
+        if self._checkpoint_writer is None:
+            return super(MultitaskBaseModel, self).save_best_session()
+
+        return self._async_save(os.path.join(
+            self._logdir, ASYNC_BEST_CKPT_DIR, ASYNC_CKPT_FNAME))
+
+    def save_snapshot(self, save_path):
+        """Save all the variables, including the optimizer slots
+        and the global step, e.g. to resume a stage-2 candidate"""
+        if self._checkpoint_writer is None:
+            raise ValueError("`save_snapshot` requires `checkpoint_writer`")
+
+        return self._async_save(save_path)
+
+    def restore_snapshot(self, ckpt_file):
+        """Restore a checkpoint of `save_snapshot` into the live variables,
+        without adding ops to the (finalized) graph"""
+        if self._checkpoint_writer is not None:
+            # the checkpoint might still be pending
+            self._checkpoint_writer.flush()
+
+        reader = tf.train.load_checkpoint(ckpt_file)
+        with self._graph.as_default():
+            names = [v.op.name for v in tf.global_variables()]
+        self.load_variables(collections.OrderedDict(
+            (name, reader.get_tensor(name))
+            for name in names if reader.has_tensor(name)))
+
+    def snapshot_variables(self):
+        """Returns the values of all the variables, by name"""
+        with self._graph.as_default():
+            variables = tf.global_variables()
+        values = self._sess.run(variables)
+        return collections.OrderedDict(
+            (variable.op.name, value)
+            for variable, value in zip(variables, values))
+
+    def load_variables(self, values):
+        """Load the values of `snapshot_variables` (or a subset of
+        them) into the live variables, without adding ops"""
+        with self._graph.as_default():
+            variables = tf.global_variables()
+        for variable in variables:
+            if variable.op.name in values:
+                variable.load(values[variable.op.name], self._sess)
 
-        return len(all_predictions), scores
+        self._step_collections["GlobalStep"] = (
+            self._sess.run(self._global_step_tensor))
+
+    def reset_training_state(self):
+        """Reset the per-task step counters, the throughput statistics
+        and the random state of the model (the global one is left to the
+        caller), e.g. between trials trained on reloaded variables"""
+        for name in self._step_collections:
+            if name != "GlobalStep":
+                self._step_collections[name] = 0
+
+        self._num_train_examples = 0
+        self._train_seconds = 0.0
+        if self._random_seed is not None:
+            self._random_state = np.random.RandomState(self._random_seed)
+
+    def set_mixing_ratios(self, mixing_ratios):
+        _mr_compatible(mixing_ratios, self.num_models, print_out=False)
+        self._mixing_ratios = mixing_ratios
+
+    def set_logdir(self, logdir):
+        """Change where the checkpoints and the results are
+        written, e.g. one directory per stage-2 trial"""
+        self._logdir = logdir
 
     def _get_global_step(self):
         return self._step_collections["GlobalStep"]
@@ -434,7 +777,19 @@ class MultitaskBaseModel(base_model.BaseModel):
 
         return task
 
+    @property
+    def mixed_training(self):
+        return self._mixed_batch_size is not None
+
+    @property
+    def examples_per_second(self):
+        return self._num_train_examples / max(self._train_seconds, 1e-6)
+
     def train(self, model_idx=None, print_message=False):
+        if model_idx is None and self.mixed_training:
+            return self.train_mixed(print_message=print_message)
+
+        start_time = time.time()
         model_idx = model_idx if model_idx is not None else self._task_selector(self.global_step)
         model_name = "%s-%d" % (self._names[model_idx], model_idx)
 
@@ -443,7 +798,8 @@ class MultitaskBaseModel(base_model.BaseModel):
         fetches = {
             "GlobalStep": self._global_step_tensor,
             "Loss": self._loss_collections[model_idx],
-            "TrainOp": self._train_op_collections[model_idx]}
+            "TrainOp": self._train_op_collections[model_idx],
+            "BatchSize": self._batch_size_collections[model_idx]}
 
         fetched = self._sess.run(fetches=fetches)
         loss = fetched["Loss"]
@@ -454,28 +810,146 @@ class MultitaskBaseModel(base_model.BaseModel):
         # update steps
         self._step_collections[model_name] += 1
         self._step_collections["GlobalStep"] = global_step
+        self._num_train_examples += fetched["BatchSize"]
+        self._train_seconds += time.time() - start_time
 
         # and print info
         message = self._format_message()
 
         return loss, message
 
+    def train_mixed(self, mixing_ratios=None, print_message=False):
+        """Train on several tasks in one step
+
+        The sub-batch sizes are drawn from a multinomial distribution
+        with probabilities proportional to the mixing ratios, and the
+        loss is the mean cross entropy over the concatenated batch, i.e.
+        the per-task losses weighted by their share of the batch. The
+        examples left over by a sub-batch are queued for the next steps.
+
+        Args:
+            mixing_ratios: list of non-negative numbers, one per task.
+                Defaults to the mixing ratios of the model, or uniform
+        """
+        if not self.mixed_training:
+            raise ValueError("Model is built without `mixed_batch_size`")
+
+        start_time = time.time()
+        if mixing_ratios is None:
+            mixing_ratios = self._mixing_ratios
+        if mixing_ratios is None:
+            mixing_ratios = [1] * self.num_models
+
+        sub_batch_sizes = self._draw_sub_batch_sizes(mixing_ratios)
+
+        # TRAIN ONE STEP
+        # ------------------------------------------
+        fetches = {
+            "GlobalStep": self._global_step_tensor,
+            "Loss": self._mixed_loss,
+            "TrainOp": self._mixed_train_op,
+            "SubBatchSizes": self._mixed_actual_sub_batch_sizes}
+
+        fetched = self._sess.run(
+            fetches=fetches,
+            feed_dict={self._mixed_sub_batch_sizes: sub_batch_sizes})
+        loss = fetched["Loss"]
+        global_step = fetched["GlobalStep"]
+        self._mixed_queue_sizes -= fetched["SubBatchSizes"]
+
+        # Update Statistics
+        # ------------------------------------------
+        for model_idx, size in enumerate(fetched["SubBatchSizes"]):
+            if size > 0:
+                model_name = "%s-%d" % (self._names[model_idx], model_idx)
+                self._step_collections[model_name] += 1
+        self._step_collections["GlobalStep"] = global_step
+        self._num_train_examples += np.sum(fetched["SubBatchSizes"])
+        self._train_seconds += time.time() - start_time
+
+        message = self._format_message()
+
+        return loss, message
+
+    def _draw_sub_batch_sizes(self, mixing_ratios):
+        """Draw the sub-batch sizes of a mixed step, and read the
+        batches of the pipelines the sub-batches need"""
+        probabilities = np.asarray(mixing_ratios, dtype=np.float64)
+        probabilities = probabilities / probabilities.sum()
+        sub_batch_sizes = self._random_state.multinomial(
+            self._mixed_batch_size, probabilities)
+        for model_idx, size in enumerate(sub_batch_sizes):
+            while self._mixed_queue_sizes[model_idx] < size:
+                self._mixed_queue_sizes[model_idx] += self._sess.run(
+                    self._mixed_enqueue_ops[model_idx])
+
+        return sub_batch_sizes
+
+    def skip_steps(self, num_steps, first_step=None):
+        """Read (and drop) the data of `num_steps` training steps in the
+        order `train` reads it, without training, e.g. to resume a model
+        restored from a checkpoint on freshly initialized iterators
+
+        Args:
+            num_steps: the number of steps to skip
+            first_step: the global step of the first skipped step,
+                defaults to the global step of the model
+        """
+        if first_step is None:
+            first_step = self.global_step
+
+        for step in range(first_step, first_step + num_steps):
+            if not self.mixed_training:
+                model_idx = self._task_selector(step)
+                self._sess.run(self._batch_size_collections[model_idx])
+                model_name = "%s-%d" % (self._names[model_idx], model_idx)
+                self._step_collections[model_name] += 1
+                continue
+
+            mixing_ratios = self._mixing_ratios
+            if mixing_ratios is None:
+                mixing_ratios = [1] * self.num_models
+            sub_batch_sizes = self._draw_sub_batch_sizes(mixing_ratios)
+            # only the dequeue of the sub-batches runs
+            actual_sub_batch_sizes = self._sess.run(
+                self._mixed_actual_sub_batch_sizes,
+                feed_dict={self._mixed_sub_batch_sizes: sub_batch_sizes})
+            self._mixed_queue_sizes -= actual_sub_batch_sizes
+            for model_idx, size in enumerate(actual_sub_batch_sizes):
+                if size > 0:
+                    model_name = "%s-%d" % (self._names[model_idx], model_idx)
+                    self._step_collections[model_name] += 1
+
     def evaluate(self, model_idx,
                  max_eval_batches=None,
                  write_results=False,
-                 write_to_summary=True):
-        """Sample from model predictions, and evaluate outputs"""
+                 write_to_summary=True,
+                 eval_data=False):
+        """Sample from model predictions, and evaluate outputs
+
+        When `eval_data` is True, evaluate the shared-variable
+        evaluation sub-graph on `._eval_data` instead
+        """
         
         # write_summary needs global_step
         self._step_collections["GlobalStep"] = (
             self._sess.run(self._global_step_tensor))
 
+        if eval_data:
+            data = self._eval_data
+            logits_collections = self._eval_logits_collections
+            predictions_collections = self._eval_predictions_collections
+        else:
+            data = self._data
+            logits_collections = self._logits_collections
+            predictions_collections = self._predictions_collections
+
         # evaluate the model
         model_name = "%s-%d" % (self._names[model_idx], model_idx)
         counts, scores = self._evaluate(
-            data=self._data[model_idx],
-            logits=self._logits_collections[model_idx],
-            predictions=self._predictions_collections[model_idx],
+            data=data[model_idx],
+            logits=logits_collections[model_idx],
+            predictions=predictions_collections[model_idx],
             evaluation_fn=self._evaluation_fns[model_idx],
             max_eval_batches=max_eval_batches,
             calculate_scores=True,
@@ -488,7 +962,58 @@ class MultitaskBaseModel(base_model.BaseModel):
 
         return {"MAIN": scores}
 
-    def inference(self, model_idx):
+    def initialize_proxy_eval(self, num_examples):
+        """Read the first `num_examples` of the `eval_data` of the main
+        model once, and keep them in the proxy evaluation variables
+
+        Returns:
+            the number of examples in the subset
+        """
+        if not self._proxy_eval:
+            raise ValueError("Model is built without `proxy_eval`")
+
+        data = self._eval_data[self._main_model_index]
+        fetches = dict((field, getattr(data, field))
+                       for field in self._proxy_placeholders.keys())
+        batches = collections.defaultdict(list)
+        size = 0
+        self._sess.run(data.initializer)
+        try:
+            while size < num_examples:
+                fetched = self._sess.run(fetches)
+                for field, value in fetched.items():
+                    batches[field].append(value)
+                size += len(fetched["target"])
+        except tf.errors.OutOfRangeError:
+            pass
+
+        size = min(size, num_examples)
+        self._sess.run(self._proxy_initializer, feed_dict=dict(
+            (placeholder, _pad_and_concat_arrays(batches[field])[:size])
+            for field, placeholder in self._proxy_placeholders.items()))
+
+        return size
+
+    def proxy_evaluate(self, write_to_summary=True):
+        """Evaluate the main model on the subset of
+        `initialize_proxy_eval`, in a single run"""
+        self._step_collections["GlobalStep"] = (
+            self._sess.run(self._global_step_tensor))
+
+        predictions, target = self._sess.run(
+            [self._proxy_predictions, self._proxy_target])
+        model_idx = self._main_model_index
+        scores = self._evaluation_fns[model_idx](
+            predictions, [], [], target)
+
+        if write_to_summary:
+            self.write_summary(
+                "TASK-%s-%d/ProxyValScores" % (
+                    self._names[model_idx], model_idx), scores)
+
+        return {"MAIN": scores}
+
+    def inference(self, model_idx, export_csv=False):
         return self._evaluate(
             data=self._data[model_idx],
             logits=self._logits_collections[model_idx],
@@ -496,15 +1021,44 @@ class MultitaskBaseModel(base_model.BaseModel):
             evaluation_fn=self._evaluation_fns[model_idx],
             max_eval_batches=None,
             calculate_scores=False,
-            write_results=True)
+            write_results=True,
+            export_csv=export_csv)
 
 
     def _format_message(self):
         # print step information
-        message = "#%d" % self.global_step
+        message = "#%d %.1f ex/s" % (
+            self.global_step, self.examples_per_second)
         return message
 
 
+class SharedEvalModel(object):
+    """Evaluation view of a model built with `eval_data`.
+
+    Exposes the interface of a separately built validation model, but
+    evaluates the shared-variable sub-graph of the wrapped (training)
+    model, thus no checkpoint round-trip is needed before evaluation.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def initialize_or_restore_session(self, *args, **kargs):
+        # the variables are shared with the wrapped model
+        pass
+
+    def initialize_data_iterator(self, model_idx=None):
+        return self._model.initialize_data_iterator(
+            model_idx, eval_data=True)
+
+    def evaluate(self, *args, **kargs):
+        return self._model.evaluate(*args, eval_data=True, **kargs)
+
+    @property
+    def global_step(self):
+        return self._model.global_step
+
+
 
 class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
     
@@ -514,10 +1068,15 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
                             embedding_fn,
                             encoder_fn_1,
                             encoder_fn_2,
-                            logits_fn):
+                            logits_fn,
+                            is_training=None):
 
-        """building Individual Models"""
-        if task_name in ["CoLA", "SST"]:
+        """building Individual Models
+
+        `is_training` is passed to the encoders, and overrides
+        the mode they are constructed with when not None
+        """
+        if task_name in SINGLE_STREAM_TASKS:
             _single_model_fn = self._build_single_stream_model
         else:
             _single_model_fn = self._build_dual_stream_model
@@ -527,14 +1086,16 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
             embedding_fn=embedding_fn,
             encoder_fn_1=encoder_fn_1,
             encoder_fn_2=encoder_fn_2,
-            logits_fn=logits_fn)
+            logits_fn=logits_fn,
+            is_training=is_training)
 
     def _build_single_stream_model(self,
                                    data,
                                    embedding_fn,
                                    encoder_fn_1,
                                    encoder_fn_2,
-                                   logits_fn):
+                                   logits_fn,
+                                   is_training=None):
         """BiLSTM with max pooling, but ignore sequence_2"""
         
         # Build the Model
@@ -557,7 +1118,8 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
         if isinstance(encoder_fn_1, modules.LstmEncoder):
             outputs_1, _ = encoder_fn_1(
                 inputs=embedded_tokens_1,
-                sequence_length=data.source_1_sequence_length)
+                sequence_length=data.source_1_sequence_length,
+                is_training=is_training)
 
         if isinstance(encoder_fn_1, modules.TransformerEncoder):
             outputs_1 = encoder_fn_1(
@@ -606,7 +1168,8 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
                                  embedding_fn,
                                  encoder_fn_1,
                                  encoder_fn_2,
-                                 logits_fn):
+                                 logits_fn,
+                                 is_training=None):
         """BiLSTM with max pooling from
             https://arxiv.org/pdf/1705.02364.pdf"""
         # Build the Model
@@ -639,14 +1202,33 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
         # this doesn't allow layer-sharing, but will be supported
         # in the future
 
-        if isinstance(encoder_fn_1, modules.LstmEncoder):
+        if (isinstance(encoder_fn_1, modules.LstmEncoder) and
+                self._fuse_dual_stream and encoder_fn_1 is encoder_fn_2):
+            # stack both sequences along the batch, and
+            # encode them with one RNN invocation
+            outputs, _ = encoder_fn_1(
+                inputs=_pad_and_concat([embedded_tokens_1,
+                                        embedded_tokens_2]),
+                sequence_length=tf.concat(
+                    [data.source_1_sequence_length,
+                     data.source_2_sequence_length], axis=0),
+                is_training=is_training)
+
+            # remove the padding added by the concatenation
+            outputs_1, outputs_2 = tf.split(outputs, 2, axis=0)
+            outputs_1 = outputs_1[:, :tf.shape(embedded_tokens_1)[1]]
+            outputs_2 = outputs_2[:, :tf.shape(embedded_tokens_2)[1]]
+
+        elif isinstance(encoder_fn_1, modules.LstmEncoder):
             outputs_1, _ = encoder_fn_1(
                 inputs=embedded_tokens_1,
-                sequence_length=data.source_1_sequence_length)
+                sequence_length=data.source_1_sequence_length,
+                is_training=is_training)
 
             outputs_2, _ = encoder_fn_2(
                 inputs=embedded_tokens_2,
-                sequence_length=data.source_2_sequence_length)
+                sequence_length=data.source_2_sequence_length,
+                is_training=is_training)
 
         if isinstance(encoder_fn_1, modules.TransformerEncoder):
             outputs_1 = encoder_fn_1(
@@ -705,3 +1287,158 @@ class MultitaskSingleAndDualStreamBaseModel(MultitaskBaseModel):
             _add_to_debug("cross_entropy", cross_entropy)
 
         return logits, predictions, cross_entropy
+
+    def _build_mixed_single_model(self,
+                                  sub_batch_sizes,
+                                  embedding_fn,
+                                  encoder_fn_1,
+                                  encoder_fn_2,
+                                  logits_fns):
+        """Same models as `_build_single_model` on `sub_batch_sizes[i]`
+        examples of each task, but each encoder runs once over the
+        sub-batches of all tasks, padded and concatenated along the batch.
+
+        The examples of each task are queued, and each step dequeues its
+        sub-batch, thus a batch is read from the pipeline of a task only
+        when its queue runs short (see `train_mixed`), and the tasks see
+        all their examples, in order.
+        """
+        if not isinstance(encoder_fn_1, modules.LstmEncoder):
+            raise ValueError("Mixed training only supports `LstmEncoder`")
+
+        # the enqueue of a batch of the pipeline (returning its size),
+        # and the removal of all the queued examples, of each task
+        self._mixed_enqueue_ops = []
+        self._mixed_clear_ops = []
+        actual_sub_batch_sizes = []
+        embedded_tokens_1 = []
+        embedded_tokens_2 = []
+        sequence_lengths_1 = []
+        sequence_lengths_2 = []
+        targets = []
+        for task_idx in range(self.num_models):
+            data = self._data[task_idx]
+            fields = ["target", "source_1", "source_1_sequence_length"]
+            if self._names[task_idx] not in SINGLE_STREAM_TASKS:
+                fields += ["source_2", "source_2_sequence_length"]
+            tensors = [getattr(data, field) for field in fields]
+
+            # a negative capacity is unbounded, but the queue holds at
+            # most a sub-batch and a batch of the pipeline
+            queue = tf.PaddingFIFOQueue(
+                capacity=-1,
+                dtypes=[tensor.dtype for tensor in tensors],
+                shapes=[tensor.shape[1:] for tensor in tensors],
+                name="MixedQueue_%s_%d" % (self._names[task_idx], task_idx))
+            with tf.control_dependencies([queue.enqueue_many(tensors)]):
+                self._mixed_enqueue_ops.append(
+                    tf.identity(tf.shape(data.target)[0]))
+            self._mixed_clear_ops.append(
+                tf.group(*queue.dequeue_many(queue.size())))
+
+            sub_batch = dict(zip(
+                fields, queue.dequeue_many(sub_batch_sizes[task_idx])))
+            actual_sub_batch_sizes.append(tf.shape(sub_batch["target"])[0])
+            targets.append(sub_batch["target"])
+
+            streams = [(sub_batch["source_1"],
+                        sub_batch["source_1_sequence_length"],
+                        embedded_tokens_1,
+                        sequence_lengths_1)]
+            if self._names[task_idx] not in SINGLE_STREAM_TASKS:
+                streams.append((sub_batch["source_2"],
+                                sub_batch["source_2_sequence_length"],
+                                embedded_tokens_2,
+                                sequence_lengths_2))
+
+            for (tokens,
+                 sequence_length,
+                 embedded_tokens,
+                 sequence_lengths) in streams:
+                if isinstance(embedding_fn, (modules.Embeddding,
+                                             modules.CachedElmoModule)):
+                    embedded_tokens.append(embedding_fn(tokens))
+
+                if isinstance(embedding_fn, modules.TFHubElmoEmbedding):
+                    embedded_tokens.append(
+                        embedding_fn(tokens, sequence_length))
+
+                sequence_lengths.append(sequence_length)
+
+        # run the encoders once
+        # ------------------------------------------------------
+        dual_stream_indices = [
+            task_idx for task_idx in range(self.num_models)
+            if self._names[task_idx] not in SINGLE_STREAM_TASKS]
+        dual_stream_sizes = [
+            actual_sub_batch_sizes[i] for i in dual_stream_indices]
+
+        if self._fuse_dual_stream and encoder_fn_1 is encoder_fn_2:
+            # both streams in one call
+            outputs, _ = encoder_fn_1(
+                inputs=_pad_and_concat(embedded_tokens_1 +
+                                       embedded_tokens_2),
+                sequence_length=tf.concat(
+                    sequence_lengths_1 + sequence_lengths_2, axis=0))
+            outputs = tf.split(
+                outputs, actual_sub_batch_sizes + dual_stream_sizes, axis=0)
+            outputs_1 = outputs[:self.num_models]
+            dual_stream_outputs = outputs[self.num_models:]
+
+        else:
+            outputs_1, _ = encoder_fn_1(
+                inputs=_pad_and_concat(embedded_tokens_1),
+                sequence_length=tf.concat(sequence_lengths_1, axis=0))
+            outputs_1 = tf.split(
+                outputs_1, actual_sub_batch_sizes, axis=0)
+
+            dual_stream_outputs = []
+            if dual_stream_indices:
+                dual_stream_outputs, _ = encoder_fn_2(
+                    inputs=_pad_and_concat(embedded_tokens_2),
+                    sequence_length=tf.concat(sequence_lengths_2, axis=0))
+                dual_stream_outputs = tf.split(
+                    dual_stream_outputs, dual_stream_sizes, axis=0)
+
+        outputs_2 = [None] * self.num_models
+        for task_idx, outputs in zip(dual_stream_indices,
+                                     dual_stream_outputs):
+            outputs_2[task_idx] = outputs
+
+        # per-task pooling and classifiers
+        # ------------------------------------------------------
+        cross_entropies = []
+        stream_2_idx = 0
+        for task_idx in range(self.num_models):
+            # remove the padding added by the concatenation,
+            # thus the max-pooling is the same as in the task model
+            u = tf.reduce_max(
+                outputs_1[task_idx][
+                    :, :tf.shape(embedded_tokens_1[task_idx])[1]],
+                axis=1)
+
+            if outputs_2[task_idx] is None:
+                features = u
+            else:
+                v = tf.reduce_max(
+                    outputs_2[task_idx][
+                        :, :tf.shape(embedded_tokens_2[stream_2_idx])[1]],
+                    axis=1)
+                stream_2_idx += 1
+
+                u_mul_v = tf.multiply(u, v)
+                u_min_v = tf.abs(tf.subtract(u, v))
+                features = tf.concat([u, v, u_min_v, u_mul_v], axis=-1)
+
+            logits = logits_fns[task_idx](features)
+            cross_entropies.append(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=targets[task_idx], logits=logits))
+
+        actual_sub_batch_sizes = tf.stack(actual_sub_batch_sizes)
+        cross_entropy = (
+            tf.reduce_sum(tf.concat(cross_entropies, axis=0)) /
+            tf.maximum(tf.to_float(tf.reduce_sum(actual_sub_batch_sizes)),
+                       1.0))
+
+        return actual_sub_batch_sizes, cross_entropy
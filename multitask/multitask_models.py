@@ -1,5 +1,7 @@
 from multitask.hard_sharing_model import MultitaskHardSharingModel
+from multitask.multitask_base_model import SharedEvalModel
 from multitask.multitask_autoMR_model import MTLAutoMRModel
+from multitask.multitask_autoMR_model import DEFAULT_SELECTOR
 
 def is_AutoMR(obj):
 	return isinstance(obj, MTLAutoMRModel)
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import csv
+import json
+import numpy as np
+
+# one raw (row-major, little-endian) file per column,
+# and a json file describing their dtypes and shapes
+META_FNAME = "meta.json"
+COLUMNS = ("logits", "predictions", "target")
+DTYPES = {"logits": "<f4", "predictions": "<i8", "target": "<i8"}
+
+
+def _column_file(output_dir, column):
+    return os.path.join(output_dir, "%s.bin" % column)
+
+
+class StreamingResultsWriter(object):
+    """Writes the inference results batch by batch
+
+    Each column is appended to its own raw binary file as soon as a
+    batch is available, such that the memory does not grow with the
+    size of the data, and the logits are a fixed-width float32 matrix.
+    Use `load_results` to read them back (as memory-maps), and
+    `export_csv` to convert them into the CSV file of previous versions.
+    """
+
+    def __init__(self, output_dir):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        self._output_dir = output_dir
+        self._files = {}
+        self._num_rows = 0
+        self._num_classes = None
+        # remove the meta of a previous run, as the
+        # results are incomplete until `close` is called
+        if os.path.exists(os.path.join(output_dir, META_FNAME)):
+            os.remove(os.path.join(output_dir, META_FNAME))
+
+        for column in COLUMNS:
+            self._files[column] = open(_column_file(output_dir, column), "wb")
+
+    def write(self, logits, predictions, target):
+        logits = np.asarray(logits, dtype=DTYPES["logits"])
+        if self._num_classes is None:
+            self._num_classes = logits.shape[1]
+        if logits.shape[1] != self._num_classes:
+            raise ValueError("Expected %d classes, found %d" % (
+                self._num_classes, logits.shape[1]))
+
+        batch = {"logits": logits,
+                 "predictions": predictions,
+                 "target": target}
+        for column in COLUMNS:
+            np.ascontiguousarray(
+                batch[column], dtype=DTYPES[column]).tofile(
+                    self._files[column])
+
+        self._num_rows += len(logits)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+        meta = {"num_rows": self._num_rows,
+                "num_classes": self._num_classes or 0,
+                "dtypes": DTYPES}
+        with open(os.path.join(self._output_dir, META_FNAME), "w") as f:
+            json.dump(meta, f)
+
+    @property
+    def num_rows(self):
+        return self._num_rows
+
+
+def load_results(output_dir):
+    """Returns a dictionary of memory-mapped columns"""
+    meta_file = os.path.join(output_dir, META_FNAME)
+    if not os.path.exists(meta_file):
+        raise ValueError("%s is missing, the results are incomplete"
+                         % meta_file)
+
+    with open(meta_file) as f:
+        meta = json.load(f)
+
+    results = {}
+    for column in COLUMNS:
+        shape = (meta["num_rows"],)
+        if column == "logits":
+            shape = (meta["num_rows"], meta["num_classes"])
+
+        if not meta["num_rows"]:
+            results[column] = np.empty(shape, dtype=meta["dtypes"][column])
+            continue
+
+        results[column] = np.memmap(
+            _column_file(output_dir, column),
+            dtype=meta["dtypes"][column],
+            mode="r", shape=shape)
+
+    return results
+
+
+def export_csv(output_dir, csv_file, chunk_size=10000):
+    """Export the results in the format of the previous
+    (pandas) CSV dump, without loading all of them at once"""
+    results = load_results(output_dir)
+    num_rows = len(results["predictions"])
+    with open(csv_file, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["", "Logits", "Predictions", "Seq1", "Seq2", "Target"])
+        for start in range(0, num_rows, chunk_size):
+            end = min(start + chunk_size, num_rows)
+            logits = results["logits"][start: end].tolist()
+            predictions = results["predictions"][start: end].tolist()
+            for i in range(end - start):
+                writer.writerow(
+                    [start + i, logits[i], predictions[i], "", "", ""])
+
+    print("Wrote the results to %s" % csv_file)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Export the streamed results to CSV")
+    parser.add_argument("--results_dir", type=str, required=True)
+    parser.add_argument("--csv_file", type=str, required=True)
+    args = parser.parse_args()
+    export_csv(args.results_dir, args.csv_file)
@@ -2,12 +2,15 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import copy
 import argparse
+import contextlib
 import numpy as np
 from tqdm import trange
 import tensorflow as tf
 
 import model_utils
+import elmo_cache_utils
 import hparams as hps_utils
 from multitask import tasks
 from utils import misc_utils
@@ -26,7 +29,7 @@ tf.logging.set_verbosity(tf.logging.INFO)
 # Command Line Arguments
 # ==================================================
 
-def get_hparams():
+def get_hparams(argv=None):
     parser = argparse.ArgumentParser()
 
     # Training
@@ -42,9 +45,32 @@ def get_hparams():
                         type=str, default=None)
     parser.add_argument("--random_seed",
                         type=int, default=None)
+    parser.add_argument("--shared_eval",
+                        action="store_true", default=False)
+    parser.add_argument("--steps_per_ckpt",
+                        type=int, default=None)
+    parser.add_argument("--async_ckpt",
+                        action="store_true", default=False)
+    parser.add_argument("--elmo_cache_backend",
+                        type=str, default=elmo_cache_utils.HDF5_BACKEND,
+                        choices=elmo_cache_utils.BACKENDS)
+    parser.add_argument("--elmo_cache_variant",
+                        type=str, default=None)
+    parser.add_argument("--elmo_prereduced",
+                        action="store_true", default=False)
+    parser.add_argument("--bucket_boundaries",
+                        type=str, default=None)
+    parser.add_argument("--data_num_shards",
+                        type=int, default=None)
+    # append the evaluation scores of the main task,
+    # e.g. for `stage2_search.py` to monitor the trial
+    parser.add_argument("--scores_file",
+                        type=str, default=None)
     # Inference
     parser.add_argument("--infer",
                         action="store_true", default=False)
+    parser.add_argument("--export_results_csv",
+                        action="store_true", default=False)
 
     # -----------------------------------------
     # HYPER-PARAMETERS
@@ -56,6 +82,10 @@ def get_hparams():
                         type=int, default=512)
     parser.add_argument("--num_layers",
                         type=int, default=2)
+    # "lstm_block_fused" is faster on CPU, and can
+    # restore the checkpoints of "lstm" as is
+    parser.add_argument("--lstm_unit_type",
+                        type=str, default="lstm")
     parser.add_argument("--dropout_rate",
                         type=float, default=0.5)
     parser.add_argument("--learning_rate",
@@ -66,14 +96,30 @@ def get_hparams():
                         type=str, default=None)
     parser.add_argument("--mixing_ratios",
                         type=str, default="AutoMR")
+    # set to `Mixed` to train on several tasks in one step
     parser.add_argument("--training_strategy",
                         type=str, default=None)
 
+    parser.add_argument("--shared_optimizer",
+                        action="store_true", default=False)
+    parser.add_argument("--fuse_dual_stream",
+                        action="store_true", default=False)
+
     # AutoMR
     parser.add_argument("--automr_update_rate",
                         type=float, default=0.3)
     parser.add_argument("--automr_reward_scale",
                         type=float, default=1.0)
+    # sample this many tasks after each evaluation, and mix
+    # them over the next `steps_per_eval` steps
+    parser.add_argument("--automr_block_samples",
+                        type=int, default=None)
+    # update the selector every `automr_proxy_steps` steps with the
+    # score on a fixed subset of `automr_proxy_eval_size` examples
+    parser.add_argument("--automr_proxy_eval_size",
+                        type=int, default=None)
+    parser.add_argument("--automr_proxy_steps",
+                        type=int, default=None)
     parser.add_argument("--stage",
                         type=int, default=None)
 
@@ -87,7 +133,7 @@ def get_hparams():
     parser.add_argument("--distill_temperature",
                         type=float, default=1.0)
     # -----------------------------------------
-    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS, unparsed = parser.parse_known_args(argv)
 
     if unparsed:
         raise ValueError(unparsed)
@@ -110,14 +156,26 @@ def _get_hparams(FLAGS):
     train_logfile = _logdir + TRAIN_LOGFILE_SUFFIX
     infer_logfile = _logdir + INFER_LOGFILE_SUFFIX
 
+    if (FLAGS.elmo_prereduced and
+            FLAGS.elmo_cache_backend != elmo_cache_utils.PACKED_BACKEND):
+        raise ValueError("`elmo_prereduced` requires the %s backend" % (
+            elmo_cache_utils.PACKED_BACKEND))
+
+    if FLAGS.automr_proxy_eval_size is not None and not FLAGS.shared_eval:
+        # the subset is evaluated on the live weights
+        raise ValueError("`automr_proxy_eval_size` requires `shared_eval`")
+
+    if FLAGS.async_ckpt and not FLAGS.shared_eval:
+        # the separate val graph restores the checkpoint
+        # right after it is saved
+        raise ValueError("`async_ckpt` requires `shared_eval`")
+
     print("\t\tRunning %d" % FLAGS.stage)
-    if FLAGS.stage == 2:
+    if FLAGS.stage == 2 and isAuto:
+        # each stage-2 trial trains with fixed mixing ratios
         raise ValueError(
-            "To run the stage-2, please follow the instructions"
-            "on https://scikit-optimize.github.io. Other existing "
-            "alternatives include: "
-            "`https://github.com/fmfn/BayesianOptimization` "
-            "`https://github.com/HIPS/Spearmint`.")
+            "The stage-2 trains with fixed `--mixing_ratios`, "
+            "use `stage2_search.py` to search them.")
 
     """A set of basic hyperparameters."""
     return tf.contrib.training.HParams(
@@ -129,6 +187,16 @@ def _get_hparams(FLAGS):
         eval_files=([t.val_data for t in ChosenTasks]
                     if not FLAGS.infer else
                     [t.test_data for t in ChosenTasks]),
+        elmo_cache_backend=FLAGS.elmo_cache_backend,
+        elmo_cache_variant=FLAGS.elmo_cache_variant,
+        elmo_prereduced=FLAGS.elmo_prereduced,
+        # e.g. "10-20-30-50", batches are bucketed by
+        # max(len(sequence_1), len(sequence_2)) when set
+        bucket_boundaries=(
+            [int(b) for b in FLAGS.bucket_boundaries.split("-")]
+            if FLAGS.bucket_boundaries is not None else None),
+        # defaults to `DATA_NUM_PARALLEL_CALLS`
+        data_num_shards=FLAGS.data_num_shards,
         # Batch sizes
         # ---------------------------------
         # just using the main task info
@@ -152,9 +220,22 @@ def _get_hparams(FLAGS):
         numpy_seed=FLAGS.random_seed,
         tensorflow_seed=FLAGS.random_seed,
         train_logfile=train_logfile,
+        scores_file=FLAGS.scores_file,
+        # evaluate on the live weights, instead of restoring
+        # the saved checkpoint into a separate val graph.
+        # checkpoints are then saved on the best-score path
+        # and every `steps_per_ckpt` steps (when set)
+        shared_eval=FLAGS.shared_eval and not FLAGS.infer,
+        steps_per_ckpt=FLAGS.steps_per_ckpt,
+        # write checkpoints, the selector and the manager in
+        # the background, instead of blocking the training loop
+        async_ckpt=FLAGS.async_ckpt and not FLAGS.infer,
         # Inference
         # ---------------------------------
         infer=FLAGS.infer,
+        # the results are streamed to binary files, and
+        # optionally exported to CSV after inference
+        export_results_csv=FLAGS.export_results_csv,
         infer_logfile=infer_logfile,
         # Misc
         # ---------------------------------
@@ -164,12 +245,17 @@ def _get_hparams(FLAGS):
         embedding_dim=FLAGS.embedding_dim,
         num_units=FLAGS.num_units,
         num_layers=FLAGS.num_layers,
+        lstm_unit_type=FLAGS.lstm_unit_type,
         dropout_rate=FLAGS.dropout_rate,
         learning_rate=FLAGS.learning_rate,
 
         # Multi-Task
         # ---------------------------------
         training_strategy=FLAGS.training_strategy,
+        # one optimizer (and one set of slots) for all tasks
+        shared_optimizer=FLAGS.shared_optimizer,
+        # encode both sequences of a pair in one RNN invocation
+        fuse_dual_stream=FLAGS.fuse_dual_stream,
         embedding_type=FLAGS.model_type.split("-")[0],
         base_model_type=FLAGS.model_type.split("-")[1],
         multitask_model_type=FLAGS.model_type.split("-")[2],
@@ -182,6 +268,14 @@ def _get_hparams(FLAGS):
         # ---------------------------------
         automr_update_rate=FLAGS.automr_update_rate,
         automr_reward_scale=FLAGS.automr_reward_scale,
+        automr_block_samples=FLAGS.automr_block_samples,
+        automr_proxy_eval_size=FLAGS.automr_proxy_eval_size,
+        automr_proxy_steps=(
+            FLAGS.automr_proxy_steps
+            if FLAGS.automr_proxy_steps is not None
+            else (FLAGS.steps_per_eval
+                  if FLAGS.steps_per_eval is not None
+                  else MainTask.steps_per_eval)),
         is_distill=FLAGS.is_distill,
         loss_coefficient_loc=FLAGS.loss_coefficient_loc,
         loss_coefficient_scale=FLAGS.loss_coefficient_scale,
@@ -190,6 +284,18 @@ def _get_hparams(FLAGS):
 
 
 
+def build_manager(hparams, logdir):
+    # early stop on the **target** task
+    eval_task = hparams.tasks[hparams.eval_model_index]
+    return training_manager.TrainingManager(
+        name=eval_task.name,
+        logdir=logdir,
+        stopping_fn=eval_task.manager_stopping_fn(
+            tolerance=EARLY_STOP_TOLERANCE),
+        updating_fn=eval_task.manager_updating_fn(),
+        load_when_possible=False)
+
+
 def trainMTL(hparams):
 
     # Build Models and Data
@@ -199,15 +305,7 @@ def trainMTL(hparams):
 
     # building training monitor
     # ------------------------------------------
-    # early stop on the **target** task
-    eval_task = hparams.tasks[hparams.eval_model_index]
-    manager = training_manager.TrainingManager(
-        name=eval_task.name,
-        logdir=hparams.manager_logdir,
-        stopping_fn=eval_task.manager_stopping_fn(
-            tolerance=EARLY_STOP_TOLERANCE),
-        updating_fn=eval_task.manager_updating_fn(),
-        load_when_possible=False)
+    manager = build_manager(hparams, logdir=hparams.manager_logdir)
 
     scores_dict = _train(
         hparams=hparams,
@@ -224,14 +322,54 @@ def trainMTL(hparams):
     print("FINISHED")
 
 
-def _train(hparams, manager, train_MTL_model, val_MTL_model):
+def _suppress_stdout(suppress_stdout):
+    """`misc_utils.suppress_stdout`, or nothing, e.g. in the threads of
+    `trial_pool.py`, which must not swap the shared `sys.stdout`"""
+    if suppress_stdout:
+        return misc_utils.suppress_stdout()
+    return contextlib.ExitStack()
+
+
+def _train(hparams, manager, train_MTL_model, val_MTL_model,
+           suppress_stdout=True):
     # initialize *all* data generator
     # ------------------------------------------
     train_MTL_model.initialize_or_restore_session(
         ckpt_file=hparams.ckpt_file,
         var_filter_fn=lambda name: "Adam" not in name and "clone" not in name)
     train_MTL_model.initialize_data_iterator(model_idx=None)
+    if (multitask_models.is_AutoMR(train_MTL_model) and
+            hparams.automr_proxy_eval_size is not None):
+        proxy_size = train_MTL_model.initialize_proxy_eval(
+            hparams.automr_proxy_eval_size)
+        tf.logging.info("Proxy evaluation on %d examples" % proxy_size)
 
+    best_value = _train_loop(
+        hparams=hparams,
+        manager=manager,
+        train_MTL_model=train_MTL_model,
+        val_MTL_model=val_MTL_model,
+        scores_file=hparams.scores_file,
+        suppress_stdout=suppress_stdout)
+
+    if multitask_models.is_AutoMR(train_MTL_model):
+        # the final state of the selector, e.g. for the stage-2
+        train_MTL_model.save_selector()
+    if train_MTL_model.checkpoint_writer is not None:
+        # make sure everything is on disk before returning
+        train_MTL_model.checkpoint_writer.close()
+
+    return best_value
+
+
+def _train_loop(hparams, manager, train_MTL_model, val_MTL_model,
+                scores_file=None, suppress_stdout=True):
+    """Train an initialized model, and return the best value
+    of the manager (e.g. for several trials of one model)
+
+    When `suppress_stdout` is False, the evaluations and saves print
+    as usual, and the caller is the one to silence `sys.stdout`.
+    """
     # TRAIN
     # ------------------------------------------
     pbar = trange(hparams.max_steps)
@@ -242,11 +380,33 @@ def _train(hparams, manager, train_MTL_model, val_MTL_model):
         except tf.errors.OutOfRangeError:
             raise ValueError("Task Finished An Epoch, this should not happen")
 
+        # Save the model on a separate cadence
+        # ------------------------------------------
+        if (hparams.shared_eval and hparams.steps_per_ckpt and
+                train_MTL_model.global_step % hparams.steps_per_ckpt == 0):
+            with _suppress_stdout(suppress_stdout):
+                train_MTL_model.save_session()
+
+        # Update the selector with the proxy reward
+        # ------------------------------------------
+        use_proxy_reward = (
+            multitask_models.is_AutoMR(train_MTL_model) and
+            hparams.automr_proxy_eval_size is not None)
+        if (use_proxy_reward and train_MTL_model.global_step %
+                hparams.automr_proxy_steps == 0):
+            with _suppress_stdout(suppress_stdout):
+                train_MTL_model.update_TaskSelector(
+                    train_MTL_model.proxy_evaluate()["MAIN"])
+
         # Evaluate the model
         # ------------------------------------------
         if train_MTL_model.global_step % hparams.steps_per_eval == 0:
-            with misc_utils.suppress_stdout():
-                ckpt = train_MTL_model.save_session()
+            with _suppress_stdout(suppress_stdout):
+                # the separate val graph needs the checkpoint
+                # to evaluate, while the shared one does not
+                ckpt = None
+                if not hparams.shared_eval:
+                    ckpt = train_MTL_model.save_session()
                 tf.logging.info("Running Evaluation")
                 val_MTL_model.initialize_or_restore_session(
                     var_filter_fn=lambda name: "Adam" not in name)
@@ -256,7 +416,8 @@ def _train(hparams, manager, train_MTL_model, val_MTL_model):
                     model_idx=hparams.eval_model_index,
                     max_eval_batches=AUTOMR_MAX_EVAL_BATCHES)
 
-                if multitask_models.is_AutoMR(train_MTL_model):
+                if (multitask_models.is_AutoMR(train_MTL_model) and
+                        not use_proxy_reward):
                     train_MTL_model.update_TaskSelector(scores_dict["MAIN"])
 
                 # Log the best ckpt, which will be saved in a
@@ -267,13 +428,26 @@ def _train(hparams, manager, train_MTL_model, val_MTL_model):
 
                 manager.update(value={"Scores": scores_dict["MAIN"]},
                                ckpt=ckpt, verbose=True)
-                manager.save()
+                if scores_file is not None:
+                    with open(scores_file, "a") as f:
+                        f.write("%d\t%.6f\n" % (
+                            train_MTL_model.global_step,
+                            scores_dict["MAIN"]))
+                if train_MTL_model.checkpoint_writer is None:
+                    manager.save()
+                else:
+                    train_MTL_model.checkpoint_writer.submit(
+                        copy.deepcopy(manager).save)
 
         if manager.should_stop:
             print("Manager has given the order to stop")
             pbar.close()
             break
 
+    tf.logging.info("Training throughput: %.1f examples/sec (%s)" % (
+        train_MTL_model.examples_per_second,
+        hparams.training_strategy or "RoundRobin"))
+
     return manager.best_value
 
 
@@ -303,7 +477,8 @@ def infer(hparams):
         ckpt_file=ckpt_file,
         var_filter_fn=lambda name: "Adam" not in name)
     infer_model.initialize_data_iterator()
-    infer_model.inference(model_idx=MAIN_MODEL_INDEX)
+    infer_model.inference(model_idx=MAIN_MODEL_INDEX,
+                          export_csv=hparams.export_results_csv)
 
 
 def main(unused_argv):
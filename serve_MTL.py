@@ -0,0 +1,432 @@
+"""Serve a trained model over HTTP, with dynamic micro-batching.
+
+The model is built and restored once, and kept resident. Requests are
+queued, and grouped into batches of at most `--max_batch_size` pairs,
+waiting at most `--max_wait_ms` for a batch to fill up. The larger
+requests are split over several batches.
+
+    POST /predict   {"pairs": [["sentence 1", "sentence 2"], ...]}
+                    --> {"predictions": [label, ...],
+                         "probabilities": [[p_0, p_1, ...], ...]}
+    GET  /stats     --> p50/p99 latency, throughput (over the time spent
+                        in batches), mean batch size
+
+The sentences are tokenized by whitespace, as the cached data. With
+`CachedELMO` models, the three ELMo layers that were cached offline
+are computed by the TF-Hub ELMo module instead, thus the scores might
+differ slightly from `run_MTL.py --infer` on the cached files.
+
+Usage (the arguments after `--` are those of the trained model):
+    python serve_MTL.py --port 8000 --max_batch_size 32 --max_wait_ms 5 \
+        -- --logdir [logdir] --tasks [tasks] --model_type [model_type] \
+        --stage 1 [additional run_MTL.py arguments]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import tensorflow as tf
+import tensorflow_hub as tf_hub
+from six.moves import queue
+from six.moves import socketserver
+from six.moves import BaseHTTPServer
+
+import run_MTL
+import model_utils
+from multitask import modules
+from utils import training_manager
+from multitask import multitask_base_model
+from constants import (MAIN_MODEL_INDEX,
+                       CACHED_ELMO_NUM_UNITS)
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def read_label_vocab(label_vocab_file):
+    with open(label_vocab_file) as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+def get_ckpt_file(hparams):
+    """`--ckpt_file` when given, else the best one of the manager"""
+    if hparams.ckpt_file is not None:
+        return hparams.ckpt_file
+
+    manager = training_manager.TrainingManager(
+        name=hparams.task_names[MAIN_MODEL_INDEX],
+        logdir=hparams.manager_logdir)
+    if manager.best_checkpoint is None:
+        raise ValueError("`ckpt_file` is None")
+    return manager.best_checkpoint
+
+
+def checkpoint_variables(ckpt_file, initialized_variables=()):
+    """Variables of the default graph that are in the checkpoint, all
+    the others must be in `initialized_variables` (e.g. the variables of
+    the TF-Hub module), otherwise they would be served at random"""
+    ckpt_variables = set(
+        name for name, _ in tf.train.list_variables(ckpt_file))
+    initialized_names = set(v.op.name for v in initialized_variables)
+    missing_names = [v.op.name for v in tf.global_variables()
+                     if v.op.name not in ckpt_variables and
+                     v.op.name not in initialized_names]
+    if missing_names:
+        raise ValueError("Variables missing from %s (e.g. another "
+                         "`--model_type` or `--lstm_unit_type`): %s" % (
+                             ckpt_file, ", ".join(missing_names)))
+
+    return [v for v in tf.global_variables()
+            if v.op.name in ckpt_variables]
+
+
+def _elmo_layers(elmo, tokens, sequence_length):
+    """The three ELMo layers as in the cached representations,
+    [batch_size, 3, max_length, 1024], where the first layer is
+    the (context-free) token embedding concatenated with itself"""
+    outputs = elmo(
+        inputs={"tokens": tokens, "sequence_len": sequence_length},
+        signature="tokens", as_dict=True)
+
+    layers = [tf.concat([outputs["word_emb"], outputs["word_emb"]], axis=-1),
+              outputs["lstm_outputs1"],
+              outputs["lstm_outputs2"]]
+    layers = tf.stack(layers, axis=1)
+    layers.set_shape([None, 3, None, CACHED_ELMO_NUM_UNITS])
+    return layers
+
+
+class ServingModel(object):
+    """The main task's model, on string tokens"""
+
+    def __init__(self, hparams, ckpt_file):
+        if hparams.elmo_prereduced:
+            raise ValueError("Serving pre-reduced models is not supported")
+        if hparams.embedding_type not in ["CachedELMO", "ELMO"]:
+            raise ValueError("Serving %s models is not supported"
+                             % hparams.embedding_type)
+
+        main_task = hparams.tasks[MAIN_MODEL_INDEX]
+        num_classes = [
+            len(read_label_vocab(t.train_data + ".label_vocab"))
+            for t in hparams.tasks]
+        self._labels = read_label_vocab(
+            main_task.train_data + ".label_vocab")
+        self._dual_stream = (
+            main_task.name not in multitask_base_model.SINGLE_STREAM_TASKS)
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            (embedding_fns,
+             encoder_fns_1,
+             encoder_fns_2,
+             logits_fns,
+             _) = model_utils.base_functions(
+                hparams=hparams,
+                num_classes=num_classes,
+                vocab_size=None,
+                is_training=False)
+
+            if hparams.embedding_type == "CachedELMO":
+                elmo = tf_hub.Module(
+                    modules.TFHubElmoEmbedding.ELMO_URL, trainable=False)
+                hub_variables = elmo.variables
+            else:
+                hub_variables = embedding_fns[MAIN_MODEL_INDEX].hub_variables
+
+            self._tokens = []
+            self._sequence_length = []
+            pooled_outputs = []
+            for stream in range(2 if self._dual_stream else 1):
+                tokens = tf.placeholder(tf.string, [None, None])
+                sequence_length = tf.placeholder(tf.int32, [None])
+                if hparams.embedding_type == "CachedELMO":
+                    embedded_tokens = embedding_fns[MAIN_MODEL_INDEX](
+                        _elmo_layers(elmo, tokens, sequence_length))
+                else:
+                    embedded_tokens = embedding_fns[MAIN_MODEL_INDEX](
+                        tokens, sequence_length)
+
+                encoder_fn = [encoder_fns_1, encoder_fns_2][stream]
+                outputs, _ = encoder_fn[MAIN_MODEL_INDEX](
+                    inputs=embedded_tokens,
+                    sequence_length=sequence_length)
+
+                self._tokens.append(tokens)
+                self._sequence_length.append(sequence_length)
+                pooled_outputs.append(tf.reduce_max(outputs, axis=1))
+
+            # same features as `_build_dual_stream_model`
+            if self._dual_stream:
+                u, v = pooled_outputs
+                features = tf.concat(
+                    [u, v, tf.abs(tf.subtract(u, v)), tf.multiply(u, v)],
+                    axis=-1)
+            else:
+                features = pooled_outputs[0]
+
+            # the logits layer is called (and its variables
+            # created) within the scope of the task model
+            with tf.variable_scope("Model_%s" % main_task.name):
+                logits = logits_fns[MAIN_MODEL_INDEX](features)
+            self._probabilities = tf.nn.softmax(logits)
+
+            # only the TF-Hub module is initialized, instead of restored
+            restored_variables = checkpoint_variables(
+                ckpt_file, initialized_variables=hub_variables)
+            saver = tf.train.Saver(var_list=restored_variables)
+            restored_names = set(v.op.name for v in restored_variables)
+            init_ops = [tf.variables_initializer(
+                            [v for v in hub_variables
+                             if v.op.name not in restored_names]),
+                        tf.tables_initializer()]
+            self._graph.finalize()
+
+        self._sess = tf.Session(graph=self._graph)
+        self._sess.run(init_ops)
+        saver.restore(self._sess, ckpt_file)
+        tf.logging.info("Restored %d variables from %s" % (
+            len(restored_variables), ckpt_file))
+
+    def _feed_sequences(self, feed_dict, stream, sentences):
+        tokenized = [sentence.split() for sentence in sentences]
+        lengths = [len(tokens) for tokens in tokenized]
+        max_length = max(max(lengths), 1)
+        feed_dict[self._tokens[stream]] = [
+            tokens + [""] * (max_length - len(tokens))
+            for tokens in tokenized]
+        feed_dict[self._sequence_length[stream]] = lengths
+
+    def predict(self, pairs):
+        """Returns the predicted labels and the probabilities"""
+        feed_dict = {}
+        self._feed_sequences(feed_dict, 0, [p[0] for p in pairs])
+        if self._dual_stream:
+            self._feed_sequences(feed_dict, 1, [p[1] for p in pairs])
+
+        probabilities = self._sess.run(self._probabilities, feed_dict)
+        predictions = np.argmax(probabilities, axis=1)
+        return [self._labels[p] for p in predictions], probabilities.tolist()
+
+
+class _Request(object):
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.done = threading.Event()
+        self.predictions = None
+        self.probabilities = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Groups the requests into batches of at most `max_batch_size`
+    pairs, waiting at most `max_wait_ms` after the first request. The
+    larger requests are split into chunks of `max_batch_size` pairs"""
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5.0,
+                 max_latency_records=100000):
+        self._predict_fn = predict_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait_seconds = max_wait_ms / 1000.
+        self._queue = queue.Queue()
+        # a request whose pairs did not fit into the previous batch
+        self._pending = None
+
+        # statistics
+        self._lock = threading.Lock()
+        self._latencies = np.zeros(max_latency_records, dtype=np.float64)
+        self._num_requests = 0
+        self._num_examples = 0
+        self._num_batches = 0
+        # the time spent in the batches, idle time excluded
+        self._batch_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="MicroBatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, pairs):
+        if not pairs:
+            return [], []
+
+        start_time = time.time()
+        requests = [_Request(pairs[start: start + self._max_batch_size])
+                    for start in range(0, len(pairs), self._max_batch_size)]
+        for request in requests:
+            self._queue.put(request)
+
+        predictions, probabilities = [], []
+        for request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            predictions.extend(request.predictions)
+            probabilities.extend(request.probabilities)
+
+        with self._lock:
+            self._latencies[self._num_requests % len(self._latencies)] = (
+                time.time() - start_time)
+            self._num_requests += 1
+
+        return predictions, probabilities
+
+    def _next_batch(self):
+        requests = [self._pending or self._queue.get()]
+        self._pending = None
+        num_pairs = len(requests[0].pairs)
+        deadline = time.time() + self._max_wait_seconds
+        while num_pairs < self._max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if num_pairs + len(request.pairs) > self._max_batch_size:
+                # keep it for the next batch
+                self._pending = request
+                break
+
+            requests.append(request)
+            num_pairs += len(request.pairs)
+
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            pairs = [pair for request in requests for pair in request.pairs]
+            start_time = time.time()
+            try:
+                predictions, probabilities = self._predict_fn(pairs)
+            except Exception as error:
+                tf.logging.error("MicroBatcher: %s" % error)
+                for request in requests:
+                    request.error = error
+                    request.done.set()
+                continue
+
+            start = 0
+            for request in requests:
+                end = start + len(request.pairs)
+                request.predictions = predictions[start: end]
+                request.probabilities = probabilities[start: end]
+                start = end
+
+            with self._lock:
+                self._num_examples += len(pairs)
+                self._num_batches += 1
+                self._batch_seconds += time.time() - start_time
+
+            for request in requests:
+                request.done.set()
+
+    @property
+    def stats(self):
+        with self._lock:
+            latencies = self._latencies[
+                :min(self._num_requests, len(self._latencies))]
+            if not len(latencies):
+                latencies = np.zeros(1)
+
+            return {"NumRequests": self._num_requests,
+                    "NumExamples": self._num_examples,
+                    "MeanBatchSize": (
+                        self._num_examples / max(self._num_batches, 1)),
+                    "LatencyP50ms": np.percentile(latencies, 50) * 1000.,
+                    "LatencyP99ms": np.percentile(latencies, 99) * 1000.,
+                    "ExamplesPerSecond": (
+                        self._num_examples / max(self._batch_seconds, 1e-6))}
+
+
+def _make_handler(batcher):
+    class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def _respond(self, code, body):
+            body = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._respond(404, {"error": "unknown path"})
+            self._respond(200, batcher.stats)
+
+        def do_POST(self):
+            if self.path != "/predict":
+                return self._respond(404, {"error": "unknown path"})
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+                pairs = [(p[0], p[1] if len(p) > 1 else "")
+                         for p in body["pairs"]]
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                return self._respond(400, {"error": str(error)})
+
+            try:
+                predictions, probabilities = batcher.predict(pairs)
+            except Exception as error:
+                return self._respond(500, {"error": str(error)})
+
+            self._respond(200, {"predictions": predictions,
+                                "probabilities": probabilities})
+
+        def log_message(self, *args):
+            # the per-request logs would dominate the latency
+            pass
+
+    return _Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    args = parser.parse_args(arguments)
+
+    hparams = run_MTL.get_hparams(run_MTL_args)
+    ckpt_file = get_ckpt_file(hparams)
+    model = ServingModel(hparams, ckpt_file)
+    batcher = MicroBatcher(
+        predict_fn=model.predict,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms)
+
+    server = ThreadingHTTPServer(
+        (args.host, args.port), _make_handler(batcher))
+    print("Serving on http://%s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats, indent=4))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,258 @@
+"""Stage-2: prune the mixing-ratio candidates with successive halving.
+
+Instead of training every candidate to `max_steps`, many candidates are
+trained for a small number of steps, evaluated on (at most)
+`AUTOMR_MAX_EVAL_BATCHES` validation batches, and only the top
+`1 / eta` of them are promoted to the next budget (`eta` times larger),
+until the budget reaches `max_steps`. With `--num_brackets` larger than
+one, several such brackets are run with decreasing numbers of candidates
+and increasing initial budgets (Hyperband).
+
+All the candidates share one graph (the mixing ratios only change the
+task schedule), and a promoted candidate resumes from its checkpoint
+(variables, optimizer slots and global step) instead of being retrained.
+
+Usage (the arguments after `--` are those of `run_MTL.py`, except
+`--logdir`, `--stage` and `--mixing_ratios`):
+    python stage2_halving.py --search_dir [search_dir] \
+        --min_steps 500 --eta 3 \
+        --stage1_selector [stage1_logdir]/mab_selector -- \
+        --tasks [tasks] --model_type [model_type] [...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import math
+import argparse
+import numpy as np
+import tensorflow as tf
+
+import run_MTL
+import model_utils
+import stage2_search
+from utils import misc_utils
+from constants import AUTOMR_MAX_EVAL_BATCHES
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+RESULTS_FNAME = "halving_results.json"
+CANDIDATE_DIRNAME = "candidate_%03d"
+INITIAL_CKPT_DIRNAME = "initial"
+
+
+def brackets(max_steps, min_steps, eta, num_brackets, num_candidates=None):
+    """Returns the (number of candidates, initial budget) of each bracket,
+    the first one being the most aggressive (successive halving)"""
+    s_max = int(math.floor(math.log(max_steps / min_steps, eta) + 1e-9))
+    num_brackets = min(num_brackets, s_max + 1)
+
+    results = []
+    for s in range(s_max, s_max - num_brackets, -1):
+        n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        if num_candidates is not None and s == s_max:
+            n = num_candidates
+        results.append((n, int(max_steps * eta ** (-s))))
+    return results
+
+
+class SuccessiveHalving(object):
+    """Trains the candidates of the brackets in one model"""
+
+    def __init__(self, train_MTL_model, val_MTL_model,
+                 eval_model_index, search_dir, eta, numpy_seed=None):
+        self._model = train_MTL_model
+        self._val_model = val_MTL_model
+        self._eval_model_index = eval_model_index
+        self._search_dir = search_dir
+        self._eta = eta
+        self._numpy_seed = numpy_seed
+
+        self._initial_ckpt = self._model.save_snapshot(
+            os.path.join(search_dir, INITIAL_CKPT_DIRNAME, "model.ckpt"))
+        # budgets are relative to the initial (e.g. stage-1) step
+        self._initial_step = self._model.global_step
+        self._num_trained_steps = 0
+        self.candidates = []
+
+    @property
+    def num_trained_steps(self):
+        return self._num_trained_steps
+
+    def add_candidate(self, mixing_ratios):
+        candidate = {"id": len(self.candidates),
+                     "mixing_ratios": mixing_ratios,
+                     "ckpt": self._initial_ckpt,
+                     "steps": 0,
+                     "scores": {}}
+        self.candidates.append(candidate)
+        return candidate
+
+    def _train_and_evaluate(self, candidate, budget):
+        self._model.restore_snapshot(candidate["ckpt"])
+        self._model.reset_training_state()
+        self._model.set_mixing_ratios(candidate["mixing_ratios"])
+        # every candidate sees the data in the same order, thus a
+        # promoted candidate skips the data of the steps it has trained
+        self._model.initialize_data_iterator(model_idx=None)
+        np.random.seed(self._numpy_seed)
+        self._model.skip_steps(candidate["steps"],
+                               first_step=self._initial_step)
+
+        while self._model.global_step - self._initial_step < budget:
+            try:
+                self._model.train()
+            except tf.errors.OutOfRangeError:
+                raise ValueError("Task Finished An Epoch, "
+                                 "this should not happen")
+            self._num_trained_steps += 1
+
+        with misc_utils.suppress_stdout():
+            self._val_model.initialize_data_iterator(
+                [self._eval_model_index])
+            scores_dict = self._val_model.evaluate(
+                model_idx=self._eval_model_index,
+                max_eval_batches=AUTOMR_MAX_EVAL_BATCHES)
+
+        candidate["steps"] = budget
+        candidate["scores"][str(budget)] = float(scores_dict["MAIN"])
+        candidate["ckpt"] = self._model.save_snapshot(os.path.join(
+            self._search_dir, CANDIDATE_DIRNAME % candidate["id"],
+            "model.ckpt"))
+
+        tf.logging.info("Candidate %d %s: %.4f after %d steps" % (
+            candidate["id"], candidate["mixing_ratios"],
+            scores_dict["MAIN"], budget))
+        return scores_dict["MAIN"]
+
+    def run_bracket(self, candidates, initial_budget, max_steps):
+        """Returns the best candidate of the bracket, and its score"""
+        budget = initial_budget
+        while True:
+            scores = [self._train_and_evaluate(candidate, budget)
+                      for candidate in candidates]
+            self.save()
+
+            order = np.argsort(scores)[::-1]
+            if budget >= max_steps or len(candidates) == 1:
+                return candidates[order[0]], scores[order[0]]
+
+            num_promoted = max(1, len(candidates) // self._eta)
+            candidates = [candidates[i] for i in order[:num_promoted]]
+            budget = min(budget * self._eta, max_steps)
+
+    def save(self):
+        with open(os.path.join(self._search_dir, RESULTS_FNAME), "w") as f:
+            json.dump({"candidates": self.candidates,
+                       "num_trained_steps": self._num_trained_steps},
+                      f, indent=2)
+
+
+def search(run_MTL_args, search_dir, stage1_selector,
+           min_steps, eta, num_brackets, num_candidates,
+           min_ratio, max_ratio, random_seed):
+    if not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+
+    num_tasks = len(run_MTL.get_hparams(
+        run_MTL_args + ["--logdir", search_dir, "--stage", "1"]).tasks)
+    # the mixing ratios are set per candidate, and evaluation
+    # runs on the live weights of the shared graph
+    hparams = run_MTL.get_hparams(run_MTL_args + [
+        "--logdir", search_dir,
+        "--stage", "2",
+        "--mixing_ratios", "-".join(["1"] * num_tasks),
+        "--shared_eval",
+        "--async_ckpt"])
+
+    np.random.seed(hparams.numpy_seed)
+    bracket_sizes = brackets(max_steps=hparams.max_steps,
+                             min_steps=min_steps,
+                             eta=eta,
+                             num_brackets=num_brackets,
+                             num_candidates=num_candidates)
+    if not bracket_sizes:
+        raise ValueError("`min_steps` = %d is larger than "
+                         "`max_steps` = %d" % (min_steps, hparams.max_steps))
+
+    train_MTL_model, val_MTL_model = model_utils.build_model(hparams)
+    train_MTL_model.initialize_or_restore_session(
+        ckpt_file=hparams.ckpt_file,
+        var_filter_fn=lambda name: "Adam" not in name and "clone" not in name)
+
+    scheduler = SuccessiveHalving(
+        train_MTL_model=train_MTL_model,
+        val_MTL_model=val_MTL_model,
+        eval_model_index=hparams.eval_model_index,
+        search_dir=search_dir,
+        eta=eta,
+        numpy_seed=hparams.numpy_seed)
+
+    random_state = np.random.RandomState(random_seed)
+    best_candidate, best_score = None, None
+    for n, initial_budget in bracket_sizes:
+        candidates = []
+        if stage1_selector is not None and not scheduler.candidates:
+            candidates.append(scheduler.add_candidate(
+                stage2_search.stage1_mixing_ratios(
+                    stage1_selector, num_tasks, min_ratio, max_ratio)))
+        while len(candidates) < n:
+            candidates.append(scheduler.add_candidate([
+                int(r) for r in random_state.randint(
+                    min_ratio, max_ratio + 1, size=num_tasks)]))
+
+        tf.logging.info("Bracket of %d candidates from %d steps" % (
+            n, initial_budget))
+        candidate, score = scheduler.run_bracket(
+            candidates, initial_budget, hparams.max_steps)
+        if best_score is None or score > best_score:
+            best_candidate, best_score = candidate, score
+
+    train_MTL_model.checkpoint_writer.close()
+    full_steps = len(scheduler.candidates) * hparams.max_steps
+    print("Best mixing ratios: %s, score %.4f (%s)" % (
+        "-".join(str(r) for r in best_candidate["mixing_ratios"]),
+        best_score, best_candidate["ckpt"]))
+    print("Trained %d steps for %d candidates (%.1f%% of %d steps)" % (
+        scheduler.num_trained_steps, len(scheduler.candidates),
+        100. * scheduler.num_trained_steps / full_steps, full_steps))
+    return best_candidate
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search_dir", type=str, required=True)
+    parser.add_argument("--stage1_selector", type=str, default=None)
+    parser.add_argument("--min_steps", type=int, default=500)
+    parser.add_argument("--eta", type=int, default=3)
+    # 1 is plain successive halving, more is Hyperband
+    parser.add_argument("--num_brackets", type=int, default=1)
+    parser.add_argument("--num_candidates", type=int, default=None)
+    parser.add_argument("--min_ratio", type=int, default=1)
+    parser.add_argument("--max_ratio", type=int, default=10)
+    parser.add_argument("--random_seed", type=int, default=None)
+    args = parser.parse_args(arguments)
+
+    search(run_MTL_args=run_MTL_args,
+           search_dir=args.search_dir,
+           stage1_selector=args.stage1_selector,
+           min_steps=args.min_steps,
+           eta=args.eta,
+           num_brackets=args.num_brackets,
+           num_candidates=args.num_candidates,
+           min_ratio=args.min_ratio,
+           max_ratio=args.max_ratio,
+           random_seed=args.random_seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,370 @@
+"""Stage-2: search the mixing ratios with a Gaussian-process optimizer.
+
+Each trial trains `run_MTL.py --stage 2` with fixed `--mixing_ratios`,
+as a separate process pinned to its own subset of CPUs, and up to
+`--num_parallel_trials` trials run concurrently. The optimizer is
+`skopt.Optimizer` (Gaussian process), whose first proposal is derived
+from the arm weights of the stage-1 AutoMR selector, and the proposals
+of the concurrent trials are decorrelated by telling a copy of the
+optimizer a "constant liar" value for the pending ones.
+
+Poor trials are terminated early: each trial appends its evaluation
+scores to a file, and the `manager_stopping_fn` of the main task is
+applied to them, where the best score is the one of the best trial
+at the same number of evaluations. The state of the search is saved
+to `[search_dir]/search_state.json` after each trial, and the search
+resumes from it (unfinished trials are run again).
+
+Usage (the arguments after `--` are those of `run_MTL.py`, except
+`--logdir`, `--stage` and `--mixing_ratios`, which are set per trial):
+    python stage2_search.py --search_dir [search_dir] \
+        --stage1_selector [stage1_logdir]/mab_selector \
+        --num_trials 30 --num_parallel_trials 4 -- \
+        --tasks [tasks] --model_type [model_type] [...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+from skopt import Optimizer
+from skopt.space import Integer
+
+import run_MTL
+from multitask import multitask_autoMR_model
+from constants import MAIN_MODEL_INDEX, EARLY_STOP_TOLERANCE
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+STATE_FNAME = "search_state.json"
+SCORES_FNAME = "scores.txt"
+TRIAL_DIRNAME = "trial_%03d"
+# seconds between two polls of the running trials
+POLL_INTERVAL = 10
+
+FINISHED = "finished"
+STOPPED = "stopped"
+FAILED = "failed"
+
+
+def stage1_mixing_ratios(selector_dir, num_tasks, min_ratio, max_ratio):
+    """Scale the arm weights of the stage-1 selector (of any type) into
+    integer mixing ratios, the largest one being `max_ratio`"""
+    selector = multitask_autoMR_model.restore_selector(
+        selector_dir, num_actions=num_tasks)
+
+    weights = np.asarray(selector.arm_weights, dtype=np.float64)
+    ratios = np.round(weights / weights.max() * max_ratio)
+    return [int(r) for r in np.clip(ratios, min_ratio, max_ratio)]
+
+
+def read_scores(scores_file):
+    if not os.path.exists(scores_file):
+        return []
+
+    with open(scores_file) as f:
+        return [float(line.split("\t")[1])
+                for line in f.read().splitlines() if line]
+
+
+class SearchState(object):
+    """The trials of the search, saved as JSON after each change"""
+
+    def __init__(self, search_dir):
+        self._fname = os.path.join(search_dir, STATE_FNAME)
+        self.trials = []
+        if os.path.exists(self._fname):
+            with open(self._fname) as f:
+                self.trials = json.load(f)["trials"]
+
+    def add(self, mixing_ratios):
+        trial = {"id": len(self.trials),
+                 "mixing_ratios": mixing_ratios,
+                 "status": None,
+                 "score": None,
+                 "scores": []}
+        self.trials.append(trial)
+        self.save()
+        return trial
+
+    def finish(self, trial, status, scores):
+        trial["status"] = status
+        trial["scores"] = scores
+        trial["score"] = max(scores) if scores else None
+        self.save()
+
+    @property
+    def completed_trials(self):
+        return [t for t in self.trials if t["status"] is not None]
+
+    @property
+    def unfinished_trials(self):
+        return [t for t in self.trials if t["status"] is None]
+
+    @property
+    def scored_trials(self):
+        """The trials with a score, except the failed ones, whose
+        partial scores are not comparable with the others"""
+        return [t for t in self.trials
+                if t["status"] in [FINISHED, STOPPED] and
+                t["score"] is not None]
+
+    @property
+    def best_trial(self):
+        trials = self.scored_trials
+        if not trials:
+            return None
+        return max(trials, key=lambda t: t["score"])
+
+    def save(self):
+        # write then rename, such that a crash does not
+        # leave a partially written state behind
+        with open(self._fname + ".tmp", "w") as f:
+            json.dump({"trials": self.trials}, f, indent=2)
+        os.rename(self._fname + ".tmp", self._fname)
+
+
+class TrialRunner(object):
+    """Runs `run_MTL.py` trials as processes pinned to CPU subsets"""
+
+    def __init__(self, run_MTL_args, search_dir,
+                 num_parallel_trials, cpus_per_trial=None):
+        self._run_MTL_args = run_MTL_args
+        self._search_dir = search_dir
+
+        # split the available CPUs into disjoint subsets
+        self._cpu_sets = [None] * num_parallel_trials
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            if cpus_per_trial is None:
+                cpus_per_trial = max(1, len(cpus) // num_parallel_trials)
+            self._cpu_sets = [
+                cpus[(i * cpus_per_trial) % len(cpus):][:cpus_per_trial]
+                for i in range(num_parallel_trials)]
+        else:
+            tf.logging.warning("CPU pinning is not supported on this OS")
+
+        # slot -> (trial, process)
+        self._running = {}
+
+    def trial_dir(self, trial):
+        return os.path.join(self._search_dir, TRIAL_DIRNAME % trial["id"])
+
+    def scores_file(self, trial):
+        return os.path.join(self.trial_dir(trial), SCORES_FNAME)
+
+    @property
+    def num_free_slots(self):
+        return len(self._cpu_sets) - len(self._running)
+
+    @property
+    def running_trials(self):
+        return [trial for trial, _ in self._running.values()]
+
+    def start(self, trial):
+        slot = [i for i in range(len(self._cpu_sets))
+                if i not in self._running][0]
+        cpus = self._cpu_sets[slot]
+
+        trial_dir = self.trial_dir(trial)
+        if not os.path.exists(trial_dir):
+            os.makedirs(trial_dir)
+        if os.path.exists(self.scores_file(trial)):
+            # a trial interrupted by a previous run starts over
+            os.remove(self.scores_file(trial))
+
+        command = [sys.executable, "run_MTL.py"] + self._run_MTL_args + [
+            "--logdir", trial_dir,
+            "--stage", "2",
+            "--mixing_ratios",
+            "-".join(str(r) for r in trial["mixing_ratios"]),
+            "--scores_file", self.scores_file(trial)]
+
+        env = dict(os.environ)
+        preexec_fn = None
+        if cpus is not None:
+            env["OMP_NUM_THREADS"] = str(len(cpus))
+            preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+
+        with open(os.path.join(trial_dir, "stdout.txt"), "w") as stdout:
+            process = subprocess.Popen(
+                command, stdout=stdout, stderr=subprocess.STDOUT,
+                env=env, preexec_fn=preexec_fn,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self._running[slot] = (trial, process)
+        tf.logging.info("Started trial %d with mixing ratios %s on CPUs %s"
+                        % (trial["id"], trial["mixing_ratios"], cpus))
+
+    def poll(self):
+        """Returns the (trial, return code) of the finished trials"""
+        finished = []
+        for slot, (trial, process) in list(self._running.items()):
+            if process.poll() is not None:
+                finished.append((trial, process.returncode))
+                del self._running[slot]
+        return finished
+
+    def stop(self, trial):
+        for slot, (running_trial, process) in list(self._running.items()):
+            if running_trial is trial:
+                process.terminate()
+                process.wait()
+                del self._running[slot]
+
+
+def _should_stop(stopping_fn, tolerance, scores, best_trial):
+    """Apply the `manager_stopping_fn` of the main task to the scores of
+    a trial, against the best trial at the same number of evaluations"""
+    if best_trial is None or len(scores) < tolerance:
+        return False
+
+    best_scores = best_trial["scores"][:len(scores)]
+    best = {"Scores": max(max(scores), max(best_scores or scores))}
+    return stopping_fn(best=best, history={"Scores": scores})
+
+
+def _propose(optimizer, pending_points):
+    """Propose a point, with the pending points
+    told with the lowest (best) observed value"""
+    if not pending_points:
+        return optimizer.ask()
+
+    liar = optimizer.copy()
+    lie = min(optimizer.yi) if optimizer.yi else 0.0
+    liar.tell(pending_points, [lie] * len(pending_points))
+    return liar.ask()
+
+
+def search(run_MTL_args, search_dir, stage1_selector,
+           num_trials, num_parallel_trials, cpus_per_trial,
+           min_ratio, max_ratio, num_initial_points,
+           stop_tolerance, random_seed):
+    if not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+
+    # only used for the tasks, the trials parse their own arguments
+    hparams = run_MTL.get_hparams(
+        run_MTL_args + ["--logdir", search_dir, "--stage", "1"])
+    num_tasks = len(hparams.tasks)
+    stopping_fn = hparams.tasks[MAIN_MODEL_INDEX].manager_stopping_fn(
+        tolerance=stop_tolerance)
+
+    optimizer = Optimizer(
+        dimensions=[Integer(min_ratio, max_ratio)] * num_tasks,
+        base_estimator="GP",
+        n_initial_points=num_initial_points,
+        random_state=random_seed)
+
+    state = SearchState(search_dir)
+    for trial in state.scored_trials:
+        # the optimizer minimizes
+        optimizer.tell(trial["mixing_ratios"], -trial["score"])
+    tf.logging.info("Resuming from %d completed trials"
+                    % len(state.completed_trials))
+
+    # trials to run: the unfinished ones, then the
+    # stage-1 ratios, then the proposals of the optimizer
+    queue = state.unfinished_trials
+    if not state.trials and stage1_selector is not None:
+        queue.append(state.add(stage1_mixing_ratios(
+            stage1_selector, num_tasks, min_ratio, max_ratio)))
+
+    runner = TrialRunner(run_MTL_args=run_MTL_args,
+                         search_dir=search_dir,
+                         num_parallel_trials=num_parallel_trials,
+                         cpus_per_trial=cpus_per_trial)
+    while True:
+        # start trials in the free slots
+        while runner.num_free_slots and (
+                queue or len(state.trials) < num_trials):
+            if not queue:
+                pending_points = [t["mixing_ratios"]
+                                  for t in runner.running_trials]
+                mixing_ratios = _propose(optimizer, pending_points)
+                queue.append(state.add([int(r) for r in mixing_ratios]))
+            runner.start(queue.pop(0))
+
+        if not runner.running_trials:
+            break
+        time.sleep(POLL_INTERVAL)
+
+        # collect the finished trials
+        for trial, returncode in runner.poll():
+            scores = read_scores(runner.scores_file(trial))
+            status = FINISHED if returncode == 0 else FAILED
+            state.finish(trial, status, scores)
+            # failed trials are left out of the optimizer, and
+            # of the best trial (thus of the stopping rule)
+            if status == FINISHED and trial["score"] is not None:
+                optimizer.tell(trial["mixing_ratios"], -trial["score"])
+            tf.logging.info("Trial %d %s with score %s" % (
+                trial["id"], status, trial["score"]))
+
+        # stop the poor trials
+        for trial in runner.running_trials:
+            scores = read_scores(runner.scores_file(trial))
+            if _should_stop(stopping_fn, stop_tolerance,
+                            scores, state.best_trial):
+                runner.stop(trial)
+                state.finish(trial, STOPPED, scores)
+                optimizer.tell(trial["mixing_ratios"], -trial["score"])
+                tf.logging.info("Trial %d stopped early with score %.4f"
+                                % (trial["id"], trial["score"]))
+
+    best_trial = state.best_trial
+    if best_trial is None:
+        raise ValueError("All the trials failed, see the `stdout.txt` "
+                         "in %s" % search_dir)
+
+    print("Best mixing ratios: %s, score %.4f (trial %d, %s)" % (
+        "-".join(str(r) for r in best_trial["mixing_ratios"]),
+        best_trial["score"], best_trial["id"],
+        runner.trial_dir(best_trial)))
+    return best_trial
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search_dir", type=str, required=True)
+    parser.add_argument("--stage1_selector", type=str, default=None)
+    parser.add_argument("--num_trials", type=int, default=30)
+    parser.add_argument("--num_parallel_trials", type=int, default=4)
+    parser.add_argument("--cpus_per_trial", type=int, default=None)
+    parser.add_argument("--min_ratio", type=int, default=1)
+    parser.add_argument("--max_ratio", type=int, default=10)
+    parser.add_argument("--num_initial_points", type=int, default=5)
+    # evaluations of a trial without matching the best trial
+    parser.add_argument("--stop_tolerance", type=int,
+                        default=EARLY_STOP_TOLERANCE)
+    parser.add_argument("--random_seed", type=int, default=None)
+    args = parser.parse_args(arguments)
+
+    search(run_MTL_args=run_MTL_args,
+           search_dir=args.search_dir,
+           stage1_selector=args.stage1_selector,
+           num_trials=args.num_trials,
+           num_parallel_trials=args.num_parallel_trials,
+           cpus_per_trial=args.cpus_per_trial,
+           min_ratio=args.min_ratio,
+           max_ratio=args.max_ratio,
+           num_initial_points=args.num_initial_points,
+           stop_tolerance=args.stop_tolerance,
+           random_seed=args.random_seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
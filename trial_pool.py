@@ -0,0 +1,145 @@
+"""Train several independent trials concurrently in one process.
+
+Each trial has its own graph (seeded by its `--random_seed`), its own
+session with a budget of intra-op threads, its own training manager and
+its own random state, and runs `run_MTL._train` on a worker thread
+(`session.run` releases the GIL). Thus small tasks (e.g. RTE, MRPC or
+WNLI as the main task) can use a many-core machine without paying the
+TensorFlow import and startup of one process per trial.
+
+The trials share the arguments after `--`, and each one adds its own,
+e.g. its mixing ratios or its tasks. The selector of AutoMR samples from
+the global numpy random state, thus trials are best run with fixed
+mixing ratios (as in the stage-2).
+
+Usage:
+    python trial_pool.py --search_dir [search_dir] --num_workers 8 \
+        --trial_args "--tasks RTE-MNLI --mixing_ratios 1-1" \
+                     "--tasks MRPC-QQP --mixing_ratios 2-1" -- \
+        --model_type [model_type] --stage 2 [...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shlex
+import argparse
+import multiprocessing
+import tensorflow as tf
+from concurrent import futures
+
+import run_MTL
+import model_utils
+from utils import misc_utils
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+TRIAL_DIRNAME = "trial_%03d"
+
+
+class TrialPool(object):
+    """Runs `run_MTL._train` of several `hparams` on a thread pool
+
+    Args:
+        num_workers: number of trials running at the same time
+        intra_op_threads: threads of each session, defaults to
+            the number of CPUs divided by `num_workers`
+        inter_op_threads: inter-op threads of each session
+    """
+
+    def __init__(self, num_workers, intra_op_threads=None,
+                 inter_op_threads=2):
+        if intra_op_threads is None:
+            intra_op_threads = max(
+                1, multiprocessing.cpu_count() // num_workers)
+
+        self._num_workers = num_workers
+        self._session_config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+
+    def _run_trial(self, hparams):
+        start_time = time.time()
+        train_MTL_model, val_MTL_model = model_utils.build_model(
+            hparams, session_config=self._session_config)
+
+        best_value = run_MTL._train(
+            hparams=hparams,
+            manager=run_MTL.build_manager(
+                hparams, logdir=hparams.manager_logdir),
+            train_MTL_model=train_MTL_model,
+            val_MTL_model=val_MTL_model,
+            # silenced once by `run`, for all the threads
+            suppress_stdout=False)
+
+        return {"BestValue": best_value,
+                "Seconds": time.time() - start_time,
+                "ExamplesPerSecond": train_MTL_model.examples_per_second}
+
+    def run(self, hparams_list):
+        """Returns the results of the trials, in order. A failed
+        trial has its exception as its result, and does not stop
+        the others"""
+        results = []
+        # `suppress_stdout` swaps the global `sys.stdout`, thus it is
+        # entered here only, and not by the trials (on their threads)
+        with misc_utils.suppress_stdout():
+            with futures.ThreadPoolExecutor(self._num_workers) as executor:
+                pending = [executor.submit(self._run_trial, hparams)
+                           for hparams in hparams_list]
+                for hparams, future in zip(hparams_list, pending):
+                    try:
+                        results.append(future.result())
+                    except Exception as error:
+                        tf.logging.error("Trial %s failed: %s" % (
+                            hparams.logdir, error))
+                        results.append(error)
+
+        return results
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search_dir", type=str, required=True)
+    parser.add_argument("--trial_args", type=str, nargs="+", required=True)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--intra_op_threads", type=int, default=None)
+    parser.add_argument("--inter_op_threads", type=int, default=2)
+    args = parser.parse_args(arguments)
+
+    hparams_list = []
+    for trial_id, trial_args in enumerate(args.trial_args):
+        logdir = os.path.join(args.search_dir, TRIAL_DIRNAME % trial_id)
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+        hparams_list.append(run_MTL.get_hparams(
+            run_MTL_args + shlex.split(trial_args) + ["--logdir", logdir]))
+
+    pool = TrialPool(num_workers=args.num_workers,
+                     intra_op_threads=args.intra_op_threads,
+                     inter_op_threads=args.inter_op_threads)
+    start_time = time.time()
+    results = pool.run(hparams_list)
+
+    for trial_args, result in zip(args.trial_args, results):
+        if isinstance(result, Exception):
+            print("%-40s FAILED (%s)" % (trial_args, result))
+            continue
+        print("%-40s %s, %.1fs, %.1f ex/s" % (
+            trial_args, result["BestValue"],
+            result["Seconds"], result["ExamplesPerSecond"]))
+    print("Wall time: %.1fs for %d trials" % (
+        time.time() - start_time, len(results)))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,204 @@
+"""Stage-2 trials that share one graph and one stage-1 checkpoint.
+
+The graph (and the merged vocab, and the data pipelines) is built once,
+and the stage-1 checkpoint (`--ckpt_file`) is restored once, into an
+in-memory snapshot of all the variables, where the optimizer slots are
+freshly initialized. Between trials, the variables are reset from the
+snapshot, and only the mixing ratios of the model are swapped, thus a
+trial costs its training steps only.
+
+The trials are either given by `--mixing_ratios`, or proposed by a
+Gaussian-process optimizer (one after another), starting from the arm
+weights of the stage-1 selector. As in `stage2_search.py`, the state of
+the search is saved in `[search_dir]/search_state.json`.
+
+Usage (the arguments after `--` are those of `run_MTL.py`, except
+`--logdir`, `--stage` and `--mixing_ratios`):
+    python warm_start_trials.py --search_dir [search_dir] \
+        --num_trials 30 --stage1_selector [stage1_logdir]/mab_selector \
+        -- --ckpt_file [stage1_ckpt] --tasks [tasks] [...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from skopt import Optimizer
+from skopt.space import Integer
+
+import run_MTL
+import model_utils
+import stage2_search
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+class WarmStartTrialRunner(object):
+    """Runs the `run_MTL._train_loop` of several trials in one model
+
+    `hparams` are expected to be built with `--shared_eval` and
+    `--async_ckpt`, such that the evaluation runs on the live weights,
+    and the checkpoints follow the logdir of each trial.
+    """
+
+    def __init__(self, hparams):
+        if not hparams.shared_eval or not hparams.async_ckpt:
+            raise ValueError("`shared_eval` and `async_ckpt` are required")
+
+        start_time = time.time()
+        self._hparams = hparams
+        self._model, self._val_model = model_utils.build_model(hparams)
+        self._model.initialize_or_restore_session(
+            ckpt_file=hparams.ckpt_file,
+            var_filter_fn=lambda name: (
+                "Adam" not in name and "clone" not in name))
+        # the stage-1 weights, with freshly initialized optimizer slots
+        self._initial_values = self._model.snapshot_variables()
+        self._setup_seconds = time.time() - start_time
+
+    @property
+    def setup_seconds(self):
+        return self._setup_seconds
+
+    def run_trial(self, mixing_ratios, logdir):
+        """Returns the best score of the trial"""
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+        scores_file = os.path.join(logdir, stage2_search.SCORES_FNAME)
+        if os.path.exists(scores_file):
+            os.remove(scores_file)
+
+        # every trial starts from the same weights, step counters
+        # and random states, whatever the trials before it
+        self._model.load_variables(self._initial_values)
+        self._model.reset_training_state()
+        self._model.set_mixing_ratios(mixing_ratios)
+        self._model.set_logdir(logdir)
+        # every trial sees the data in the same order
+        self._model.initialize_data_iterator(model_idx=None)
+        np.random.seed(self._hparams.numpy_seed)
+
+        best_value = run_MTL._train_loop(
+            hparams=self._hparams,
+            manager=run_MTL.build_manager(self._hparams, logdir=logdir),
+            train_MTL_model=self._model,
+            val_MTL_model=self._val_model,
+            scores_file=scores_file)
+
+        self._model.checkpoint_writer.flush()
+        return best_value["Scores"]
+
+    def close(self):
+        self._model.checkpoint_writer.close()
+
+
+def search(run_MTL_args, search_dir, stage1_selector, mixing_ratios,
+           num_trials, min_ratio, max_ratio, num_initial_points,
+           random_seed):
+    if not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+
+    num_tasks = len(run_MTL.get_hparams(
+        run_MTL_args + ["--logdir", search_dir, "--stage", "1"]).tasks)
+    hparams = run_MTL.get_hparams(run_MTL_args + [
+        "--logdir", search_dir,
+        "--stage", "2",
+        "--mixing_ratios", "-".join(["1"] * num_tasks),
+        "--shared_eval",
+        "--async_ckpt"])
+
+    optimizer = Optimizer(
+        dimensions=[Integer(min_ratio, max_ratio)] * num_tasks,
+        base_estimator="GP",
+        n_initial_points=num_initial_points,
+        random_state=random_seed)
+
+    state = stage2_search.SearchState(search_dir)
+    for trial in state.scored_trials:
+        optimizer.tell(trial["mixing_ratios"], -trial["score"])
+
+    queue = state.unfinished_trials
+    if not state.trials:
+        if mixing_ratios:
+            queue.extend(state.add(r) for r in mixing_ratios)
+        elif stage1_selector is not None:
+            queue.append(state.add(stage2_search.stage1_mixing_ratios(
+                stage1_selector, num_tasks, min_ratio, max_ratio)))
+    if mixing_ratios:
+        num_trials = len(mixing_ratios)
+
+    runner = WarmStartTrialRunner(hparams)
+    tf.logging.info("Built the model and restored %s in %.1fs" % (
+        hparams.ckpt_file, runner.setup_seconds))
+
+    while queue or len(state.trials) < num_trials:
+        if not queue:
+            queue.append(state.add(
+                [int(r) for r in optimizer.ask()]))
+        trial = queue.pop(0)
+
+        start_time = time.time()
+        logdir = os.path.join(
+            search_dir, stage2_search.TRIAL_DIRNAME % trial["id"])
+        runner.run_trial(trial["mixing_ratios"], logdir)
+
+        state.finish(trial, stage2_search.FINISHED,
+                     stage2_search.read_scores(os.path.join(
+                         logdir, stage2_search.SCORES_FNAME)))
+        if trial["score"] is not None:
+            optimizer.tell(trial["mixing_ratios"], -trial["score"])
+        tf.logging.info("Trial %d %s: %s in %.1fs" % (
+            trial["id"], trial["mixing_ratios"], trial["score"],
+            time.time() - start_time))
+
+    runner.close()
+    best_trial = state.best_trial
+    if best_trial is None:
+        raise ValueError("No trial has been evaluated")
+
+    print("Best mixing ratios: %s, score %.4f (trial %d)" % (
+        "-".join(str(r) for r in best_trial["mixing_ratios"]),
+        best_trial["score"], best_trial["id"]))
+    return best_trial
+
+
+def main(arguments):
+    # arguments after `--` are passed to `run_MTL.py`
+    run_MTL_args = []
+    if "--" in arguments:
+        run_MTL_args = arguments[arguments.index("--") + 1:]
+        arguments = arguments[:arguments.index("--")]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search_dir", type=str, required=True)
+    parser.add_argument("--stage1_selector", type=str, default=None)
+    # e.g. `--mixing_ratios 1-2-3 2-1-1`, instead of the optimizer
+    parser.add_argument("--mixing_ratios", type=str, nargs="*", default=None)
+    parser.add_argument("--num_trials", type=int, default=30)
+    parser.add_argument("--min_ratio", type=int, default=1)
+    parser.add_argument("--max_ratio", type=int, default=10)
+    parser.add_argument("--num_initial_points", type=int, default=5)
+    parser.add_argument("--random_seed", type=int, default=None)
+    args = parser.parse_args(arguments)
+
+    search(run_MTL_args=run_MTL_args,
+           search_dir=args.search_dir,
+           stage1_selector=args.stage1_selector,
+           mixing_ratios=(
+               [[int(r) for r in ratios.split("-")]
+                for ratios in args.mixing_ratios]
+               if args.mixing_ratios else None),
+           num_trials=args.num_trials,
+           min_ratio=args.min_ratio,
+           max_ratio=args.max_ratio,
+           num_initial_points=args.num_initial_points,
+           random_seed=args.random_seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))